@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import errno
+import textwrap
+import threading
+import time
+from nagiosplugin import *
+
+"""
+Nagios plugin for checking space and inode usage of mounted filesystems. Every mount is checked in one
+invocation and the worst one is reported, with the values for every mount in the perfdata.
+
+Mounts are read from /proc/self/mountinfo. Each mount is queried with statvfs in its own thread, so a hung
+NFS or FUSE mount can't stop the others from being checked. Mounts that don't answer within
+--mount-timeout, or that return an error such as a stale NFS handle, make the check CRITICAL. A hung mount
+isn't queried again until its last query returns, so checks run in-process by nrpe_server.py don't leave a
+new thread behind on it every time.
+
+Requirements
+=============
+
+This script requires the following python modules:
+
+  * argparse (included with python 2.7, otherwise install with 'easy_install argparse')
+
+Notes
+=====
+
+Statistics are:
+
+  * space_used_percentage - used space as a percentage of the space available to ordinary users, as `df`
+    reports it
+  * space_used, space_free - in bytes. space_free is the space available to ordinary users. Use
+    space_used with --delta-time for growth rates.
+  * inodes_used_percentage, inodes_free
+  * reserved_percentage, reserved - space reserved for root, as a percentage of the filesystem and in bytes
+  * time_to_full - seconds until the mount fills up at the rate it has grown since the previous
+    invocation. Mounts that aren't growing are left out, so use a threshold such as -c 3600: to alert when
+    a mount will fill within an hour.
+"""
+
+
+class Disk(NagiosPlugin):
+    """
+    A Nagios plugin to check filesystem space and inode usage. Data is returned in perfdata format and is
+    found using statvfs on each mount.
+    """
+    VERSION = '0.1'
+    SERVICE = 'Disk'
+    AUTHOR = 'Ally B'
+    ## Statistic computed from the growth of used space since the previous invocation
+    TIME_TO_FULL = 'time_to_full'
+    ## Statistics whose smallest value is the worst
+    LOWER_IS_WORSE = ('space_free', 'inodes_free', TIME_TO_FULL)
+
+    class Defaults(object):
+        mountinfo_path = '/proc/self/mountinfo'
+        mount_timeout = 5
+        delta_file_path = '/var/nagios/check_disk_plugin_delta'
+        delta_precision = 2
+        ## Filesystems that don't store files
+        excluded_types = ['autofs', 'binfmt_misc', 'bpf', 'cgroup', 'cgroup2', 'configfs', 'debugfs', 'devpts',
+            'devtmpfs', 'fusectl', 'hugetlbfs', 'mqueue', 'nsfs', 'proc', 'pstore', 'rpc_pipefs', 'securityfs',
+            'sysfs', 'tracefs']
+
+    def parse_args(self, opts):
+        """
+        Parse given options and arguments
+        """
+        parser = self._default_parser(description=self.__doc__, version=self.VERSION, author=self.AUTHOR,
+            delta_file_path=self.Defaults.delta_file_path, delta_precision=self.Defaults.delta_precision)
+
+        parser.add_argument('--mountinfo', nargs='?', default=self.Defaults.mountinfo_path,
+            help="Path to the mountinfo file listing mounts. Default is %s" % self.Defaults.mountinfo_path)
+        parser.add_argument('--mount-timeout', nargs='?', type=float, default=self.Defaults.mount_timeout,
+            help="""Seconds to wait for each mount to answer before reporting it as hung.
+            Default is %d.""" % self.Defaults.mount_timeout)
+        parser.add_argument('--mount', action='append',
+            help="Mount point to check. Can be given more than once. Default is to check every mount.")
+        parser.add_argument('--type', action='append',
+            help="Filesystem type to check, e.g. ext4. Can be given more than once. Default is every type.")
+        parser.add_argument('--exclude-type', action='append',
+            help="""Filesystem type not to check. Can be given more than once. Default is %s.""" %
+            ', '.join(self.Defaults.excluded_types))
+        parser.add_argument('-s', '--statistic', help=textwrap.dedent("""
+        The statistic to check. Possible values are:
+
+            space_used_percentage,
+            space_used,
+            space_free,
+            inodes_used_percentage,
+            inodes_free,
+            reserved_percentage,
+            reserved,
+            time_to_full
+            """), nargs='?', required=True)
+
+        args = parser.parse_args(opts)
+        if 'verbose' not in args:
+            args.verbose = False
+        else:
+            args.verbose = True
+
+        if args.exclude_type == None:
+            args.exclude_type = self.Defaults.excluded_types
+
+        return args
+
+    def _get_statistic(self, statistic):
+        """
+        Returns a dictionary of the statistic's value for each mount that answered. Mounts that didn't are
+        stored in self.failed_mounts.
+        """
+        if statistic not in FilesystemStatistic.STATISTICS + (self.TIME_TO_FULL,):
+            raise InvalidStatisticError("%s is not a valid statistic name." % statistic)
+
+        if statistic == self.TIME_TO_FULL and hasattr(self.args, 'delta_time'):
+            raise InvalidParameterError("%s is already derived from growth rates, so can't be used with --delta-time." %
+                statistic)
+
+        mounts = MountInfo(self.args.mountinfo).get_mounts(self.args.mount, self.args.type, self.args.exclude_type)
+        mount_points = [mount_point for (mount_point, fs_type, source) in mounts]
+        # mounts are queried in threads of their own, which the recorder doesn't follow
+        (stats, self.failed_mounts) = recorder.fetch('statvfs %s' % ' '.join(mount_points),
+            lambda: FilesystemStatistic(self.args.mount_timeout).get_stats(mount_points, self.args.verbose))
+
+        values = {}
+
+        if statistic == self.TIME_TO_FULL:
+            for (mount_point, mount_stats) in stats.items():
+                growth = self._get_delta('%s:%s' % (mount_point, statistic), mount_stats['space_used'], persist=False)
+                if growth > 0:
+                    values[mount_point] = int(mount_stats['space_free'] / growth)
+            self._forget_missing_instances(statistic, stats)
+            self._persist_statistics()
+
+        elif hasattr(self.args, 'delta_time'):
+            for (mount_point, mount_stats) in stats.items():
+                values[mount_point] = self._get_delta('%s:%s' % (mount_point, statistic), mount_stats[statistic],
+                    persist=False)
+            self._forget_missing_instances(statistic, stats)
+            self._persist_statistics()
+
+        else:
+            for (mount_point, mount_stats) in stats.items():
+                values[mount_point] = mount_stats[statistic]
+
+        return values
+
+    def check(self):
+        "Checks every mount, and finds out which status the worst one corresponds to."
+        self.statistic = self.args.statistic
+
+        if hasattr(self.args, 'delta_time'):
+            self.statistic += '_per_second'
+
+        values = self._get_statistic(self.args.statistic)
+
+        if values:
+            (self.worst_mount, self.statistic_value) = self._get_worst_value(values,
+                self.args.statistic in self.LOWER_IS_WORSE and not hasattr(self.args, 'delta_time'))
+            self.status = self._calculate_status(self.statistic_value)
+        else:
+            (self.worst_mount, self.statistic_value) = (None, 0)
+            self.status = self.STATUS_OK
+
+        self.additional_perfdata = [('%s:%s' % (self._get_label(mount_point), self.statistic), value)
+            for (mount_point, value) in sorted(values.items())]
+        self.additional_perfdata.append(('failed_mounts', len(self.failed_mounts)))
+
+        if self.failed_mounts:
+            self.status = self.STATUS_CRITICAL
+
+    def _get_label(self, mount_point):
+        "Returns the mount point with the characters perfdata labels can't contain replaced by underscores"
+        return re.sub(r"['=\n]", '_', mount_point)
+
+    def get_output(self):
+        "Returns an output string for nagios, naming the worst mount and any that failed"
+        (summary, separator, perfdata) = NagiosPlugin.get_output(self).partition(' | ')
+
+        if self.worst_mount != None:
+            summary += " on %s" % self.worst_mount
+
+        if self.failed_mounts:
+            summary += ". Failed: %s" % ', '.join('%s (%s)' % (mount_point, error)
+                for (mount_point, error) in sorted(self.failed_mounts.items()))
+
+        return summary + separator + perfdata
+
+
+class MountInfo(object):
+    "Lists mounts from a mountinfo file"
+
+    ## Characters mountinfo escapes as octal. The backslash must be unescaped last, otherwise a backslash
+    # followed by digits, such as \134040 for the name '\040', would be unescaped twice.
+    ESCAPES = [('\\040', ' '), ('\\011', '\t'), ('\\012', '\n'), ('\\134', '\\')]
+
+    def __init__(self, path):
+        """
+        @param path Path to the mountinfo file
+        """
+        self.path = path
+
+    def get_mounts(self, mount_points=None, types=None, excluded_types=None):
+        """
+        Returns a list of (mount point, filesystem type, source) tuples. Where a mount point appears more than
+        once only the last mount, which hides the others, is returned.
+
+        @param mount_points Mount points to return, or None for all
+        @param types Filesystem types to return, or None for all
+        @param excluded_types Filesystem types not to return
+        """
+        mounts = {}
+
+        # lines look like: 36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+        for line in read_file(self.path).splitlines():
+            (mount_fields, separator, filesystem_fields) = line.partition(' - ')
+            (mount_fields, filesystem_fields) = (mount_fields.split(), filesystem_fields.split())
+
+            if not separator or len(mount_fields) < 5 or len(filesystem_fields) < 2:
+                raise UnexpectedResponseError("Unable to parse line of %s: %s" % (self.path, line))
+
+            mount_point = self.unescape(mount_fields[4])
+            (fs_type, source) = filesystem_fields[:2]
+
+            if mount_points and mount_point not in mount_points:
+                continue
+
+            mounts[mount_point] = (mount_point, fs_type, self.unescape(source))
+
+        # filtered by type only once the mount that hides the others is known
+        return [mounts[mount_point] for mount_point in sorted(mounts)
+            if (not types or mounts[mount_point][1] in types)
+            and not (excluded_types and mounts[mount_point][1] in excluded_types)]
+
+    def unescape(self, field):
+        "Returns a mountinfo field with octal escapes replaced"
+        for (escape, character) in self.ESCAPES:
+            field = field.replace(escape, character)
+
+        return field
+
+
+class FilesystemStatistic(object):
+    "Returns space and inode usage of mounts, querying each in a separate thread"
+
+    STATISTICS = ('space_used_percentage', 'space_used', 'space_free', 'inodes_used_percentage', 'inodes_free',
+        'reserved_percentage', 'reserved')
+
+    ## Threads querying each mount point, kept so a mount is only queried by one thread in the process at once
+    _queries = {}
+    _queries_lock = threading.Lock()
+
+    def __init__(self, timeout):
+        """
+        @param timeout Seconds to wait for each mount to answer
+        """
+        self.timeout = timeout
+
+    def get_stats(self, mount_points, verbose=False):
+        """
+        Returns a tuple of a dictionary of statistics for each mount that answered, and a dictionary of the
+        reason each mount that didn't failed.
+
+        Threads querying hung mounts are left behind as daemon threads, so they don't stop the check from
+        exiting. A mount whose thread from an earlier call is still running isn't queried again, and fails.
+
+        @param mount_points A list of mount points
+        @param vebose Whether to display verbose output
+        """
+        results = {}
+        threads = []
+
+        stats = {}
+        failed = {}
+
+        for mount_point in mount_points:
+            thread = self._start_query(mount_point, results)
+
+            if thread == None:
+                failed[mount_point] = 'still not answering an earlier check'
+                continue
+
+            threads.append((mount_point, thread, time.time() + self.timeout))
+
+        for (mount_point, thread, deadline) in threads:
+            thread.join(max(0, deadline - time.time()))
+
+            if mount_point not in results:
+                failed[mount_point] = 'timed out after %ss' % self.timeout
+                continue
+
+            result = results[mount_point]
+
+            if isinstance(result, OSError):
+                # mounts that have gone, or that we may not look at, aren't failures of the mount itself
+                if result.errno not in (errno.ENOENT, errno.EACCES, errno.EPERM):
+                    failed[mount_point] = result.strerror
+                continue
+
+            stats[mount_point] = self._get_mount_stats(result)
+
+            if verbose:
+                print "%s: %s" % (mount_point, stats[mount_point])
+
+        return (stats, failed)
+
+    def _start_query(self, mount_point, results):
+        "Starts a thread querying the mount point and returns it, or None if an earlier one hasn't returned"
+        self._queries_lock.acquire()
+        try:
+            if mount_point in self._queries and self._queries[mount_point].is_alive():
+                return None
+
+            thread = threading.Thread(target=self._statvfs, args=(mount_point, results))
+            thread.daemon = True
+            thread.start()
+            self._queries[mount_point] = thread
+        finally:
+            self._queries_lock.release()
+
+        return thread
+
+    def _statvfs(self, mount_point, results):
+        "Stores the result of statvfs for a mount point, or the error it raised"
+        try:
+            results[mount_point] = os.statvfs(mount_point)
+        except OSError, error:
+            results[mount_point] = error
+
+    def _get_mount_stats(self, statvfs):
+        "Returns a dictionary of statistics from the result of statvfs"
+        used = statvfs.f_blocks - statvfs.f_bfree
+        reserved = statvfs.f_bfree - statvfs.f_bavail
+        inodes_used = statvfs.f_files - statvfs.f_ffree
+
+        stats = {
+            'space_used': used * statvfs.f_frsize,
+            'space_free': statvfs.f_bavail * statvfs.f_frsize,
+            'reserved': reserved * statvfs.f_frsize,
+            'inodes_free': statvfs.f_ffree,
+            'space_used_percentage': 0,
+            'inodes_used_percentage': 0,
+            'reserved_percentage': 0,
+        }
+
+        if used + statvfs.f_bavail:
+            stats['space_used_percentage'] = round(used * 100.0 / (used + statvfs.f_bavail), 2)
+        if statvfs.f_files:
+            stats['inodes_used_percentage'] = round(inodes_used * 100.0 / statvfs.f_files, 2)
+        if statvfs.f_blocks:
+            stats['reserved_percentage'] = round(reserved * 100.0 / statvfs.f_blocks, 2)
+
+        return stats
+
+
+if __name__ == '__main__':
+    (status, output) = Disk.run(sys.argv[1:])
+    print output
+    sys.exit(status)
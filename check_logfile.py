@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import mmap
+import errno
+from nagiosplugin import *
+
+"""
+Nagios plugin for checking how often patterns appear in a log file.
+
+Each invocation only scans what has been appended to the file since the last one. Where the last scan
+stopped, the file's inode and a running count of matches for each pattern are kept in the delta file. The
+new part of the file is memory mapped and searched with a single regular expression combining every
+pattern, so the file is never read line by line in python.
+
+Rotation is detected by the file's inode changing. The rest of the old file is scanned too if it has been
+renamed to the same path with '.1' appended. If the file is shorter than where the last scan stopped, it
+was truncated and is scanned from the start. The first invocation only records the end of the file, so
+matches already in the log aren't reported.
+
+Requirements
+=============
+
+This script requires the following python modules:
+
+  * argparse (included with python 2.7, otherwise install with 'easy_install argparse')
+
+Notes
+=====
+
+Patterns are given as NAME=REGEX, e.g. --pattern 'errors=\\bERROR\\b' --pattern 'oom=Out of memory'.
+Patterns match within a line, with ^ and $ matching at the start and end of lines. Where patterns overlap,
+text is counted against the first pattern that matches it. Patterns that can match the empty string, such
+as .* or ^$, are rejected, since they would match between every character. Names may not be matches or end
+in _total, since those are the names of statistics. Statistics are:
+
+  * NAME - matches of the pattern in the lines appended since the last invocation
+  * NAME_total - matches of the pattern since the check first ran. Use with --delta-time for the rate
+    of matches per second.
+  * matches, matches_total - the same for all patterns together
+
+Only complete lines are scanned. A line still being written is scanned once it ends.
+"""
+
+
+class LogFile(NagiosPlugin):
+    """
+    A Nagios plugin to check how often patterns appear in the lines appended to a log file.
+    """
+    VERSION = '0.1'
+    SERVICE = 'Logfile'
+    AUTHOR = 'Ally B'
+    ## Prefix of keys in the statistic collection that hold where the last scan of a file stopped
+    POSITION_PREFIX = 'position:'
+    ## Suffix a rotated log file is expected to have
+    ROTATED_SUFFIX = '.1'
+
+    class Defaults(object):
+        delta_file_path = '/var/nagios/check_logfile_plugin_delta'
+        delta_precision = 2
+
+    def parse_args(self, opts):
+        """
+        Parse given options and arguments
+        """
+        parser = self._default_parser(description=self.__doc__, version=self.VERSION, author=self.AUTHOR,
+            delta_file_path=self.Defaults.delta_file_path, delta_precision=self.Defaults.delta_precision)
+
+        parser.add_argument('--logfile', nargs='?', required=True, help="Path to the log file to check.")
+        parser.add_argument('--pattern', action='append', required=True,
+            help="""A pattern to count, as NAME=REGEX. Can be given more than once. NAME may only contain
+            letters, numbers and underscores, and may not be matches or end in _total. REGEX must not match
+            the empty string, so use e.g. ERROR rather than .*ERROR.*""")
+        parser.add_argument('-s', '--statistic', nargs='?', required=True,
+            help="""The statistic to check: the NAME of a pattern for matches since the last invocation,
+            NAME_total for all matches, or matches or matches_total for all patterns together.""")
+
+        args = parser.parse_args(opts)
+        if 'verbose' not in args:
+            args.verbose = False
+        else:
+            args.verbose = True
+
+        args.patterns = self._parse_patterns(args.pattern)
+
+        return args
+
+    def _parse_patterns(self, given):
+        """
+        Returns a list of (name, regex) tuples for the patterns given
+
+        @throws InvalidParameterError if a pattern isn't NAME=REGEX, or its name is taken by a statistic
+        """
+        patterns = []
+
+        for pattern in given:
+            (name, separator, regex) = pattern.partition('=')
+
+            if not separator or not re.match(r'^[A-Za-z_]\w*$', name):
+                raise InvalidParameterError("Patterns must be given as NAME=REGEX, not '%s'." % pattern)
+
+            # the counts of every pattern together, and each pattern's totals, are named like this
+            if name == 'matches' or name.endswith('_total'):
+                raise InvalidParameterError("Pattern names may not be matches or end in _total, not '%s'." % pattern)
+
+            patterns.append((name, regex))
+
+        return patterns
+
+    def _get_statistic(self, statistic):
+        "Scans the new part of the log file and returns the statistic, adding each pattern's matches to the perfdata"
+        patterns = self.args.patterns
+        names = [name for (name, regex) in patterns]
+
+        # services scanning the same file for different patterns each keep their own position and rates
+        self.key_scope = '%s:%r' % (os.path.abspath(self.args.logfile), sorted(patterns))
+        key = self.POSITION_PREFIX + self.key_scope
+        position = self._get_value_from_last_invocation(key).get('value')
+
+        scanner = LogScanner(self.args.logfile, patterns)
+        # the log itself is too large to record, so only what was counted in it is
+        (counts, position) = recorder.fetch('logfile %s' % self.key_scope,
+            lambda: scanner.scan(position, self.ROTATED_SUFFIX, self.args.verbose))
+
+        self.statistic_collection[key] = position
+        self._persist_statistics()
+
+        stats = {'matches': sum(counts.values()), 'matches_total': sum(position['counters'].values())}
+        for name in names:
+            stats[name] = counts[name]
+            stats[name + '_total'] = position['counters'][name]
+
+        if statistic not in stats:
+            raise InvalidStatisticError("%s is not a valid statistic name. Use the name of a pattern." % statistic)
+
+        self.additional_perfdata = [(name, counts[name]) for name in names if name != statistic]
+
+        return stats[statistic]
+
+    def check(self):
+        "Scans the log file, and finds out which status the number of matches corresponds to."
+        self.statistic = self.args.statistic
+        self.statistic_value = self._get_statistic(self.statistic)
+
+        if hasattr(self.args, 'delta_time'):
+            self.statistic_value = self._get_delta('%s:%s' % (self.key_scope, self.statistic), self.statistic_value)
+            self.statistic += '_per_second'
+
+        self.status = self._calculate_status(self.statistic_value)
+
+
+class LogScanner(object):
+    "Counts matches of patterns in the lines appended to a log file since it was last scanned"
+
+    def __init__(self, path, patterns):
+        """
+        @param path Path to the log file
+        @param patterns A list of (name, regex) tuples
+        @throws InvalidParameterError if any of the regular expressions are invalid or match the empty string
+        """
+        self.path = path
+        self.names = [name for (name, regex) in patterns]
+
+        # one pass over the file with every pattern as a named alternative is much faster than one per pattern
+        try:
+            self.regex = re.compile('|'.join('(?P<%s>%s)' % (name, regex) for (name, regex) in patterns), re.MULTILINE)
+        except re.error, error:
+            raise InvalidParameterError("Invalid pattern: %s" % error)
+
+        # a pattern matching nothing would be counted between every character, and hide the other patterns
+        for (name, regex) in patterns:
+            if re.match(regex, '', re.MULTILINE):
+                raise InvalidParameterError("The pattern %s matches the empty string." % name)
+
+    def scan(self, position=None, rotated_suffix=None, verbose=False):
+        """
+        Returns a tuple of a dictionary of the number of matches of each pattern in the lines appended since
+        the position, and the new position.
+
+        Positions are dictionaries of the file's inode, the offset the scan stopped at, and the total number
+        of matches of each pattern.
+
+        @param position The position returned by the previous scan, or None if the file hasn't been scanned
+        @param rotated_suffix Suffix of the path a rotated file is renamed to
+        """
+        counts = dict.fromkeys(self.names, 0)
+
+        try:
+            file = open(self.path, 'rb')
+        except IOError, error:
+            raise NagiosPluginError("Unable to read %s: %s" % (self.path, error))
+
+        try:
+            stat = os.fstat(file.fileno())
+
+            if position == None:
+                # start from the end so matches already logged aren't reported
+                new_position = {'inode': stat.st_ino, 'offset': stat.st_size, 'counters': counts.copy()}
+                return (counts, new_position)
+
+            offset = position['offset']
+
+            if position['inode'] != stat.st_ino:
+                if verbose:
+                    print "%s has been rotated" % self.path
+                self._scan_rotated(position, rotated_suffix, counts, verbose)
+                offset = 0
+            elif stat.st_size < offset:
+                if verbose:
+                    print "%s has been truncated" % self.path
+                offset = 0
+
+            offset = self._scan_file(file, offset, counts, verbose)
+        finally:
+            file.close()
+
+        counters = dict((name, position['counters'].get(name, 0) + counts[name]) for name in self.names)
+
+        return (counts, {'inode': stat.st_ino, 'offset': offset, 'counters': counters})
+
+    def _scan_rotated(self, position, rotated_suffix, counts, verbose=False):
+        "Scans the rest of the file as it was when it was rotated, if it can be found"
+        if rotated_suffix == None:
+            return
+
+        try:
+            file = open(self.path + rotated_suffix, 'rb')
+        except IOError, error:
+            if error.errno != errno.ENOENT:
+                raise NagiosPluginError("Unable to read %s: %s" % (self.path + rotated_suffix, error))
+            return
+
+        try:
+            if os.fstat(file.fileno()).st_ino == position['inode']:
+                self._scan_file(file, position['offset'], counts, verbose, whole_lines=False)
+        finally:
+            file.close()
+
+    def _scan_file(self, file, offset, counts, verbose=False, whole_lines=True):
+        """
+        Counts matches in a file from the offset, adding them to counts. Returns the offset scanning stopped at.
+
+        @param whole_lines Whether to stop after the last complete line. A rotated file won't be written to
+            again, so its last line is scanned even if it doesn't end.
+        """
+        size = os.fstat(file.fileno()).st_size
+        if size <= offset:
+            return offset
+
+        mapped = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+
+        try:
+            end = size
+            if whole_lines:
+                end = mapped.rfind('\n', offset, size) + 1
+                if end <= offset:
+                    return offset
+
+            for match in self.regex.finditer(mapped, offset, end):
+                counts[match.lastgroup] += 1
+        finally:
+            mapped.close()
+
+        if verbose:
+            print "Scanned %d bytes of %s from offset %d" % (end - offset, file.name, offset)
+
+        return end
+
+
+if __name__ == '__main__':
+    (status, output) = LogFile.run(sys.argv[1:])
+    print output
+    sys.exit(status)
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
+import os
+import re
 import sys
 import memcache
-import textwrap
-import os.path
+import socket
+import urllib
 import time
 from nagiosplugin import *
 
@@ -34,6 +36,32 @@ It's useful to monitor the following statistics:
   * get_misses - delta'd by time
   * evictions - delta'd by time
   * bytes_written - delta'd by time
+
+Expressions of statistics can be checked instead of a single statistic, e.g.
+'rate(evictions) / rate(cmd_set)' for evictions per set. Functions rate() and delta() give a statistic's
+change per second and change since the previous invocation. cache_hits_percentage is the expression
+'rate(get_hits) * 100 / rate(cmd_get)'. Every value in an expression comes from the same snapshot of the
+server's statistics.
+
+Statistics beginning 'probe_' measure the latency clients see, by timing --probe-count set, touch and
+delete round trips on canary keys:
+
+  * probe_p50, probe_p99, etc. - any percentile of the latency of all operations, in milliseconds
+  * probe_max, probe_mean - in milliseconds
+  * probe_errors - operations that failed, timed out or didn't find the canary keys
+
+The 99th percentile of each kind of operation is added to the perfdata. With --probe-pipeline, each
+round trip sets, touches or deletes a batch of keys. Canary keys start with --probe-key-prefix followed by
+the host and process ID, so they never collide with production keys. They're stored with a short expiry in
+case the probe is interrupted before deleting them. The number of keys per probe is capped at 1000.
+
+Keys are read back with touch rather than get, which looks them up in the same way but is counted in
+cmd_touch and touch_hits, so the probe doesn't change get_hits, cmd_get or cache_hits_percentage.
+
+Statistics beginning 'metadump_' are computed from the output of `lru_crawler metadump all`, which
+lists every item in the cache (memcached 1.4.31 or later). The dump is read and summarised as it
+streams in, so memory use stays constant however many items there are. The dump makes the server
+walk its entire LRU, so these checks should be run infrequently.
 """
 
 
@@ -49,6 +77,7 @@ class MemcachedStats(NagiosPlugin):
     AUTHOR = 'Ally B'
     ## a constant for a special metric we calculate ourselves
     CACHE_HITS_PERCENTAGE = 'cache_hits_percentage'
+    CACHE_HITS_EXPRESSION = 'rate(get_hits) * 100 / rate(cmd_get)'
 
     class Defaults(object):
         timeout = 3
@@ -56,14 +85,22 @@ class MemcachedStats(NagiosPlugin):
         port = 11211
         delta_file_path = '/var/nagios/check_memcached_plugin_delta'
         delta_precision = 2
+        snapshot_cache_dir = '/dev/shm'
+        metadump_timeout = 60
+        metadump_top = 5
+        key_delimiter = ':'
+        probe_count = 10
+        probe_key_prefix = 'nagios_probe:'
+        probe_value_size = 64
 
     def parse_args(self, opts):
         """
         Parse given options and arguments
         """
         parser = self._default_parser(description=self.__doc__, version=self.VERSION, author=self.AUTHOR,
-            hostname=self.Defaults.hostname, port=self.Defaults.port, delta_file_path=self.Defaults.delta_file_path,
-            delta_precision=self.Defaults.delta_precision)
+            timeout=self.Defaults.timeout, hostname=self.Defaults.hostname, port=self.Defaults.port,
+            delta_file_path=self.Defaults.delta_file_path,
+            delta_precision=self.Defaults.delta_precision, snapshot_cache_dir=self.Defaults.snapshot_cache_dir)
 
         parser.add_argument('-s', '--statistic', nargs='?', required=True,
             help="""The statistic to check. Use one of the following keywords:
@@ -107,7 +144,51 @@ class MemcachedStats(NagiosPlugin):
 
             or the special value:
                 cache_hits_percentage
+
+            or an expression of the above, e.g. 'evictions / cmd_set' or 'rate(get_misses) / rate(cmd_get)'.
+            See the notes at the top of this script.
+
+            or one of the following, measured by probing the server:
+                probe_p50, probe_p99 or any other percentile
+                probe_max
+                probe_mean
+                probe_errors
+
+            or one of the following, computed from a dump of all items:
+                metadump_items
+                metadump_bytes
+                metadump_never_fetched_percentage
+                metadump_no_expiry_percentage
+                metadump_size_p50
+                metadump_size_p99
+                metadump_ttl_p50
+                metadump_idle_p50
+                metadump_idle_p99
+                metadump_prefix_items (requires --metadump-prefix)
+                metadump_prefix_bytes (requires --metadump-prefix)
         """)
+        parser.add_argument('--metadump-timeout', nargs='?', type=float, default=self.Defaults.metadump_timeout,
+            help="""Seconds to wait for more of the item dump for metadump_ statistics before giving up.
+            Default is %d.""" % self.Defaults.metadump_timeout)
+        parser.add_argument('--metadump-top', nargs='?', type=int, default=self.Defaults.metadump_top,
+            help="""Number of key prefixes holding the most bytes to report as perfdata with metadump_
+            statistics. Default is %d.""" % self.Defaults.metadump_top)
+        parser.add_argument('--metadump-prefix', nargs='?',
+            help="Key prefix to count items and bytes for with metadump_prefix_ statistics.")
+        parser.add_argument('--key-delimiter', nargs='?', default=self.Defaults.key_delimiter,
+            help="""Character separating a key's prefix from the rest of the key. Default is '%s'.""" %
+            self.Defaults.key_delimiter)
+        parser.add_argument('--probe-count', nargs='?', type=int, default=self.Defaults.probe_count,
+            help="""Number of round trips of each kind of operation for probe_ statistics.
+            Default is %d.""" % self.Defaults.probe_count)
+        parser.add_argument('--probe-pipeline', nargs='?', type=int, const=10, default=argparse.SUPPRESS,
+            help="""Number of keys to set, touch or delete in each round trip for probe_ statistics.
+            Default is 10 if given without a value.""")
+        parser.add_argument('--probe-key-prefix', nargs='?', default=self.Defaults.probe_key_prefix,
+            help="Prefix of canary keys for probe_ statistics. Default is '%s'." % self.Defaults.probe_key_prefix)
+        parser.add_argument('--probe-value-size', nargs='?', type=int, default=self.Defaults.probe_value_size,
+            help="""Bytes in each canary value for probe_ statistics.
+            Default is %d.""" % self.Defaults.probe_value_size)
         
         args = parser.parse_args(opts)
         if 'verbose' not in args:
@@ -117,33 +198,72 @@ class MemcachedStats(NagiosPlugin):
 
         return args
 
+    def _get_statistic_retriever(self):
+        "Creates the object used to read statistics from the server, if it hasn't been already"
+        if not hasattr(self, 'memcache_statistic'):
+            self.memcache_statistic = MemcacheStatistic(self.args.hostname, self.args.port,
+                self._get_snapshot_cache(self.args.hostname, self.args.port))
+
     def _get_statistic(self, statistic):
         "Returns a tuple containing the name of the specified statistic and its value."
-        if not hasattr(self, 'memcache_statistic'):
-            self.memcache_statistic = MemcacheStatistic(self.args.hostname, self.args.port)
+        self._get_statistic_retriever()
 
         # calculate the cache hits percentage special statistic
         if statistic == self.CACHE_HITS_PERCENTAGE:
-            get_hits = self._get_statistic('get_hits')
-            cmd_get = self._get_statistic('cmd_get')
-            # use separate values for get_hits and cmd_get compared to ordinary invocations to check those
-            # statistics
-            delta_cache_hits = NumberUtils.string_to_number(self._get_delta('get_hits_hit_cache_perc', get_hits))
-            delta_gets = NumberUtils.string_to_number(self._get_delta('cmd_get_hit_cache_perc', cmd_get))
+            return self._evaluate_expression(StatisticExpression.parse(self.CACHE_HITS_EXPRESSION),
+                self.memcache_statistic.get_stats(self.args.verbose))
+        elif statistic.startswith(MemcacheMetadump.PREFIX):
+            return self._get_metadump_statistic(statistic)
+        elif statistic.startswith(MemcacheProbe.PREFIX):
+            return self._get_probe_statistic(statistic)
+        else:
+            return self.memcache_statistic.get_statistic(statistic, self.args.verbose)
 
-            try:
-                cache_hits_percentage = round(delta_cache_hits * 100 / delta_gets, 2)
-            except ZeroDivisionError:
-                cache_hits_percentage = 0
+    def _get_metadump_statistic(self, statistic):
+        "Returns a statistic computed from a dump of all items, adding the top key prefixes to the perfdata"
+        if statistic in (MemcacheMetadump.PREFIX + 'prefix_items', MemcacheMetadump.PREFIX + 'prefix_bytes') \
+                and self.args.metadump_prefix == None:
+            raise InvalidParameterError("--metadump-prefix is required for %s" % statistic)
 
-            if self.args.verbose:
-                print "cache hits: %s, gets: %s" % (get_hits, cmd_get)
-                print "delta_cache_hits: %s, delta_gets: %s" % (delta_cache_hits, delta_gets)
-                print "cache hits %%: %s" % (cache_hits_percentage)
+        # the dump is streamed rather than kept, so there's no response to record
+        self._check_not_recording("Statistics from the item dump")
 
-            return cache_hits_percentage
-        else:
-            return self.memcache_statistic.get_statistic(statistic, self.args.verbose)
+        if not hasattr(self, 'metadump'):
+            self.metadump = MemcacheMetadump(self.args.hostname, self.args.port, self.args.metadump_timeout,
+                self.args.key_delimiter, self.args.metadump_prefix, self.args.metadump_top)
+            self.metadump.analyse(self.args.verbose)
+
+        stats = self.metadump.get_stats()
+
+        if statistic not in stats:
+            raise InvalidStatisticError("No statistic called '%s' can be computed from the item dump." % statistic)
+
+        self.additional_perfdata = [('prefix_bytes_%s' % prefix, value)
+            for (prefix, value) in self.metadump.get_top_prefixes()]
+
+        return stats[statistic]
+
+    def _get_probe_statistic(self, statistic):
+        "Returns a statistic measured by probing the server, adding the latency of each operation to the perfdata"
+        # latencies measured now say nothing about a replay
+        self._check_not_recording("Probe statistics")
+
+        if not hasattr(self, 'probe'):
+            self.probe = MemcacheProbe(self.args.hostname, self.args.port, self.args.timeout, self.args.probe_count,
+                self.args.probe_key_prefix, self.args.probe_value_size, getattr(self.args, 'probe_pipeline', 1))
+            self.probe.run(self.args.verbose)
+
+        value = self.probe.get_statistic(statistic)
+
+        self.additional_perfdata = [(name, probe_value)
+            for (name, probe_value) in sorted(self.probe.get_stats().items()) if name != statistic]
+
+        return value
+
+    def _get_snapshot(self):
+        "Returns all statistics returned by the server, for evaluating expressions"
+        self._get_statistic_retriever()
+        return self.memcache_statistic.get_stats(self.args.verbose)
 
     def _get_delta(self, statistic, current_value):
         "Returns the delta for a statistic"
@@ -158,7 +278,7 @@ class MemcachedStats(NagiosPlugin):
                 delta = current_value
             else:
                 delta = NumberUtils.string_to_number(current_value) - NumberUtils.string_to_number(previous_value['value'])
-            delta_time = round(time.time() - previous_value['time'])
+            delta_time = round(clock.time() - previous_value['time'])
             delta_value = round(delta / delta_time, self.args.delta_precision)
         except (KeyError, ZeroDivisionError):
             pass
@@ -175,7 +295,12 @@ class MemcachedStats(NagiosPlugin):
     def check(self):
         "Retrieves the required statistic value from memcache, and finds out which status it corresponds to."
         self.statistic = self.args.statistic
-        self.statistic_value = self._get_statistic(self.statistic)
+
+        # percentiles such as probe_p99.9 contain a dot, but are statistic names rather than expressions
+        if StatisticExpression.is_expression(self.statistic) and not MemcacheProbe.PERCENTILE.match(self.statistic):
+            self.statistic_value = self._get_expression_value(self.statistic)
+        else:
+            self.statistic_value = self._get_statistic(self.statistic)
 
         if hasattr(self.args, 'delta_time'):
             self.statistic_value = self._get_delta(self.statistic, self.statistic_value)
@@ -186,44 +311,358 @@ class MemcachedStats(NagiosPlugin):
 
 class MemcacheStatistic(object):
     "Returns statistics from a memcache server"
-    def __init__(self, server, port):
+    def __init__(self, server, port, snapshot_cache=None):
+        """
+        @param snapshot_cache An optional SnapshotCache to share the server's statistics with other checks
+        """
         self.memcache = memcache.Client(['%s:%d' % (server, port)])
+        self.snapshot_cache = snapshot_cache
 
-    def get_statistic(self, statistic, verbose=False):
+    def get_stats(self, verbose=False):
         """
-        Returns a statistic value.
+        Returns a dictionary of all statistics returned by the server. If there is a snapshot cache, stats
+        are only requested from the server when the cached snapshot has expired.
 
-        @param statistic The name of the statistic to retrieve
         @param vebose Whether to display verbose output
         """
-        server_stats = self.memcache.get_stats()
+        if self.snapshot_cache:
+            return self.snapshot_cache.get(lambda: self._fetch_stats(verbose))
+
+        return self._fetch_stats(verbose)
+
+    def _fetch_stats(self, verbose=False):
+        "Requests all statistics from the server"
+        server_stats = recorder.fetch('memcached stats', self.memcache.get_stats)
 
         # if no stats were returned, raise an Error
         try:
-            stats = server_stats[0][1]
+            return server_stats[0][1]
         except IndexError:
             if verbose:
                 print "Unable to connect to memcache server. Check the host and port and make sure \nmemcached is running."
             raise NagiosPluginError("Unable to connect to memcache server. Check the host and port and make sure \nmemcached is running.")
 
+    def get_statistic(self, statistic, verbose=False):
+        """
+        Returns a statistic value.
+
+        @param statistic The name of the statistic to retrieve
+        @param vebose Whether to display verbose output
+        """
+        stats = self.get_stats(verbose)
+
         if statistic in stats.keys():
             return stats[statistic]
         else:
             raise InvalidStatisticError("No statistic called '%s' was returned by the memcache server." % statistic)
 
 
+class MemcacheProbe(object):
+    """
+    Measures the latency clients see by timing set, touch and delete round trips on canary keys.
+
+    Latencies are counted in a histogram with fixed buckets, so percentiles can be reported without keeping
+    every measurement.
+    """
+
+    ## Prefix of the names of statistics measured by the probe
+    PREFIX = 'probe_'
+    PERCENTILE = re.compile(r'^probe_p(\d+(?:\.\d+)?)$')
+    ## Keys are read back with touch, since gets would count towards the server's hit ratio
+    OPERATIONS = ('set', 'touch', 'delete')
+    ## Most keys a probe may use, so probes can't fill the cache
+    MAX_KEYS = 1000
+    ## Seconds canary keys are stored for, in case they aren't deleted
+    EXPIRY = 60
+
+    def __init__(self, server, port, timeout, count, key_prefix, value_size=64, pipeline=1):
+        """
+        @param timeout Seconds to wait for each response
+        @param count Number of round trips of each operation
+        @param key_prefix Prefix of canary keys
+        @param value_size Bytes in each canary value
+        @param pipeline Number of keys in each round trip
+        """
+        if count < 1 or pipeline < 1 or count * pipeline > self.MAX_KEYS:
+            raise InvalidParameterError("A probe must use between 1 and %d keys." % self.MAX_KEYS)
+
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.count = count
+        self.pipeline = pipeline
+        self.value = 'x' * value_size
+        self.key_prefix = '%s%s:%d:' % (key_prefix, socket.gethostname(), os.getpid())
+
+        self.errors = 0
+        self.histograms = {}
+        self.latencies = Histogram.exponential(0.05, 1.5, 30)
+        for operation in self.OPERATIONS:
+            self.histograms[operation] = Histogram(self.latencies.bounds)
+
+    def run(self, verbose=False):
+        "Times every round trip, counting errors instead of raising them"
+        self.connection = self._connect()
+
+        try:
+            for round_trip in range(self.count):
+                keys = ['%s%d' % (self.key_prefix, round_trip * self.pipeline + i) for i in range(self.pipeline)]
+
+                for operation in self.OPERATIONS:
+                    self._time(operation, keys)
+        finally:
+            self.connection.close()
+
+        if verbose:
+            print "Probed %s:%d with %d round trips of %d keys: %s" % (self.server, self.port, self.count,
+                self.pipeline, self.get_stats())
+
+    def get_stats(self):
+        "Returns a dictionary of the probe's p50, p99, max, mean and errors, and the p99 of each operation"
+        stats = {
+            self.PREFIX + 'p50': round(self.latencies.percentile(50), 3),
+            self.PREFIX + 'p99': round(self.latencies.percentile(99), 3),
+            self.PREFIX + 'max': round(self.latencies.maximum or 0, 3),
+            self.PREFIX + 'mean': round(self.latencies.mean(), 3),
+            self.PREFIX + 'errors': self.errors,
+        }
+
+        for (operation, histogram) in self.histograms.items():
+            stats['%s%s_p99' % (self.PREFIX, operation)] = round(histogram.percentile(99), 3)
+
+        return stats
+
+    def get_statistic(self, statistic):
+        "Returns a statistic, which may be any percentile of the latency of all operations"
+        match = self.PERCENTILE.match(statistic)
+        if match:
+            return round(self.latencies.percentile(float(match.group(1))), 3)
+
+        stats = self.get_stats()
+        if statistic not in stats:
+            raise InvalidStatisticError("No statistic called '%s' is measured by the probe." % statistic)
+
+        return stats[statistic]
+
+    def _connect(self):
+        "Returns a new connection to the server"
+        try:
+            connection = socket.create_connection((self.server, self.port), self.timeout)
+        except socket.error, error:
+            raise NagiosPluginError("Unable to connect to memcache server %s:%d: %s" % (self.server, self.port,
+                error))
+
+        # send each request straight away, as clients do
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.responses = connection.makefile('rb')
+        return connection
+
+    def _time(self, operation, keys):
+        "Times one round trip of an operation on the keys, counting it as an error if it fails"
+        start = time.time()
+
+        try:
+            getattr(self, '_' + operation)(keys)
+        except (socket.error, UnexpectedResponseError):
+            self.errors += 1
+            # whatever is left of the response would be read as the answer to the next request
+            self.connection.close()
+            self.connection = self._connect()
+            return
+
+        latency = (time.time() - start) * 1000
+        self.latencies.add(latency)
+        self.histograms[operation].add(latency)
+
+    def _set(self, keys):
+        "Stores the canary value in each key"
+        self.connection.sendall(''.join('set %s 0 %d %d\r\n%s\r\n' % (key, self.EXPIRY, len(self.value), self.value)
+            for key in keys))
+        for key in keys:
+            self._expect('STORED')
+
+    def _touch(self, keys):
+        "Looks up each key, checking it's still stored"
+        self.connection.sendall(''.join('touch %s %d\r\n' % (key, self.EXPIRY) for key in keys))
+        for key in keys:
+            self._expect('TOUCHED')
+
+    def _delete(self, keys):
+        "Deletes the keys"
+        self.connection.sendall(''.join('delete %s\r\n' % key for key in keys))
+        for key in keys:
+            self._expect('DELETED')
+
+    def _expect(self, expected):
+        "Reads a response line, raising an error if it isn't the one expected"
+        line = self._read_line()
+        if line != expected:
+            raise UnexpectedResponseError("Expected %s but the server returned %s" % (expected, line))
+
+    def _read_line(self):
+        "Reads a response line without its line ending"
+        line = self.responses.readline()
+        if not line:
+            raise socket.error("The server closed the connection")
+
+        return line.rstrip('\r\n')
+
+
+class MemcacheMetadump(object):
+    """
+    Summarises the items on a memcache server by streaming the output of `lru_crawler metadump all`.
+
+    Each line of the dump describes one item, e.g.:
+
+      key=user%3A1234 exp=1500003600 la=1500000000 cas=17 fetch=yes cls=1 size=63
+
+    Lines are summarised as they're read into histograms and approximate top-K counters, so memory use
+    doesn't grow with the number of items.
+    """
+
+    ## Prefix of the names of statistics computed from the dump
+    PREFIX = 'metadump_'
+
+    def __init__(self, server, port, timeout, delimiter=':', prefix=None, top=5):
+        """
+        @param timeout Seconds to wait for each part of the dump
+        @param delimiter Character separating key prefixes from the rest of keys
+        @param prefix Key prefix to count items and bytes for exactly
+        @param top Number of prefixes holding the most bytes to report
+        """
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.top = top
+
+        # keys are URL encoded in the dump, so compare them with the encoded delimiter and prefix
+        self.delimiter = urllib.quote(delimiter, safe='-._~')
+        self.prefix = prefix
+        if prefix != None:
+            self.prefix = urllib.quote(prefix, safe='-._~')
+
+        self.items = 0
+        self.bytes = 0
+        self.never_fetched = 0
+        self.no_expiry = 0
+        self.prefix_items = 0
+        self.prefix_bytes = 0
+        ## item sizes from 64 bytes to 32MB
+        self.sizes = Histogram.exponential(64, 2, 20)
+        ## remaining time to live and time since last access, from 1 second to around a year
+        self.ttls = Histogram.exponential(1, 2, 25)
+        self.idle_times = Histogram.exponential(1, 2, 25)
+        ## track more prefixes than are reported to make the reported counts more accurate
+        self.prefix_bytes_counter = TopCounter(max(top * 10, 100))
+
+    def analyse(self, verbose=False):
+        "Requests the dump from the server and summarises it"
+        if verbose:
+            print "Requesting lru_crawler metadump all from %s:%d" % (self.server, self.port)
+
+        try:
+            connection = socket.create_connection((self.server, self.port), self.timeout)
+        except socket.error, error:
+            raise NagiosPluginError("Unable to connect to memcache server %s:%d: %s" % (self.server, self.port,
+                error))
+
+        try:
+            try:
+                connection.sendall("lru_crawler metadump all\r\n")
+                self.analyse_lines(connection.makefile('rb'))
+            except socket.error, error:
+                raise NagiosPluginError("Error reading the item dump from %s:%d: %s" % (self.server, self.port,
+                    error))
+        finally:
+            connection.close()
+
+        if verbose:
+            print "Analysed %d items" % self.items
+
+    def analyse_lines(self, lines, now=None):
+        """
+        Summarises dump lines from an iterable until the END line.
+
+        @param now The time to measure TTLs and idle times from. Defaults to the current time.
+        @throws UnexpectedResponseError if the server returns an error or the dump ends early
+        """
+        if now == None:
+            now = time.time()
+
+        for line in lines:
+            if line.startswith('key='):
+                self._add_item(line, now)
+            elif line.rstrip() == 'END':
+                return
+            elif line.strip():
+                raise UnexpectedResponseError("The server returned '%s' when asked for an item dump. "
+                    "lru_crawler metadump requires memcached 1.4.31 or later." % line.strip())
+
+        raise UnexpectedResponseError("The item dump ended before the END line.")
+
+    def _add_item(self, line, now):
+        "Adds an item from a dump line to the summary"
+        item = {}
+        for field in line.split():
+            (name, separator, value) = field.partition('=')
+            item[name] = value
+
+        try:
+            size = int(item['size'])
+            expires = int(item['exp'])
+            last_access = int(item['la'])
+        except (KeyError, ValueError):
+            raise UnexpectedResponseError("Unable to parse item dump line '%s'" % line.strip())
+
+        self.items += 1
+        self.bytes += size
+        self.sizes.add(size)
+        self.idle_times.add(max(now - last_access, 0))
+
+        if item.get('fetch') == 'no':
+            self.never_fetched += 1
+
+        if expires == -1:
+            self.no_expiry += 1
+        else:
+            self.ttls.add(max(expires - now, 0))
+
+        prefix = item['key'].split(self.delimiter, 1)[0]
+        self.prefix_bytes_counter.add(prefix, size)
+
+        if prefix == self.prefix:
+            self.prefix_items += 1
+            self.prefix_bytes += size
+
+    def _percentage(self, count):
+        if not self.items:
+            return 0
+        return round(count * 100.0 / self.items, 2)
+
+    def get_stats(self):
+        "Returns a dictionary of the statistics computed from the dump"
+        stats = {
+            'items': self.items,
+            'bytes': self.bytes,
+            'never_fetched_percentage': self._percentage(self.never_fetched),
+            'no_expiry_percentage': self._percentage(self.no_expiry),
+            'size_p50': int(self.sizes.percentile(50)),
+            'size_p99': int(self.sizes.percentile(99)),
+            'ttl_p50': int(self.ttls.percentile(50)),
+            'idle_p50': int(self.idle_times.percentile(50)),
+            'idle_p99': int(self.idle_times.percentile(99)),
+            'prefix_items': self.prefix_items,
+            'prefix_bytes': self.prefix_bytes,
+        }
+
+        return dict((self.PREFIX + name, value) for (name, value) in stats.items())
+
+    def get_top_prefixes(self):
+        "Returns a list of (prefix, bytes) tuples for the prefixes holding the most bytes. Prefixes are URL encoded."
+        return self.prefix_bytes_counter.top(self.top)
+
 
 if __name__ == '__main__':
-    try:
-        checker = MemcachedStats(sys.argv[1:])
-        checker.check()
-        status = checker.get_status()
-        print checker.get_output()
-        sys.exit(status)
-    except (ThresholdValidatorError, InvalidStatisticError), e:
-        print textwrap.fill(str(e), 80)
-        sys.exit(NagiosPlugin.STATUS_UNKNOWN)
-    except NagiosPluginError, e:
-        print textwrap.fill("%s failed unexpectedly. Error was:" % (os.path.basename(__file__,)), 80)
-        print textwrap.fill(str(e), 80)
-        sys.exit(NagiosPlugin.STATUS_UNKNOWN)
\ No newline at end of file
+    (status, output) = MemcachedStats.run(sys.argv[1:])
+    print output
+    sys.exit(status)
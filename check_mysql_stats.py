@@ -2,8 +2,9 @@
 import sys
 import re
 import MySQLdb
-import textwrap
-import os.path
+import MySQLdb.cursors
+import binascii
+import heapq
 import time
 from nagiosplugin import *
 
@@ -42,6 +43,87 @@ It's useful to monitor the following statistics:
   * Threads_connected
   * Threads_created
   * Threads_running
+
+Expressions of SHOW GLOBAL STATUS variables can be checked instead of a single variable, e.g.
+'Threads_created / Connections', or 'rate(Innodb_buffer_pool_reads) * 100 / rate(Innodb_buffer_pool_read_requests)'
+for the buffer pool miss ratio. Functions rate() and delta() give a variable's change per second and
+change since the previous invocation. Every value in an expression comes from a single SHOW GLOBAL STATUS.
+
+Statistics beginning 'processlist_' are computed from information_schema.PROCESSLIST instead:
+
+  * processlist_threads - all connections
+  * processlist_active - connections that aren't sleeping
+  * processlist_long_running - queries running for at least --long-query-time seconds
+  * processlist_state - connections in the state given by --state, e.g. 'Locked'
+  * processlist_oldest_transaction - age in seconds of the oldest open InnoDB transaction
+
+Counts of connections in each state are added to the perfdata. The process list is read with an
+unbuffered cursor and aggregated row by row, so even tens of thousands of connections don't have to be
+held in memory at once.
+
+Statistics beginning 'digest_' are computed from performance_schema.events_statements_summary_by_digest
+by comparing each statement digest's counters with those from the previous invocation:
+
+  * digest_calls_per_second - statements executed per second
+  * digest_latency_per_second - seconds spent executing statements per second
+  * digest_rows_examined_per_second - rows examined per second
+  * digest_top_latency_percentage - the largest share of total latency taken by a single digest
+
+These are already rates, so they can't be used with --delta-time. The digests taking the most time are
+added to the perfdata, labelled with their schema and the start of the digest. Counters for digests that
+have disappeared from the table are dropped from the delta file.
+
+Statistics beginning 'innodb_status_' are parsed from the output of SHOW ENGINE INNODB STATUS, which
+reports signs of write stalls that SHOW GLOBAL STATUS doesn't:
+
+  * innodb_status_history_list_length
+  * innodb_status_checkpoint_age - bytes of redo log written since the last checkpoint
+  * innodb_status_semaphore_waits - threads currently waiting on a semaphore
+  * innodb_status_pending_reads, innodb_status_pending_aio_writes, innodb_status_pending_log_fsyncs, etc.
+
+See InnoDBStatusParser for the full list.
+
+Statistics beginning 'tables_' summarise the size of every table in information_schema.TABLES. Reading
+sizes for tens of thousands of tables at once can stall the server, so each invocation only reads the
+next --tables-per-run tables, resuming from where the last invocation stopped, and keeps the sizes of
+all tables in the delta file:
+
+  * tables_count - tables seen so far
+  * tables_data_length, tables_index_length, tables_data_free - summed over all tables, in bytes
+  * tables_total_length - data plus index length, useful with --delta-time for growth rates
+  * tables_fragmentation_percentage - free space as a percentage of all space allocated to tables
+  * tables_max_fragmentation_percentage - the same for the most fragmented table of at least
+    --min-table-size bytes
+
+The tables with the most free space are added to the perfdata. Totals only cover every table once a
+full pass has been made, which takes the number of tables divided by --tables-per-run invocations. Until
+then the status is UNKNOWN and no values are reported, so partial totals can't be mistaken for real ones.
+
+Statistics beginning 'statement_latency_' are computed from performance_schema's
+events_statements_histogram_global (MySQL 8.0 or later), which counts every statement into a bucket by its
+latency. The bucket counts are stored in the delta file, and percentiles are estimated from the change in
+each bucket since the previous invocation, so they describe the latency of statements run in between:
+
+  * statement_latency_p50, statement_latency_p95, statement_latency_p99, etc. - any percentile, in
+    milliseconds
+  * statement_latency_count - statements completed in the interval
+
+Statistics beginning 'probe_' measure the latency an application sees, by connecting --probe-count times
+and running --probe-query on each connection:
+
+  * probe_connect_ms - mean time to connect and authenticate, in milliseconds
+  * probe_connect_max - the slowest connection, in milliseconds
+  * probe_query_p50, probe_query_p99, etc. - any percentile of the query's latency, in milliseconds
+  * probe_query_max - in milliseconds
+  * probe_errors - connections and queries that failed. If every one fails, the status is UNKNOWN.
+
+Slow handshakes are often the first sign that the server has run out of cached threads. With
+--probe-reuse-connection the server is connected to once and the query run --probe-count times on that
+connection, which measures query latency without the cost of connecting.
+
+probe_connect_ms covers the TCP connect, the handshake and authentication together, since MySQLdb doesn't
+expose them separately. They aren't timed apart by opening bare TCP connections, because the server counts
+connections closed before the handshake as errors, and blocks hosts that make max_connect_errors of them.
 """
 
 class MySQLStats(NagiosPlugin):
@@ -53,6 +135,24 @@ class MySQLStats(NagiosPlugin):
     VERSION = '0.1'
     SERVICE = 'MySQL'
     AUTHOR = 'Ally B'
+    ## Prefix of the names of statistics computed from statement digests
+    DIGEST_PREFIX = 'digest_'
+    ## Key in the statistic collection for the previous invocation's digest counters
+    DIGEST_COUNTERS = 'digest_counters'
+    ## performance_schema timers count picoseconds
+    PICOSECONDS = 1000000000000.0
+    ## Prefix of the names of statistics computed from the statement latency histogram
+    STATEMENT_LATENCY_PREFIX = 'statement_latency_'
+    STATEMENT_LATENCY_PERCENTILE = re.compile(r'^statement_latency_p(\d+(?:\.\d+)?)$')
+    ## Key in the statistic collection for the histogram's bucket counts
+    STATEMENT_HISTOGRAM = 'statement_histogram'
+    ## Prefix of the names of statistics computed from table sizes
+    TABLES_PREFIX = 'tables_'
+    ## Keys in the statistic collection for the incremental table scan's position and the sizes found
+    TABLE_SCAN = 'table_scan'
+    TABLE_SIZES = 'table_sizes'
+    ## Number of tables with the most free space to add to the perfdata
+    TABLES_TOP = 5
 
     class Defaults(object):
         timeout = 3
@@ -60,6 +160,14 @@ class MySQLStats(NagiosPlugin):
         port = 3306
         delta_file_path = '/var/nagios/check_mysql_stats_plugin_delta'
         delta_precision = 2
+        snapshot_cache_dir = '/dev/shm'
+        max_staleness = 300
+        long_query_time = 60
+        digest_top = 5
+        tables_per_run = 500
+        min_table_size = 10485760
+        probe_count = 10
+        probe_query = 'SELECT 1'
 
     def parse_args(self, opts):
         """
@@ -67,12 +175,43 @@ class MySQLStats(NagiosPlugin):
         """
         parser = self._default_parser(description=self.__doc__, version=self.VERSION, author=self.AUTHOR,
             hostname=self.Defaults.hostname, port=self.Defaults.port, delta_file_path=self.Defaults.delta_file_path,
-            delta_precision=self.Defaults.delta_precision, timeout=self.Defaults.timeout)
+            delta_precision=self.Defaults.delta_precision, timeout=self.Defaults.timeout,
+            snapshot_cache_dir=self.Defaults.snapshot_cache_dir, max_staleness=self.Defaults.max_staleness)
 
         parser.add_argument('-u', '--username', nargs='?', help="User name to connect with.", required=True)
         parser.add_argument('--password', nargs='?', help="Password to connect with.", required=True)
         parser.add_argument('-s', '--statistic', help="""The statistic to check. One of the variable names
-        returned by the SHOW GLOBAL STATUS mysql command.""", nargs='?', required=True)
+        returned by the SHOW GLOBAL STATUS mysql command, or one of the processlist_ statistics: processlist_threads,
+        processlist_active, processlist_long_running, processlist_state, processlist_oldest_transaction, or one of
+        the digest_ statistics: digest_calls_per_second, digest_latency_per_second, digest_rows_examined_per_second,
+        digest_top_latency_percentage, or one of the innodb_status_ or tables_ statistics listed in the notes at
+        the top of this script, or one of the probe_ statistics: probe_connect_ms, probe_connect_max,
+        probe_query_p50, probe_query_p99 or any other percentile, probe_query_max, probe_errors, or one of the
+        statement_latency_ statistics: statement_latency_p50, statement_latency_p99 or any other percentile,
+        statement_latency_count. An expression of SHOW GLOBAL STATUS variables can be given instead, e.g.
+        'Threads_created / Connections'.""",
+        nargs='?', required=True)
+        parser.add_argument('--long-query-time', nargs='?', type=int, default=self.Defaults.long_query_time,
+            help="""Seconds a query must have been running for to count towards processlist_long_running.
+            Default is %d.""" % self.Defaults.long_query_time)
+        parser.add_argument('--state', nargs='?', help="""Connection state to count for processlist_state,
+            e.g. 'Locked' or 'Sending data'.""")
+        parser.add_argument('--digest-top', nargs='?', type=int, default=self.Defaults.digest_top,
+            help="""Number of statement digests taking the most time to report as perfdata with digest_
+            statistics. Default is %d.""" % self.Defaults.digest_top)
+        parser.add_argument('--tables-per-run', nargs='?', type=int, default=self.Defaults.tables_per_run,
+            help="""Number of tables to read sizes for on each invocation with tables_ statistics.
+            Default is %d.""" % self.Defaults.tables_per_run)
+        parser.add_argument('--min-table-size', nargs='?', type=int, default=self.Defaults.min_table_size,
+            help="""Smallest table, in bytes, considered for tables_max_fragmentation_percentage.
+            Default is %d.""" % self.Defaults.min_table_size)
+        parser.add_argument('--probe-count', nargs='?', type=int, default=self.Defaults.probe_count,
+            help="""Number of connections, or queries with --probe-reuse-connection, for probe_ statistics.
+            Default is %d.""" % self.Defaults.probe_count)
+        parser.add_argument('--probe-query', nargs='?', default=self.Defaults.probe_query,
+            help="Query to time for probe_ statistics. Default is '%s'." % self.Defaults.probe_query)
+        parser.add_argument('--probe-reuse-connection', nargs='?', default=argparse.SUPPRESS,
+            help="Run every probe query on a single connection, to time queries without connecting.")
 
         args = parser.parse_args(opts)
         if 'verbose' not in args:
@@ -80,60 +219,615 @@ class MySQLStats(NagiosPlugin):
         else:
             args.verbose = True
 
+        if args.digest_top < 1:
+            raise InvalidParameterError("--digest-top must be at least 1.")
+
         return args
 
-    def _get_statistic(self, statistic):
-        "Returns a tuple containing the name of the specified statistic and its value."
+    def _get_statistic_retriever(self):
+        "Creates the object used to read statistics from the server, if it hasn't been already"
         if not hasattr(self, 'statistic_retriever'):
             try:
                 if self.args.verbose:
                     print "Connecting to database with details: ", self.args
                 self.statistic_retriever = MySQLStatistic(self.args.hostname, self.args.port, self.args.username,
-                    self.args.password, self.args.timeout)
+                    self.args.password, self.args.timeout,
+                    self._get_snapshot_cache(self.args.hostname, self.args.port, self.args.username))
             except Exception, error:
                 raise NagiosPluginError("Error: %s" % (error))
 
+    def _get_snapshot(self):
+        "Returns all variables returned by SHOW GLOBAL STATUS, for evaluating expressions"
+        self._get_statistic_retriever()
+        return self.statistic_retriever.get_status(self.args.verbose)
+
+    def _get_statistic(self, statistic):
+        "Returns a tuple containing the name of the specified statistic and its value."
+        self._get_statistic_retriever()
+
+        if statistic.startswith(self.STATEMENT_LATENCY_PREFIX):
+            return self._get_statement_latency_statistic(statistic)
+
+        if statistic.startswith(MySQLProbe.PREFIX):
+            return self._get_probe_statistic(statistic)
+
+        if statistic.startswith(MySQLStatistic.PROCESSLIST_PREFIX):
+            return self._get_processlist_statistic(statistic)
+
+        if statistic.startswith(self.DIGEST_PREFIX):
+            return self._get_digest_statistic(statistic)
+
+        if statistic.startswith(self.TABLES_PREFIX):
+            return self._get_table_statistic(statistic)
+
+        if statistic.startswith(InnoDBStatusParser.PREFIX):
+            stats = self.statistic_retriever.get_innodb_status(self.args.verbose)
+            if statistic not in stats:
+                raise InvalidStatisticError("No statistic called '%s' was found in the InnoDB status." % statistic)
+            return stats[statistic]
+
         return self.statistic_retriever.get_statistic(statistic, self.args.verbose)
 
-    def _get_delta(self, statistic, current_value):
-        "Returns the delta for a statistic"
-        previous_value = self._get_value_from_last_invocation(statistic)
-        delta_value = 0
+    def _get_processlist_statistic(self, statistic):
+        "Returns a statistic computed from the process list, adding counts by state to the perfdata"
+        if statistic == MySQLStatistic.PROCESSLIST_PREFIX + 'oldest_transaction':
+            return self.statistic_retriever.get_oldest_transaction_age(self.args.verbose)
 
-        # calculate delta, catching division by zero errors
-        try:
-            delta = NumberUtils.string_to_number(current_value) - NumberUtils.string_to_number(previous_value['value'])
-            delta_time = round(time.time() - previous_value['time'])
-            delta_value = round(delta / delta_time, self.args.delta_precision)
-        except (KeyError, ZeroDivisionError):
-            pass
+        if statistic == MySQLStatistic.PROCESSLIST_PREFIX + 'state' and self.args.state == None:
+            raise InvalidParameterError("--state is required for %s" % statistic)
 
-        self.statistic_collection[statistic] = current_value
+        (stats, states) = self.statistic_retriever.get_processlist_stats(self.args.long_query_time,
+            self.args.verbose)
 
-        try:
-            self.statistic_collection.persist()
-        except IOError, error:
-            raise NagiosPluginError("%s.\nProbably means we were unable to write to file %s" % (str(error), self.args.delta_file))
+        self.additional_perfdata = [('state_%s' % (state or 'none'), count)
+            for (state, count) in sorted(states.items())]
+
+        if statistic == MySQLStatistic.PROCESSLIST_PREFIX + 'state':
+            return states.get(self.args.state, 0)
+
+        if statistic not in stats:
+            raise InvalidStatisticError("No statistic called '%s' can be computed from the process list." % statistic)
+
+        return stats[statistic]
+
+    def _get_digest_statistic(self, statistic):
+        """
+        Returns a statistic computed from the change in each statement digest's counters since the last
+        invocation, adding the digests taking the most time to the perfdata.
+        """
+        if hasattr(self.args, 'delta_time'):
+            raise InvalidParameterError("%s is already derived from rates, so can't be used with --delta-time." %
+                statistic)
+
+        current = self.statistic_retriever.get_digest_counters(self.args.verbose)
+        previous = self._get_value_from_last_invocation(self.DIGEST_COUNTERS)
+
+        # only the digests in the table now are stored, so those that disappear are forgotten
+        self.statistic_collection[self.DIGEST_COUNTERS] = current
+        self._persist_statistics()
+
+        totals = [0, 0, 0]
+        deltas = []
+
+        if previous:
+            interval = clock.time() - previous['time']
+
+            for (digest, counters) in current.iteritems():
+                previous_counters = previous['value'].get(digest)
+
+                # new digests, and those whose counters were reset, have only been counted since then
+                if previous_counters == None or counters[0] < previous_counters[0]:
+                    delta = counters
+                else:
+                    delta = (counters[0] - previous_counters[0], counters[1] - previous_counters[1],
+                        counters[2] - previous_counters[2])
+
+                if delta[0]:
+                    deltas.append((delta[1], digest))
+                    for i in range(3):
+                        totals[i] += delta[i]
+        else:
+            interval = 0
+
+        if interval <= 0:
+            stats = dict.fromkeys(['calls_per_second', 'latency_per_second', 'rows_examined_per_second',
+                'top_latency_percentage'], 0)
+        else:
+            top = heapq.nlargest(self.args.digest_top, deltas)
+            stats = {
+                'calls_per_second': round(totals[0] / interval, self.args.delta_precision),
+                'latency_per_second': round(totals[1] / self.PICOSECONDS / interval, self.args.delta_precision),
+                'rows_examined_per_second': round(totals[2] / interval, self.args.delta_precision),
+                'top_latency_percentage': 0,
+            }
+
+            if totals[1]:
+                stats['top_latency_percentage'] = round(max(deltas)[0] * 100.0 / totals[1], 2)
+
+            # the same statement run in different schemas has the same digest, so both are in the label
+            self.additional_perfdata = [('digest_%s_%s_latency_per_second' % (self._get_schema_label(digest[0]),
+                binascii.hexlify(digest[1])[:12] or 'other'),
+                round(latency / self.PICOSECONDS / interval, self.args.delta_precision)) for (latency, digest) in top]
+
+        stats = dict((self.DIGEST_PREFIX + name, value) for (name, value) in stats.items())
+
+        if statistic not in stats:
+            raise InvalidStatisticError("No statistic called '%s' can be computed from statement digests." %
+                statistic)
+
+        if self.args.verbose:
+            print "Digest statistics over %.1f seconds: %s" % (interval, stats)
+
+        return stats[statistic]
+
+    def _get_statement_latency_statistic(self, statistic):
+        """
+        Returns a percentile of the latency of statements run since the last invocation, estimated from the
+        change in the statement latency histogram's buckets. p50, p95, p99 and the number of statements are
+        added to the perfdata.
+        """
+        (bounds, counts) = self.statistic_retriever.get_statement_histogram(self.args.verbose)
+        previous = self._get_value_from_last_invocation(self.STATEMENT_HISTOGRAM)
+
+        self.statistic_collection[self.STATEMENT_HISTOGRAM] = counts
+        self._persist_statistics()
+
+        if not previous:
+            deltas = [0] * len(counts)
+        else:
+            deltas = [current - last for (current, last) in zip(counts, previous['value'])]
+
+            # if the histogram was truncated or the server restarted, statements have only been counted since
+            if len(previous['value']) != len(counts) or min(deltas) < 0:
+                deltas = counts
+
+        # the last bucket counts everything slower than the bound before it
+        histogram = Histogram(bounds[:-1], deltas)
+
+        stats = {self.STATEMENT_LATENCY_PREFIX + 'count': histogram.count}
+        for percentile in (50, 95, 99):
+            stats['%sp%d' % (self.STATEMENT_LATENCY_PREFIX, percentile)] = round(histogram.percentile(percentile), 3)
+
+        if self.args.verbose:
+            print "Statement latency over the interval: %s" % stats
+
+        self.additional_perfdata = [(name, value) for (name, value) in sorted(stats.items()) if name != statistic]
+
+        match = self.STATEMENT_LATENCY_PERCENTILE.match(statistic)
+        if match:
+            return round(histogram.percentile(float(match.group(1))), 3)
+
+        if statistic not in stats:
+            raise InvalidStatisticError("No statistic called '%s' can be computed from the statement latency histogram." %
+                statistic)
+
+        return stats[statistic]
+
+    def _get_probe_statistic(self, statistic):
+        "Returns a statistic measured by probing the server, adding the others to the perfdata"
+        # latencies measured now say nothing about a replay
+        self._check_not_recording("Probe statistics")
+
+        if not hasattr(self, 'probe'):
+            self.probe = MySQLProbe(self.args.hostname, self.args.port, self.args.username, self.args.password,
+                self.args.timeout, self.args.probe_query)
+            self.probe.run(self.args.probe_count, hasattr(self.args, 'probe_reuse_connection'), self.args.verbose)
 
-        return delta_value
+        value = self.probe.get_statistic(statistic)
+
+        self.additional_perfdata = [(name, probe_value)
+            for (name, probe_value) in sorted(self.probe.get_stats().items()) if name != statistic]
+
+        return value
+
+    def _get_schema_label(self, schema):
+        "Returns a schema name for use in a perfdata label, with characters labels can't contain replaced"
+        if schema == None:
+            return 'none'
+
+        return re.sub(r"['=\s]", '_', schema)
+
+    def _scan_tables(self):
+        """
+        Reads the sizes of the next --tables-per-run tables, updating the sizes kept in the statistic
+        collection. Returns a tuple of the dictionary of sizes, keyed by (schema, table) with values of
+        (data length, index length, data free, pass number), and whether a full pass has ever been completed.
+
+        Each table's entry records the pass of the scan it was last seen in. When a pass finishes, tables
+        that weren't seen during it must have been dropped and are forgotten.
+        """
+        scan = self._get_value_from_last_invocation(self.TABLE_SCAN).get('value',
+            {'cursor': None, 'pass': 0, 'complete': False})
+        sizes = self._get_value_from_last_invocation(self.TABLE_SIZES).get('value', {})
+
+        names = self.statistic_retriever.get_table_names_after(scan['cursor'], self.args.tables_per_run,
+            self.args.verbose)
+
+        for (schema, table, data_length, index_length, data_free) in \
+                self.statistic_retriever.get_table_sizes(names, self.args.verbose):
+            sizes[(schema, table)] = (data_length, index_length, data_free, scan['pass'])
+
+        if len(names) < self.args.tables_per_run:
+            # this pass has reached the last table, so start the next one from the beginning
+            sizes = dict((key, value) for (key, value) in sizes.iteritems() if value[3] == scan['pass'])
+            scan = {'cursor': None, 'pass': scan['pass'] + 1, 'complete': True}
+        else:
+            scan = {'cursor': names[-1], 'pass': scan['pass'], 'complete': scan['complete']}
+
+        if self.args.verbose:
+            print "Read sizes for %d tables. Next scan position: %s. Full pass completed: %s" % (len(names),
+                scan['cursor'], scan['complete'])
+
+        self.statistic_collection[self.TABLE_SCAN] = scan
+        self.statistic_collection[self.TABLE_SIZES] = sizes
+        self._persist_statistics()
+
+        return (sizes, scan['complete'])
+
+    def _get_table_statistic(self, statistic):
+        """
+        Returns a statistic computed from the sizes of all tables, adding the most fragmented to the perfdata
+
+        @throws IncompleteStatisticError if the first full pass over the tables hasn't finished
+        """
+        if not hasattr(self, 'table_sizes'):
+            (self.table_sizes, complete) = self._scan_tables()
+
+            if not complete:
+                raise IncompleteStatisticError("Sizes of %d tables have been read so far. %s isn't reported until "
+                    "the first pass over every table has finished." % (len(self.table_sizes), statistic))
+
+        data_length = index_length = data_free = 0
+        max_fragmentation = 0
+
+        for (data, index, free, scan_pass) in self.table_sizes.itervalues():
+            data_length += data
+            index_length += index
+            data_free += free
+
+            allocated = data + index + free
+            if allocated >= self.args.min_table_size:
+                max_fragmentation = max(max_fragmentation, free * 100.0 / allocated)
+
+        allocated = data_length + index_length + data_free
+        fragmentation = 0
+        if allocated:
+            fragmentation = data_free * 100.0 / allocated
+
+        stats = {
+            'count': len(self.table_sizes),
+            'data_length': data_length,
+            'index_length': index_length,
+            'data_free': data_free,
+            'total_length': data_length + index_length,
+            'fragmentation_percentage': round(fragmentation, 2),
+            'max_fragmentation_percentage': round(max_fragmentation, 2),
+        }
+        stats = dict((self.TABLES_PREFIX + name, value) for (name, value) in stats.items())
+
+        if statistic not in stats:
+            raise InvalidStatisticError("No statistic called '%s' can be computed from table sizes." % statistic)
+
+        most_free = heapq.nlargest(self.TABLES_TOP, self.table_sizes.iteritems(), key=lambda item: item[1][2])
+        self.additional_perfdata = [('data_free_%s.%s' % table, sizes[2]) for (table, sizes) in most_free]
+
+        return stats[statistic]
 
     def check(self):
         "Retrieves the required statistic value from the server, and finds out which status it corresponds to."
         self.statistic = self.args.statistic
-        self.statistic_value = self._get_statistic(self.statistic)
 
         if hasattr(self.args, 'delta_time'):
-            self.statistic_value = self._get_delta(self.statistic, self.statistic_value)
             self.statistic += '_per_second'
 
+        (self.statistic_value, self.stale_age) = self._evaluate_within_latency_budget(self.statistic,
+            self._evaluate_statistic)
+
         self.status = self._calculate_status(self.statistic_value)
 
+    def _evaluate_statistic(self):
+        "Returns the value to report for the statistic, which is its change per second if --delta-time was given"
+        if self._is_expression(self.args.statistic):
+            return self._get_expression_value(self.args.statistic)
+
+        value = self._get_statistic(self.args.statistic)
+
+        if hasattr(self.args, 'delta_time'):
+            value = self._get_delta(self.args.statistic, value)
+
+        return value
+
+    def _is_expression(self, statistic):
+        "Returns whether the statistic is an expression, allowing for percentiles such as statement_latency_p99.9"
+        if MySQLProbe.QUERY_PERCENTILE.match(statistic) or self.STATEMENT_LATENCY_PERCENTILE.match(statistic):
+            return False
+
+        return StatisticExpression.is_expression(statistic)
+
 
 class MySQLStatistic(object):
     "Returns statistics from a memcache server"
-    def __init__(self, host, port, username, password, timeout):
-        self.mysql = MySQLdb.Connect(host=host, port=port, user=username, passwd=password,
-            connect_timeout=timeout)
+
+    ## Prefix of the names of statistics computed from the process list
+    PROCESSLIST_PREFIX = 'processlist_'
+    ## Commands of connections that aren't running anything
+    IDLE_COMMANDS = ('Sleep', 'Daemon', 'Binlog Dump', 'Binlog Dump GTID')
+    ## Users of the server's own long-lived threads
+    SYSTEM_USERS = ('system user', 'event_scheduler')
+    def __init__(self, host, port, username, password, timeout, snapshot_cache=None):
+        """
+        The connection to the server is only made when a query needs to be run, so checks that are answered
+        from the snapshot cache never connect.
+
+        @param snapshot_cache An optional SnapshotCache to share the server's status with other checks
+        """
+        self.connection_details = {'host': host, 'port': port, 'user': username, 'passwd': password,
+            'connect_timeout': timeout}
+        self.snapshot_cache = snapshot_cache
+
+    def _get_connection(self):
+        "Returns a connection to the server, connecting if necessary"
+        if not hasattr(self, 'mysql'):
+            try:
+                self.mysql = MySQLdb.Connect(**self.connection_details)
+            except MySQLdb.Error, error:
+                raise NagiosPluginError("Error: %s" % (error))
+
+        return self.mysql
+
+    def _query(self, sql, parameters=None, streamed=False):
+        """
+        Returns the rows returned by a statement, through the recorder so they're recorded with --record and
+        replayed with --replay.
+
+        @param parameters Parameters to substitute into the statement
+        @param streamed Whether to return an iterator over rows read from the server with an unbuffered cursor
+            as they're needed, rather than a list of every row. Rows being recorded or replayed are always
+            read into a list.
+        """
+        if streamed and not recorder.is_active():
+            return self._stream(sql, parameters)
+
+        source = 'mysql %s' % sql
+        if parameters:
+            source += ' %s' % (parameters,)
+
+        return recorder.fetch(source, lambda: list(self._stream(sql, parameters, streamed)))
+
+    def _stream(self, sql, parameters=None, unbuffered=True):
+        "Yields the rows returned by a statement"
+        if unbuffered:
+            cursor = self._get_connection().cursor(MySQLdb.cursors.SSCursor)
+        else:
+            cursor = self._get_connection().cursor()
+
+        try:
+            cursor.execute(sql, parameters)
+
+            row = cursor.fetchone()
+            while row != None:
+                yield row
+                row = cursor.fetchone()
+        finally:
+            cursor.close()
+
+    def get_status(self, verbose=False):
+        """
+        Returns a dictionary of all variables returned by SHOW GLOBAL STATUS. If there is a snapshot cache,
+        the server is only queried when the cached snapshot has expired.
+
+        @param vebose Whether to display verbose output
+        """
+        if self.snapshot_cache:
+            return self.snapshot_cache.get(lambda: self._fetch_status(verbose))
+
+        return self._fetch_status(verbose)
+
+    def _fetch_status(self, verbose=False):
+        "Queries the server for all status variables"
+        sql = "SHOW GLOBAL STATUS"
+
+        if verbose:
+            print "Executing SQL statement: %s" % sql
+
+        return dict(self._query(sql))
+
+    def get_processlist_stats(self, long_query_time, verbose=False):
+        """
+        Returns a tuple (stats, states) summarising the process list. stats is a dictionary of processlist_
+        statistics and states is a dictionary of connection counts by state.
+
+        Rows are streamed from the server with an unbuffered cursor and counted as they arrive.
+
+        @param long_query_time Seconds a query must have been running for to count as long running
+        @param vebose Whether to display verbose output
+        """
+        sql = "SELECT USER, COMMAND, TIME, STATE FROM information_schema.PROCESSLIST"
+
+        if verbose:
+            print "Executing SQL statement: %s" % sql
+
+        threads = active = long_running = 0
+        states = {}
+
+        for (user, command, running_time, state) in self._query(sql, streamed=True):
+            threads += 1
+            state = state or ''
+            states[state] = states.get(state, 0) + 1
+
+            if command not in self.IDLE_COMMANDS:
+                active += 1
+
+                # replication and event scheduler threads run for as long as the server does
+                if user not in self.SYSTEM_USERS and running_time >= long_query_time:
+                    long_running += 1
+
+        stats = {
+            self.PROCESSLIST_PREFIX + 'threads': threads,
+            self.PROCESSLIST_PREFIX + 'active': active,
+            self.PROCESSLIST_PREFIX + 'long_running': long_running,
+        }
+
+        if verbose:
+            print "Process list: %s, states: %s" % (stats, states)
+
+        return (stats, states)
+
+    def get_digest_counters(self, verbose=False):
+        """
+        Returns a dictionary of the counters for every statement digest. Keys are tuples of the schema name
+        and binary digest, and values are tuples of (calls, total latency in picoseconds, rows examined).
+
+        Rows are streamed from the server with an unbuffered cursor as the table can hold thousands of them.
+
+        @param vebose Whether to display verbose output
+        """
+        sql = """SELECT SCHEMA_NAME, DIGEST, COUNT_STAR, SUM_TIMER_WAIT, SUM_ROWS_EXAMINED
+            FROM performance_schema.events_statements_summary_by_digest"""
+
+        if verbose:
+            print "Executing SQL statement: %s" % sql
+
+        counters = {}
+
+        for (schema, digest, calls, latency, rows_examined) in self._query(sql, streamed=True):
+            # digests are hex strings, stored as binary to halve the size of the delta file. The row
+            # counting statements that didn't fit in the table has no digest.
+            if digest:
+                digest = binascii.unhexlify(digest)
+            else:
+                digest = ''
+
+            counters[(schema, digest)] = (int(calls), int(latency), int(rows_examined))
+
+        if verbose:
+            print "Read counters for %d statement digests" % len(counters)
+
+        return counters
+
+    def get_statement_histogram(self, verbose=False):
+        """
+        Returns a tuple of a list of the upper bounds of the global statement latency histogram's buckets in
+        milliseconds, and a list of the number of statements counted in each bucket.
+
+        @param vebose Whether to display verbose output
+        """
+        sql = """SELECT BUCKET_TIMER_HIGH, COUNT_BUCKET FROM performance_schema.events_statements_histogram_global
+            ORDER BY BUCKET_NUMBER"""
+
+        if verbose:
+            print "Executing SQL statement: %s" % sql
+
+        try:
+            rows = self._query(sql)
+        except MySQLdb.Error, error:
+            raise NagiosPluginError("Unable to read the statement latency histogram, which needs MySQL 8.0 or later: %s" %
+                error)
+
+        if not rows:
+            raise UnexpectedResponseError("The statement latency histogram is empty. Is performance_schema enabled?")
+
+        # timers count picoseconds
+        bounds = [int(high) / 1000000000.0 for (high, count) in rows]
+        counts = [int(count) for (high, count) in rows]
+
+        return (bounds, counts)
+
+    def get_innodb_status(self, verbose=False):
+        """
+        Returns a dictionary of the statistics parsed from SHOW ENGINE INNODB STATUS
+
+        @param vebose Whether to display verbose output
+        """
+        sql = "SHOW ENGINE INNODB STATUS"
+
+        if verbose:
+            print "Executing SQL statement: %s" % sql
+
+        rows = self._query(sql)
+
+        # the row is (Type, Name, Status)
+        if not rows or len(rows[0]) != 3:
+            raise UnexpectedResponseError("SHOW ENGINE INNODB STATUS returned no status. Is InnoDB enabled?")
+
+        stats = InnoDBStatusParser().parse(rows[0][2])
+
+        if verbose:
+            print "Parsed InnoDB status: %s" % stats
+
+        return stats
+
+    def get_table_names_after(self, position, limit, verbose=False):
+        """
+        Returns a list of up to limit (schema, table) tuples for the base tables that sort after position.
+        System schemas are skipped.
+
+        Only names are selected so the server doesn't need to open each table.
+
+        @param position A (schema, table) tuple, or None to start from the first table
+        @param vebose Whether to display verbose output
+        """
+        sql = """SELECT TABLE_SCHEMA, TABLE_NAME FROM information_schema.TABLES
+            WHERE TABLE_TYPE = 'BASE TABLE'
+            AND TABLE_SCHEMA NOT IN ('mysql', 'information_schema', 'performance_schema', 'sys')"""
+        parameters = []
+
+        if position != None:
+            sql += " AND (TABLE_SCHEMA > %s OR (TABLE_SCHEMA = %s AND TABLE_NAME > %s))"
+            parameters = [position[0], position[0], position[1]]
+
+        sql += " ORDER BY TABLE_SCHEMA, TABLE_NAME LIMIT %d" % limit
+
+        if verbose:
+            print "Executing SQL statement: %s with %s" % (sql, parameters)
+
+        return [(schema, table) for (schema, table) in self._query(sql, parameters)]
+
+    def get_table_sizes(self, names, verbose=False):
+        """
+        Returns a list of (schema, table, data length, index length, data free) tuples for the given tables.
+
+        Sizes are queried one schema at a time, which lets the server only look at that schema's tables.
+
+        @param names A list of (schema, table) tuples
+        @param vebose Whether to display verbose output
+        """
+        tables_by_schema = {}
+        for (schema, table) in names:
+            tables_by_schema.setdefault(schema, []).append(table)
+
+        sizes = []
+
+        for (schema, tables) in sorted(tables_by_schema.items()):
+            sql = """SELECT TABLE_SCHEMA, TABLE_NAME, DATA_LENGTH, INDEX_LENGTH, DATA_FREE
+                FROM information_schema.TABLES WHERE TABLE_SCHEMA = %%s AND TABLE_NAME IN (%s)""" % \
+                ', '.join(['%s'] * len(tables))
+
+            if verbose:
+                print "Reading sizes of %d tables in %s" % (len(tables), schema)
+
+            for (schema_name, table, data_length, index_length, data_free) in self._query(sql, [schema] + tables):
+                sizes.append((schema_name, table, int(data_length or 0), int(index_length or 0), int(data_free or 0)))
+
+        return sizes
+
+    def get_oldest_transaction_age(self, verbose=False):
+        """
+        Returns the age in seconds of the oldest open InnoDB transaction, or 0 if there are none.
+
+        @param vebose Whether to display verbose output
+        """
+        sql = "SELECT MAX(TIMESTAMPDIFF(SECOND, trx_started, NOW())) FROM information_schema.INNODB_TRX"
+
+        if verbose:
+            print "Executing SQL statement: %s" % sql
+
+        rows = self._query(sql)
+
+        if not rows or rows[0][0] == None:
+            return 0
+
+        return int(rows[0][0])
 
     def get_statistic(self, statistic, verbose=False):
         """
@@ -145,20 +839,28 @@ class MySQLStatistic(object):
         if not re.match("^[a-z_A-Z]+$", statistic):
             raise InvalidStatisticError("%s is not a valid statistic name." % statistic)
 
+        # with a snapshot cache all variables are fetched at once so other checks can share them
+        if self.snapshot_cache:
+            status = self.get_status(verbose)
+            if statistic not in status:
+                raise UnexpectedResponseError("""Nothing returned for statistic '%s'. Run SHOW GLOBAL STATUS to make sure it's a
+valid statistic name.""" % statistic)
+
+            return status[statistic]
+
         sql = "SHOW GLOBAL STATUS LIKE '%s'" % statistic
 
         if verbose:
             print "Executing SQL statement: %s" % sql
 
-        cursor = self.mysql.cursor()
-        cursor.execute(sql)
+        rows = self._query(sql)
 
-        stats = cursor.fetchone()
-
-        if not stats:
+        if not rows:
             raise UnexpectedResponseError("""Nothing returned for statistic '%s'. Run SHOW GLOBAL STATUS to make sure it's a
 valid statistic name.""" % statistic)
-        elif len(stats) != 2:
+        stats = rows[0]
+
+        if len(stats) != 2:
             raise UnexpectedResponseError("Expected 2 responses from the server, received %d" % len(stats))
 
         if verbose:
@@ -167,17 +869,249 @@ valid statistic name.""" % statistic)
         return stats[1]
 
 
+class MySQLProbe(object):
+    """
+    Measures the latency an application sees by timing connections to the server and a query run on them.
+    Latencies are counted in histograms with fixed buckets.
+    """
+
+    ## Prefix of the names of statistics measured by the probe
+    PREFIX = 'probe_'
+    QUERY_PERCENTILE = re.compile(r'^probe_query_p(\d+(?:\.\d+)?)$')
+
+    def __init__(self, host, port, username, password, timeout, query):
+        """
+        @param timeout Seconds to wait for each connection
+        @param query The query to time
+        """
+        self.connection_details = {'host': host, 'port': port, 'user': username, 'passwd': password,
+            'connect_timeout': timeout}
+        self.query = query
+
+        self.errors = 0
+        self.last_error = None
+        self.connect_latencies = Histogram.exponential(0.1, 1.5, 30)
+        self.query_latencies = Histogram(self.connect_latencies.bounds)
+
+    def run(self, count, reuse_connection=False, verbose=False):
+        """
+        Times count connections with a query on each, or with reuse_connection a single connection with count
+        queries on it. Errors are counted instead of raised, unless every query failed.
+
+        @throws NagiosPluginError if no query was timed, since there are no latencies to report
+        """
+        if count < 1:
+            raise InvalidParameterError("The probe must make at least one connection or query.")
+
+        if reuse_connection:
+            connection = self._connect()
+            if connection != None:
+                try:
+                    for i in range(count):
+                        self._time_query(connection)
+                finally:
+                    connection.close()
+        else:
+            for i in range(count):
+                connection = self._connect()
+                if connection != None:
+                    try:
+                        self._time_query(connection)
+                    finally:
+                        connection.close()
+
+        if not self.query_latencies.count:
+            raise NagiosPluginError("Every probe of the MySQL server failed. The last error was: %s" % self.last_error)
+
+        if verbose:
+            print "Probed with %d %s: %s" % (count, reuse_connection and 'queries' or 'connections',
+                self.get_stats())
+
+    def get_stats(self):
+        "Returns a dictionary of the probe's connect time, query p50, p99 and max, and errors"
+        return {
+            self.PREFIX + 'connect_ms': round(self.connect_latencies.mean(), 3),
+            self.PREFIX + 'connect_max': round(self.connect_latencies.maximum or 0, 3),
+            self.PREFIX + 'query_p50': round(self.query_latencies.percentile(50), 3),
+            self.PREFIX + 'query_p99': round(self.query_latencies.percentile(99), 3),
+            self.PREFIX + 'query_max': round(self.query_latencies.maximum or 0, 3),
+            self.PREFIX + 'errors': self.errors,
+        }
+
+    def get_statistic(self, statistic):
+        "Returns a statistic, which may be any percentile of the query's latency"
+        match = self.QUERY_PERCENTILE.match(statistic)
+        if match:
+            return round(self.query_latencies.percentile(float(match.group(1))), 3)
+
+        stats = self.get_stats()
+        if statistic not in stats:
+            raise InvalidStatisticError("No statistic called '%s' is measured by the probe." % statistic)
+
+        return stats[statistic]
+
+    def _connect(self):
+        "Returns a new connection after timing the TCP connect and handshake together, or None if connecting failed"
+        start = time.time()
+
+        try:
+            connection = MySQLdb.Connect(**self.connection_details)
+        except MySQLdb.Error, error:
+            self.errors += 1
+            self.last_error = error
+            return None
+
+        self.connect_latencies.add((time.time() - start) * 1000)
+        return connection
+
+    def _time_query(self, connection):
+        "Times the query, including fetching its results"
+        start = time.time()
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute(self.query)
+            cursor.fetchall()
+            cursor.close()
+        except MySQLdb.Error, error:
+            self.errors += 1
+            self.last_error = error
+            return
+
+        self.query_latencies.add((time.time() - start) * 1000)
+
+
+class InnoDBStatusParser(object):
+    """
+    Parses the text returned by SHOW ENGINE INNODB STATUS into named statistics in a single pass.
+
+    The text is divided into sections, each headed by a title between two lines of dashes:
+
+      ------------
+      TRANSACTIONS
+      ------------
+      Trx id counter 1234
+      History list length 42
+
+    Lines are only matched against the patterns for the section they're in, since some (such as
+    'Pending reads') appear in several sections with different meanings.
+    """
+
+    ## Prefix of the names of statistics parsed from the status
+    PREFIX = 'innodb_status_'
+
+    ## For each section, regular expressions whose groups are the values of the listed statistics. Lists of
+    # numbers in square brackets are summed.
+    PATTERNS = {
+        'SEMAPHORES': [
+            (re.compile(r'^OS WAIT ARRAY INFO: reservation count (\d+)'), ['semaphore_reservation_count']),
+            (re.compile(r'^OS WAIT ARRAY INFO: signal count (\d+)'), ['semaphore_signal_count']),
+            (re.compile(r'^Mutex spin waits (\d+), rounds (\d+), OS waits (\d+)'),
+                ['mutex_spin_waits', 'mutex_spin_rounds', 'mutex_os_waits']),
+            (re.compile(r'^RW-shared spins (\d+), rounds (\d+), OS waits (\d+)'),
+                ['rw_shared_spins', 'rw_shared_rounds', 'rw_shared_os_waits']),
+            (re.compile(r'^RW-excl spins (\d+), rounds (\d+), OS waits (\d+)'),
+                ['rw_excl_spins', 'rw_excl_rounds', 'rw_excl_os_waits']),
+        ],
+        'TRANSACTIONS': [
+            (re.compile(r'^History list length (\d+)'), ['history_list_length']),
+        ],
+        'FILE I/O': [
+            (re.compile(r'^Pending normal aio reads:\s*(\d+|\[[\d, ]*\])\s*,\s*aio writes:\s*(\d+|\[[\d, ]*\])'),
+                ['pending_aio_reads', 'pending_aio_writes']),
+            (re.compile(r'^Pending flushes \(fsync\) log: (\d+); buffer pool: (\d+)'),
+                ['pending_log_fsyncs', 'pending_buffer_pool_fsyncs']),
+        ],
+        'LOG': [
+            (re.compile(r'^Log sequence number\s+(\d+(?: \d+)?)$'), ['log_sequence_number']),
+            (re.compile(r'^Log flushed up to\s+(\d+(?: \d+)?)$'), ['log_flushed_up_to']),
+            (re.compile(r'^Last checkpoint at\s+(\d+(?: \d+)?)$'), ['last_checkpoint']),
+            (re.compile(r'^(\d+) pending log (?:writes|flushes), (\d+) pending chkp writes'),
+                ['pending_log_writes', 'pending_checkpoint_writes']),
+        ],
+        'BUFFER POOL AND MEMORY': [
+            (re.compile(r'^Buffer pool size\s+(\d+)'), ['buffer_pool_pages']),
+            (re.compile(r'^Free buffers\s+(\d+)'), ['free_pages']),
+            (re.compile(r'^Database pages\s+(\d+)'), ['database_pages']),
+            (re.compile(r'^Modified db pages\s+(\d+)'), ['modified_pages']),
+            (re.compile(r'^Pending reads\s+(\d+)'), ['pending_reads']),
+            (re.compile(r'^Pending writes: LRU (\d+), flush list (\d+), single page (\d+)'),
+                ['pending_writes_lru', 'pending_writes_flush_list', 'pending_writes_single_page']),
+        ],
+        'ROW OPERATIONS': [
+            (re.compile(r'^(\d+) queries inside InnoDB, (\d+) queries in queue'),
+                ['queries_inside', 'queries_in_queue']),
+        ],
+    }
+
+    DASHES = re.compile(r'^-{3,}$')
+    ## Lines reporting a thread currently waiting for a semaphore
+    SEMAPHORE_WAIT = re.compile(r'^--Thread \d+ has waited')
+
+    def parse(self, status):
+        "Returns a dictionary of the statistics found in the status text"
+        stats = {'semaphore_waits': 0}
+        section = None
+        title = None
+        after_dashes = False
+
+        for line in status.splitlines():
+            line = line.rstrip()
+
+            if self.DASHES.match(line):
+                # dashes straight after a possible title confirm that it's the start of a new section
+                if title != None:
+                    section = title
+                    title = None
+                else:
+                    after_dashes = True
+                continue
+
+            title = None
+            if after_dashes:
+                title = line.strip()
+                after_dashes = False
+
+            if section == 'SEMAPHORES' and self.SEMAPHORE_WAIT.match(line):
+                stats['semaphore_waits'] += 1
+                continue
+
+            for (pattern, names) in self.PATTERNS.get(section, ()):
+                match = pattern.match(line)
+                if match:
+                    for (name, value) in zip(names, match.groups()):
+                        stats[name] = self._to_number(value)
+                    break
+
+        if 'log_sequence_number' in stats and 'last_checkpoint' in stats:
+            stats['checkpoint_age'] = stats['log_sequence_number'] - stats['last_checkpoint']
+
+        if stats.get('buffer_pool_pages'):
+            if 'modified_pages' in stats:
+                stats['modified_pages_percentage'] = round(stats['modified_pages'] * 100.0 /
+                    stats['buffer_pool_pages'], 2)
+            if 'free_pages' in stats:
+                stats['free_pages_percentage'] = round(stats['free_pages'] * 100.0 / stats['buffer_pool_pages'], 2)
+
+        return dict((self.PREFIX + name, value) for (name, value) in stats.items())
+
+    @staticmethod
+    def _to_number(value):
+        """
+        Converts a value matched in the status to a number. Lists like [0, 1, 0] are summed, and the pairs
+        of numbers old versions of MySQL print for log sequence numbers are combined.
+        """
+        if value.startswith('['):
+            return sum(int(number) for number in re.findall(r'\d+', value))
+
+        numbers = value.split()
+        if len(numbers) == 2:
+            return (int(numbers[0]) << 32) + int(numbers[1])
+
+        return int(value)
+
+
 if __name__ == '__main__':
-    try:
-        checker = MySQLStats(sys.argv[1:])
-        checker.check()
-        status = checker.get_status()
-        print checker.get_output()
-        sys.exit(status)
-    except (ThresholdValidatorError, InvalidStatisticError), e:
-        print textwrap.fill(str(e), 80)
-        sys.exit(NagiosPlugin.STATUS_UNKNOWN)
-    except NagiosPluginError, e:
-        print textwrap.fill("%s failed unexpectedly. Error was:" % (os.path.basename(__file__,)), 80)
-        print textwrap.fill(str(e), 80)
-        sys.exit(NagiosPlugin.STATUS_UNKNOWN)
\ No newline at end of file
+    (status, output) = MySQLStats.run(sys.argv[1:])
+    print output
+    sys.exit(status)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+import re
+import sys
+import mmap
+import textwrap
+from nagiosplugin import *
+
+"""
+Nagios plugin for checking aggregates of other services' results, e.g. MySQL questions per second summed
+across all replicas, or the percentage of memcached services that are CRITICAL. Results are read from
+Nagios' status.dat.
+
+status.dat can be hundreds of MB, so it's memory mapped rather than read, and only the blocks for services
+whose host and description match are decoded. Where each matching service was found is stored in the
+delta file. While Nagios hasn't been restarted, so the file lists the same services in the same order,
+later invocations look for each service near where it was last time instead of scanning the whole file.
+
+Requirements
+=============
+
+This script requires the following python modules:
+
+  * argparse (included with python 2.7, otherwise install with 'easy_install argparse')
+
+Notes
+=====
+
+Statistics are:
+
+  * count - matching services
+  * sum, average, minimum, maximum - of the perfdata value given by --label, over the matching services
+    that report it
+  * ok_percentage, warning_percentage, critical_percentage, unknown_percentage - matching services in each
+    state
+  * problem_percentage - matching services that aren't OK
+
+For example, to alert when more than a quarter of memcached services are CRITICAL:
+
+  check_nagios_aggregate.py --service '^Memcached' -s critical_percentage -w 10 -c 25
+"""
+
+
+class NagiosAggregate(NagiosPlugin):
+    """
+    A Nagios plugin to check aggregates of the results of other services, read from Nagios' status.dat.
+    """
+    VERSION = '0.1'
+    SERVICE = 'Aggregate'
+    AUTHOR = 'Ally B'
+    ## Prefix of keys in the statistic collection that hold where matching services were found
+    OFFSETS_PREFIX = 'offsets:'
+    ## Names of service states, by state code
+    STATES = ['ok', 'warning', 'critical', 'unknown']
+
+    class Defaults(object):
+        status_file_path = '/usr/local/nagios/var/status.dat'
+        delta_file_path = '/var/nagios/check_nagios_aggregate_plugin_delta'
+        delta_precision = 2
+
+    def parse_args(self, opts):
+        """
+        Parse given options and arguments
+        """
+        parser = self._default_parser(description=self.__doc__, version=self.VERSION, author=self.AUTHOR,
+            delta_file_path=self.Defaults.delta_file_path, delta_precision=self.Defaults.delta_precision)
+
+        parser.add_argument('--status-file', nargs='?', default=self.Defaults.status_file_path,
+            help="Path to Nagios' status.dat. Default is %s" % self.Defaults.status_file_path)
+        parser.add_argument('--host', nargs='?', default='',
+            help="Regular expression matching the host names of services to aggregate. Default is all hosts.")
+        parser.add_argument('--service', nargs='?', default='',
+            help="Regular expression matching the descriptions of services to aggregate. Default is all services.")
+        parser.add_argument('--label', nargs='?',
+            help="Perfdata label of the value to aggregate for sum, average, minimum and maximum.")
+        parser.add_argument('-s', '--statistic', help=textwrap.dedent("""
+        The statistic to check. Possible values are:
+
+            count,
+            sum,
+            average,
+            minimum,
+            maximum,
+            ok_percentage,
+            warning_percentage,
+            critical_percentage,
+            unknown_percentage,
+            problem_percentage
+            """), nargs='?', required=True)
+
+        args = parser.parse_args(opts)
+        if 'verbose' not in args:
+            args.verbose = False
+        else:
+            args.verbose = True
+
+        return args
+
+    def _get_statistic(self, statistic):
+        "Returns the value of an aggregate over the matching services"
+        if statistic in ('sum', 'average', 'minimum', 'maximum') and self.args.label == None:
+            raise InvalidParameterError("--label is required for %s" % statistic)
+
+        key = '%s%s:%s:%s' % (self.OFFSETS_PREFIX, self.args.status_file, self.args.host, self.args.service)
+        status_file = StatusFile(self.args.status_file)
+        offsets = self._get_value_from_last_invocation(key).get('value')
+
+        try:
+            (host_pattern, service_pattern) = (re.compile(self.args.host), re.compile(self.args.service))
+        except re.error, error:
+            raise InvalidParameterError("Invalid regular expression: %s" % error)
+
+        # status.dat is too large to record, so only the services decoded from it are
+        (services, offsets) = recorder.fetch('status %s' % key[len(self.OFFSETS_PREFIX):],
+            lambda: status_file.get_services(host_pattern, service_pattern, offsets, self.args.verbose))
+
+        self.statistic_collection[key] = offsets
+        self._persist_statistics()
+
+        states = [0] * len(self.STATES)
+        values = []
+
+        for service in services:
+            states[min(service['current_state'], len(self.STATES) - 1)] += 1
+            if self.args.label in service['perfdata']:
+                values.append(service['perfdata'][self.args.label])
+
+        stats = {
+            'count': len(services),
+            'sum': sum(values),
+            'average': 0,
+            'minimum': 0,
+            'maximum': 0,
+        }
+
+        if values:
+            stats['average'] = round(float(sum(values)) / len(values), 2)
+            stats['minimum'] = min(values)
+            stats['maximum'] = max(values)
+
+        for (state, count) in zip(self.STATES, states):
+            stats['%s_percentage' % state] = 0
+        stats['problem_percentage'] = 0
+
+        if services:
+            for (state, count) in zip(self.STATES, states):
+                stats['%s_percentage' % state] = round(count * 100.0 / len(services), 2)
+            stats['problem_percentage'] = round((len(services) - states[0]) * 100.0 / len(services), 2)
+
+        if self.args.verbose:
+            print "Aggregates over %d services: %s" % (len(services), stats)
+
+        if statistic not in stats:
+            raise InvalidStatisticError("%s is not a valid statistic name." % statistic)
+
+        self.additional_perfdata = [('%s_services' % state, count) for (state, count) in zip(self.STATES, states)]
+
+        return stats[statistic]
+
+    def check(self):
+        "Aggregates the results of the matching services, and finds out which status it corresponds to."
+        self.statistic = self.args.statistic
+        self.statistic_value = self._get_statistic(self.statistic)
+
+        if hasattr(self.args, 'delta_time'):
+            self.statistic_value = self._get_delta(self.statistic, self.statistic_value)
+            self.statistic += '_per_second'
+
+        self.status = self._calculate_status(self.statistic_value)
+
+
+class StatusFile(object):
+    """
+    Reads service results from Nagios' status.dat. Service blocks look like:
+
+      servicestatus {
+      \thost_name=db1
+      \tservice_description=MySQL Questions
+      \tcurrent_state=0
+      \t...
+      \tperformance_data='Questions_per_second'=12.3
+      \t}
+    """
+
+    BLOCK_START = '\nservicestatus {\n\thost_name='
+    DESCRIPTION = '\n\tservice_description='
+    BLOCK_END = '\n\t}'
+    ## Bytes either side of a service's previous offset to look for it in first
+    SEARCH_WINDOW = 65536
+    PERFDATA = re.compile(r"('[^']+'|[^\s=']+)=(-?[0-9.]+)")
+
+    def __init__(self, path):
+        """
+        @param path Path to status.dat
+        """
+        self.path = path
+
+    def get_services(self, host_pattern, service_pattern, offsets=None, verbose=False):
+        """
+        Returns a tuple of a list of the results of matching services, and offsets to pass to the next call
+        to find them again quickly. Results are dictionaries of the host, service, current_state and a
+        dictionary of perfdata values by label.
+
+        @param host_pattern Compiled regular expression the host name must match
+        @param service_pattern Compiled regular expression the service description must match
+        @param offsets The offsets returned by a previous call, or None
+        """
+        try:
+            file = open(self.path, 'rb')
+        except IOError, error:
+            raise NagiosPluginError("Unable to read %s: %s" % (self.path, error))
+
+        try:
+            try:
+                status = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error), error:
+                raise NagiosPluginError("Unable to map %s: %s" % (self.path, error))
+
+            try:
+                program_start = self._get_program_start(status)
+                blocks = None
+
+                # until nagios restarts the file lists the same services in the same order
+                if offsets != None and offsets['program_start'] == program_start:
+                    blocks = self._find_known_blocks(status, offsets['blocks'])
+
+                if blocks == None:
+                    if verbose:
+                        print "Scanning all of %s" % self.path
+                    blocks = self._scan(status, host_pattern, service_pattern)
+
+                services = [self._decode(status, offset, host, service) for (offset, host, service) in blocks]
+            finally:
+                status.close()
+        finally:
+            file.close()
+
+        if verbose:
+            print "Found %d matching services" % len(services)
+
+        return (services, {'program_start': program_start, 'blocks': blocks})
+
+    def _get_program_start(self, status):
+        "Returns the time nagios started, from the programstatus block near the start of the file"
+        start = status.find('\n\tprogram_start=')
+        if start == -1:
+            return None
+
+        start += len('\n\tprogram_start=')
+        return status[start:status.find('\n', start)]
+
+    def _scan(self, status, host_pattern, service_pattern):
+        "Returns a list of (offset, host, service) tuples for the matching services in the file"
+        blocks = []
+        position = status.find(self.BLOCK_START)
+
+        while position != -1:
+            (host, service, end) = self._read_names(status, position)
+
+            if host_pattern.search(host) and service_pattern.search(service):
+                blocks.append((position, host, service))
+
+            position = status.find(self.BLOCK_START, end)
+
+        return blocks
+
+    def _find_known_blocks(self, status, known_blocks):
+        """
+        Returns a list of (offset, host, service) tuples for the services found by a previous scan, looking for
+        each near its previous offset first. Returns None if any of them can no longer be found.
+        """
+        blocks = []
+
+        for (offset, host, service) in known_blocks:
+            signature = '%s%s%s%s\n' % (self.BLOCK_START, host, self.DESCRIPTION, service)
+
+            position = status.find(signature, max(0, offset - self.SEARCH_WINDOW), offset + self.SEARCH_WINDOW)
+            if position == -1:
+                position = status.find(signature)
+            if position == -1:
+                return None
+
+            blocks.append((position, host, service))
+
+        return blocks
+
+    def _read_names(self, status, position):
+        "Returns the host name and service description of the block at position, and where they end"
+        start = position + len(self.BLOCK_START)
+        end = status.find('\n', start)
+        host = status[start:end]
+
+        start = end + len(self.DESCRIPTION)
+        end = status.find('\n', start)
+        service = status[start:end]
+
+        return (host, service, end)
+
+    def _decode(self, status, position, host, service):
+        "Returns the result of the service whose block starts at position"
+        end = status.find(self.BLOCK_END, position + 1)
+        if end == -1:
+            end = len(status)
+
+        result = {'host': host, 'service': service, 'current_state': 3, 'perfdata': {}}
+
+        for line in status[position:end].split('\n\t'):
+            (name, separator, value) = line.partition('=')
+
+            if name == 'current_state':
+                result['current_state'] = int(value)
+            elif name == 'performance_data':
+                for (label, number) in self.PERFDATA.findall(value):
+                    try:
+                        result['perfdata'][label.strip("'")] = NumberUtils.string_to_number(number)
+                    except ValueError:
+                        pass
+
+        return result
+
+
+if __name__ == '__main__':
+    (status, output) = NagiosAggregate.run(sys.argv[1:])
+    print output
+    sys.exit(status)
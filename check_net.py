@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+import os
+import sys
+from nagiosplugin import *
+
+"""
+Nagios plugin for checking the health of the kernel's network stack: TCP retransmits, listen queue overflows,
+dropped packets, socket counts and connection tracking table usage. Everything is read from the proc
+filesystem, and only the file holding the statistic asked for is read, in a single pass.
+
+Requirements
+=============
+
+This script requires the following python modules:
+
+  * argparse (included with python 2.7, otherwise install with 'easy_install argparse')
+
+Notes
+=====
+
+Statistics are named after the file they're read from:
+
+  * PROTOCOL_NAME - any counter in /proc/net/snmp or /proc/net/netstat, where PROTOCOL is the name at the
+    start of the line, e.g. Tcp_RetransSegs, Tcp_OutSegs, Udp_InErrors, Udp_RcvbufErrors,
+    TcpExt_ListenOverflows, TcpExt_ListenDrops, TcpExt_TCPBacklogDrop or IpExt_InNoRoutes. Most are
+    counters, so use them with --delta-time for rates.
+  * sockstat_PROTOCOL_NAME - any value in /proc/net/sockstat, e.g. sockstat_sockets_used,
+    sockstat_TCP_inuse, sockstat_TCP_tw or sockstat_TCP_orphan
+  * conntrack_count, conntrack_max - entries in the connection tracking table and its size, from
+    /proc/sys/net/netfilter/nf_conntrack_count and nf_conntrack_max
+  * conntrack_used_percentage - conntrack_count as a percentage of conntrack_max. New connections are
+    dropped when the table is full.
+  * tcp_retransmit_percentage - segments retransmitted as a percentage of segments sent since the
+    previous invocation
+
+Expressions of any of these statistics can be checked instead of a single one, e.g.
+'rate(TcpExt_ListenDrops) + rate(TcpExt_ListenOverflows)'.
+"""
+
+
+class Net(NagiosPlugin):
+    """
+    A Nagios plugin to check network stack statistics. Data is returned in perfdata format and is read from
+    the proc filesystem.
+    """
+    VERSION = '0.1'
+    SERVICE = 'Net'
+    AUTHOR = 'Ally B'
+    ## Statistics computed from the change in counters since the previous invocation
+    DERIVED_STATISTICS = {
+        'tcp_retransmit_percentage': 'rate(Tcp_RetransSegs) * 100 / rate(Tcp_OutSegs)',
+    }
+
+    class Defaults(object):
+        proc_path = '/proc'
+        conntrack_path = '/proc/sys/net/netfilter'
+        delta_file_path = '/var/nagios/check_net_plugin_delta'
+        delta_precision = 2
+
+    def parse_args(self, opts):
+        """
+        Parse given options and arguments
+        """
+        parser = self._default_parser(description=self.__doc__, version=self.VERSION, author=self.AUTHOR,
+            delta_file_path=self.Defaults.delta_file_path, delta_precision=self.Defaults.delta_precision)
+
+        parser.add_argument('--proc-path', nargs='?', default=self.Defaults.proc_path,
+            help="Path to the proc filesystem. Default is %s" % self.Defaults.proc_path)
+        parser.add_argument('--conntrack-path', nargs='?', default=self.Defaults.conntrack_path,
+            help="""Path to the directory containing nf_conntrack_count and nf_conntrack_max.
+            Default is %s""" % self.Defaults.conntrack_path)
+        parser.add_argument('-s', '--statistic', nargs='?', required=True,
+            help="""The statistic to check, e.g. TcpExt_ListenOverflows, Tcp_RetransSegs, sockstat_TCP_tw,
+            conntrack_used_percentage or tcp_retransmit_percentage, or an expression of statistics.""")
+
+        args = parser.parse_args(opts)
+        if 'verbose' not in args:
+            args.verbose = False
+        else:
+            args.verbose = True
+
+        return args
+
+    def _get_statistic_retriever(self):
+        "Creates the object used to read statistics, if it hasn't been already"
+        if not hasattr(self, 'net_statistic'):
+            self.net_statistic = NetStatistic(self.args.proc_path, self.args.conntrack_path)
+
+    def _get_statistic(self, statistic):
+        "Returns the value of a statistic"
+        self._get_statistic_retriever()
+
+        if statistic in self.DERIVED_STATISTICS:
+            if hasattr(self.args, 'delta_time'):
+                raise InvalidParameterError("%s is already derived from rates, so can't be used with --delta-time." %
+                    statistic)
+
+            return self._evaluate_expression(StatisticExpression.parse(self.DERIVED_STATISTICS[statistic]),
+                self.net_statistic.get_stats('Tcp_'))
+
+        return self.net_statistic.get_statistic(statistic, self.args.verbose)
+
+    def _get_snapshot(self):
+        "Returns every statistic, for evaluating expressions"
+        self._get_statistic_retriever()
+        return self.net_statistic.get_all_stats()
+
+    def check(self):
+        "Reads the required statistic, and finds out which status it corresponds to."
+        self.statistic = self.args.statistic
+
+        if StatisticExpression.is_expression(self.statistic):
+            self.statistic_value = self._get_expression_value(self.statistic)
+        else:
+            self.statistic_value = self._get_statistic(self.statistic)
+
+        if hasattr(self.args, 'delta_time'):
+            self.statistic_value = self._get_delta(self.statistic, self.statistic_value)
+            self.statistic += '_per_second'
+
+        self.status = self._calculate_status(self.statistic_value)
+
+
+class NetStatistic(object):
+    "Returns network stack statistics from the proc filesystem"
+
+    SOCKSTAT_PREFIX = 'sockstat_'
+    CONNTRACK_PREFIX = 'conntrack_'
+    ## Protocols whose counters are in /proc/net/snmp. Counters of any other protocol are in /proc/net/netstat.
+    SNMP_PROTOCOLS = ('Ip', 'Icmp', 'IcmpMsg', 'Tcp', 'Udp', 'UdpLite')
+
+    def __init__(self, proc_path, conntrack_path):
+        """
+        @param proc_path Path to the proc filesystem
+        @param conntrack_path Path to the directory containing nf_conntrack_count and nf_conntrack_max
+        """
+        self.proc_path = proc_path
+        self.conntrack_path = conntrack_path
+
+    def get_stats(self, statistic):
+        "Returns a dictionary of the statistics in the file the given statistic is read from"
+        if statistic.startswith(self.SOCKSTAT_PREFIX):
+            return self.get_sockstat_stats()
+        elif statistic.startswith(self.CONNTRACK_PREFIX):
+            return self.get_conntrack_stats()
+        elif statistic.partition('_')[0] in self.SNMP_PROTOCOLS:
+            return self.get_counter_stats('snmp')
+        else:
+            return self.get_counter_stats('netstat')
+
+    def get_all_stats(self):
+        """
+        Returns a dictionary of every statistic. Connection tracking statistics are left out when the
+        nf_conntrack module isn't loaded.
+        """
+        stats = self.get_counter_stats('snmp')
+        stats.update(self.get_counter_stats('netstat'))
+        stats.update(self.get_sockstat_stats())
+
+        path = os.path.join(self.conntrack_path, 'nf_conntrack_count')
+        if recorder.fetch('exists %s' % path, lambda: os.path.exists(path)):
+            stats.update(self.get_conntrack_stats())
+
+        return stats
+
+    def get_statistic(self, statistic, verbose=False):
+        """
+        Returns a statistic value.
+
+        @param statistic The name of the statistic to retrieve
+        @param vebose Whether to display verbose output
+        """
+        stats = self.get_stats(statistic)
+
+        if verbose:
+            print "Read: %s" % stats
+
+        if statistic not in stats:
+            raise InvalidStatisticError("%s is not a valid statistic name." % statistic)
+
+        return stats[statistic]
+
+    def get_counter_stats(self, filename):
+        """
+        Returns a dictionary of the counters in /proc/net/snmp or /proc/net/netstat, named PROTOCOL_NAME.
+        Each protocol has a line of names followed by a line of values, e.g.
+
+          Tcp: RtoAlgorithm RtoMin RtoMax MaxConn ActiveOpens ...
+          Tcp: 1 200 120000 -1 53829 ...
+        """
+        stats = {}
+        lines = read_file(os.path.join(self.proc_path, 'net', filename)).splitlines()
+
+        for (names, values) in zip(lines[0::2], lines[1::2]):
+            names = names.split()
+            values = values.split()
+            protocol = names[0].rstrip(':')
+
+            for (name, value) in zip(names[1:], values[1:]):
+                stats['%s_%s' % (protocol, name)] = int(value)
+
+        return stats
+
+    def get_sockstat_stats(self):
+        """
+        Returns a dictionary of the values in /proc/net/sockstat, named sockstat_PROTOCOL_NAME. Lines look like:
+
+          sockets: used 291
+          TCP: inuse 11 orphan 0 tw 2 alloc 14 mem 3
+        """
+        stats = {}
+
+        for line in read_file(os.path.join(self.proc_path, 'net', 'sockstat')).splitlines():
+            fields = line.split()
+            protocol = fields[0].rstrip(':')
+
+            for (name, value) in zip(fields[1::2], fields[2::2]):
+                stats['%s%s_%s' % (self.SOCKSTAT_PREFIX, protocol, name)] = int(value)
+
+        return stats
+
+    def get_conntrack_stats(self):
+        "Returns a dictionary of the size and usage of the connection tracking table"
+        count = int(read_file(os.path.join(self.conntrack_path, 'nf_conntrack_count')))
+        maximum = int(read_file(os.path.join(self.conntrack_path, 'nf_conntrack_max')))
+
+        stats = {
+            'conntrack_count': count,
+            'conntrack_max': maximum,
+            'conntrack_used_percentage': 0,
+        }
+
+        if maximum:
+            stats['conntrack_used_percentage'] = round(count * 100.0 / maximum, 2)
+
+        return stats
+
+
+if __name__ == '__main__':
+    (status, output) = Net.run(sys.argv[1:])
+    print output
+    sys.exit(status)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+import os
+import re
+import errno
+import sys
+import pwd
+import textwrap
+from nagiosplugin import *
+
+"""
+Nagios plugin for counting processes and checking their threads and open file descriptors. Processes are
+found by scanning /proc once, without running `ps`, so it stays cheap on hosts with tens of thousands of
+processes and threads.
+
+Each process's stat file is always read, which gives its command name, state and thread count. Other files
+are only read when they're needed: status for --user, cmdline for --args, and the fd directory and limits
+file for the fd statistics. Processes that exit during the scan are skipped.
+
+Requirements
+=============
+
+This script requires the following python modules:
+
+  * argparse (included with python 2.7, otherwise install with 'easy_install argparse')
+
+Notes
+=====
+
+Processes can be selected by --command, --args, --user and --state. Every condition given must match.
+Statistics are:
+
+  * count - matching processes
+  * threads - threads of matching processes
+  * threads_max - the most threads of any one matching process
+  * threads_used_percentage - threads of matching processes as a percentage of the kernel's limit on
+    threads, /proc/sys/kernel/threads-max
+  * fds_max - the most file descriptors open in any one matching process
+  * fd_used_percentage - the highest percentage of its limit on open files that any one matching process
+    is using. Only root can see the file descriptors of other users' processes. If any matching process's
+    can't be read the status is UNKNOWN, since the process left out could be the worst.
+
+The number of matching processes in each state is added to the perfdata, so zombie and uninterruptible (D)
+processes can be graphed alongside the statistic. For example, to alert on zombies:
+
+  check_procs.py --state Z -s count -w 5 -c 50
+"""
+
+
+class Procs(NagiosPlugin):
+    """
+    A Nagios plugin to count processes and check their threads and open file descriptors. Data is returned
+    in perfdata format and is read from the proc filesystem.
+    """
+    VERSION = '0.1'
+    SERVICE = 'Procs'
+    AUTHOR = 'Ally B'
+
+    class Defaults(object):
+        proc_path = '/proc'
+        delta_file_path = '/var/nagios/check_procs_plugin_delta'
+        delta_precision = 2
+
+    def parse_args(self, opts):
+        """
+        Parse given options and arguments
+        """
+        parser = self._default_parser(description=self.__doc__, version=self.VERSION, author=self.AUTHOR,
+            delta_file_path=self.Defaults.delta_file_path, delta_precision=self.Defaults.delta_precision)
+
+        parser.add_argument('--proc-path', nargs='?', default=self.Defaults.proc_path,
+            help="Path to the proc filesystem. Default is %s" % self.Defaults.proc_path)
+        parser.add_argument('--command', action='append',
+            help="Command name to match exactly, as shown by `ps -e`. Can be given more than once.")
+        parser.add_argument('--args', nargs='?',
+            help="Regular expression to search for in the command line of processes.")
+        parser.add_argument('--user', action='append',
+            help="Name or ID of the user processes run as. Can be given more than once.")
+        parser.add_argument('--state', action='append',
+            help="""State of processes to match, e.g. Z for zombies or D for uninterruptible sleep.
+            Can be given more than once.""")
+        parser.add_argument('-s', '--statistic', help=textwrap.dedent("""
+        The statistic to check. Possible values are:
+
+            count,
+            threads,
+            threads_max,
+            threads_used_percentage,
+            fds_max,
+            fd_used_percentage
+            """), nargs='?', required=True)
+
+        args = parser.parse_args(opts)
+        if 'verbose' not in args:
+            args.verbose = False
+        else:
+            args.verbose = True
+
+        return args
+
+    def _get_uids(self):
+        "Returns a set of the user IDs given by --user, or None if it wasn't given"
+        if self.args.user == None:
+            return None
+
+        uids = set()
+
+        for user in self.args.user:
+            if user.isdigit():
+                uids.add(int(user))
+                continue
+
+            try:
+                uids.add(pwd.getpwnam(user).pw_uid)
+            except KeyError:
+                raise InvalidParameterError("There is no user called '%s'." % user)
+
+        return uids
+
+    def _get_statistic(self, statistic):
+        "Scans processes and returns the statistic, adding the number of processes in each state to the perfdata"
+        if statistic not in ProcessScanner.STATISTICS:
+            raise InvalidStatisticError("%s is not a valid statistic name." % statistic)
+
+        args_pattern = None
+        if self.args.args != None:
+            try:
+                args_pattern = re.compile(self.args.args)
+            except re.error, error:
+                raise InvalidParameterError("Invalid regular expression for --args: %s" % error)
+
+        scanner = ProcessScanner(self.args.proc_path, self.args.command, args_pattern, self._get_uids(),
+            self.args.state)
+        # the scan reads files of every process, so only its result is recorded
+        (stats, states, worst) = recorder.fetch('processes %s %s' % (self.args.proc_path, statistic),
+            lambda: scanner.scan(read_fds=statistic.startswith('fd'), read_limits=(statistic == 'fd_used_percentage'),
+                verbose=self.args.verbose))
+        self.unreadable_fds = stats['fds_unreadable']
+
+        if statistic == 'threads_used_percentage':
+            threads_limit = scanner.get_threads_limit()
+            stats[statistic] = 0
+            if threads_limit:
+                stats[statistic] = round(stats['threads'] * 100.0 / threads_limit, 2)
+
+        self.worst_process = worst.get(statistic)
+        self.additional_perfdata = [('processes_%s' % ProcessScanner.STATES.get(state, state), count)
+            for (state, count) in sorted(states.items())]
+        if self.unreadable_fds:
+            self.additional_perfdata.append(('processes_fds_unreadable', self.unreadable_fds))
+
+        return stats[statistic]
+
+    def check(self):
+        "Scans processes, and finds out which status the statistic corresponds to."
+        self.statistic = self.args.statistic
+        self.worst_process = None
+        self.unreadable_fds = 0
+        self.statistic_value = self._get_statistic(self.statistic)
+
+        if hasattr(self.args, 'delta_time'):
+            self.statistic_value = self._get_delta(self.statistic, self.statistic_value)
+            self.statistic += '_per_second'
+
+        self.status = self._calculate_status(self.statistic_value)
+
+        # the processes whose file descriptors couldn't be counted may be the ones over the thresholds
+        if self.unreadable_fds:
+            self.status = self.STATUS_UNKNOWN
+
+    def get_output(self):
+        """
+        Returns an output string for nagios, naming the process with the largest value of per-process statistics
+        and saying how many processes' file descriptors couldn't be read
+        """
+        (summary, separator, perfdata) = NagiosPlugin.get_output(self).partition(' | ')
+
+        if self.worst_process != None:
+            summary += " in process %d (%s)" % self.worst_process
+
+        if self.unreadable_fds:
+            summary += ". Unable to read the file descriptors of %d matching processes" % self.unreadable_fds
+
+        return summary + separator + perfdata
+
+
+class ProcessScanner(object):
+    "Counts processes matching conditions and measures their threads and file descriptors, from the proc filesystem"
+
+    STATISTICS = ('count', 'threads', 'threads_max', 'threads_used_percentage', 'fds_max', 'fd_used_percentage')
+    ## Names of process states used in perfdata labels
+    STATES = {'R': 'running', 'S': 'sleeping', 'D': 'uninterruptible', 'Z': 'zombie', 'T': 'stopped',
+        't': 'tracing_stop', 'X': 'dead', 'I': 'idle', 'P': 'parked', 'W': 'paging'}
+    ## Index of the number of threads in /proc/PID/stat, counting from the state after the command name
+    STAT_THREADS_FIELD = 17
+
+    def __init__(self, path, commands=None, args_pattern=None, uids=None, states=None):
+        """
+        @param path Path to the proc filesystem
+        @param commands Command names to match, or None for any
+        @param args_pattern Compiled regular expression to search command lines for, or None for any
+        @param uids Set of effective user IDs to match, or None for any
+        @param states Process states to match, or None for any
+        """
+        self.path = path
+        self.commands = commands
+        self.args_pattern = args_pattern
+        self.uids = uids
+        self.states = states
+
+    def scan(self, read_fds=False, read_limits=False, verbose=False):
+        """
+        Scans every process. Returns a tuple of a dictionary of statistics, a dictionary of the number of
+        matching processes in each state, and a dictionary of (pid, command) tuples of the process with the
+        largest value of each per-process statistic.
+
+        Matching processes whose file descriptors or limits we may not read are still counted, and the
+        number of them is returned as the fds_unreadable statistic.
+
+        @param read_fds Whether to count each matching process's open file descriptors
+        @param read_limits Whether to read each matching process's limit on open files
+        @param vebose Whether to display verbose output
+        """
+        try:
+            # python 2 has no os.scandir, but listing the directory alone doesn't stat each entry either
+            pids = [int(name) for name in os.listdir(self.path) if name.isdigit()]
+        except OSError, error:
+            raise NagiosPluginError("Unable to list processes in %s: %s" % (self.path, error))
+
+        stats = {'count': 0, 'threads': 0, 'threads_max': 0, 'fds_max': 0, 'fd_used_percentage': 0,
+            'fds_unreadable': 0}
+        states = {}
+        worst = {}
+        own_pid = os.getpid()
+
+        for pid in pids:
+            if pid == own_pid:
+                continue
+
+            try:
+                (command, state, threads) = self._read_stat(pid)
+
+                if not self._matches(pid, command, state):
+                    continue
+            except (IOError, OSError):
+                # processes may exit during the scan
+                continue
+
+            fds = fd_used_percentage = 0
+            try:
+                if read_fds:
+                    fds = self._count_fds(pid)
+                if read_limits:
+                    fd_limit = self._read_fd_limit(pid)
+                    if fd_limit:
+                        fd_used_percentage = round(fds * 100.0 / fd_limit, 2)
+            except (IOError, OSError), error:
+                # only root can see other users' file descriptors, but the process still counts
+                if error.errno != errno.EACCES:
+                    continue
+                stats['fds_unreadable'] += 1
+
+            stats['count'] += 1
+            stats['threads'] += threads
+            states[state] = states.get(state, 0) + 1
+
+            for (name, value) in (('threads_max', threads), ('fds_max', fds), ('fd_used_percentage', fd_used_percentage)):
+                if value > stats[name]:
+                    stats[name] = value
+                    worst[name] = (pid, command)
+
+        if verbose:
+            print "Scanned %d processes in %s, %d matched: %s" % (len(pids), self.path, stats['count'], stats)
+
+        return (stats, states, worst)
+
+    def get_threads_limit(self):
+        "Returns the kernel's limit on the number of threads"
+        return int(read_file('%s/sys/kernel/threads-max' % self.path))
+
+    def _matches(self, pid, command, state):
+        "Returns whether a process matches every condition, reading its status and cmdline only when needed"
+        if self.commands != None and command not in self.commands:
+            return False
+        if self.states != None and state not in self.states:
+            return False
+        if self.uids != None and self._read_uid(pid) not in self.uids:
+            return False
+        if self.args_pattern != None and not self.args_pattern.search(self._read_cmdline(pid)):
+            return False
+
+        return True
+
+    def _read_stat(self, pid):
+        "Returns a tuple of the command name, state and number of threads of a process, from /proc/PID/stat"
+        file = open('%s/%d/stat' % (self.path, pid), 'r')
+        try:
+            stat = file.read()
+        finally:
+            file.close()
+
+        # the command name is in brackets and may itself contain spaces and brackets
+        end = stat.rfind(')')
+        command = stat[stat.find('(') + 1:end]
+        fields = stat[end + 2:].split()
+
+        return (command, fields[0], int(fields[self.STAT_THREADS_FIELD]))
+
+    def _read_uid(self, pid):
+        "Returns the effective user ID of a process, from /proc/PID/status"
+        file = open('%s/%d/status' % (self.path, pid), 'r')
+        try:
+            for line in file:
+                if line.startswith('Uid:'):
+                    return int(line.split()[2])
+        finally:
+            file.close()
+
+        return None
+
+    def _read_cmdline(self, pid):
+        "Returns the command line of a process with its arguments separated by spaces"
+        file = open('%s/%d/cmdline' % (self.path, pid), 'r')
+        try:
+            return file.read().rstrip('\0').replace('\0', ' ')
+        finally:
+            file.close()
+
+    def _count_fds(self, pid):
+        "Returns the number of file descriptors a process has open, from /proc/PID/fd"
+        return len(os.listdir('%s/%d/fd' % (self.path, pid)))
+
+    def _read_fd_limit(self, pid):
+        "Returns the soft limit on the number of files a process may open, or None if it's unlimited"
+        file = open('%s/%d/limits' % (self.path, pid), 'r')
+        try:
+            for line in file:
+                # lines look like: Max open files            1024                 1048576              files
+                if line.startswith('Max open files'):
+                    limit = line[len('Max open files'):].split()[0]
+                    if limit.isdigit():
+                        return int(limit)
+        finally:
+            file.close()
+
+        return None
+
+
+if __name__ == '__main__':
+    (status, output) = Procs.run(sys.argv[1:])
+    print output
+    sys.exit(status)
@@ -1,13 +1,76 @@
 #!/usr/bin/env python
+import os
+import re
 import sys
+import errno
+import heapq
 import textwrap
 import subprocess
-import os.path
 from nagiosplugin import *
 
 """
 Nagios plugin for checking free RAM. Returns detailed statistics for use by perfdata visualisation tools.
-Stats are returned by parsing the output of `free`
+Stats are returned by parsing the output of `free`, or by reading /proc/meminfo directly when --meminfo
+is given, which avoids running any other processes.
+
+Statistics beginning 'process_' report the memory used by individual processes, found by scanning /proc:
+
+  * process_max_rss, process_max_pss, process_max_swap - the largest value for any single process, in kB
+  * process_total_rss, process_total_pss, process_total_swap - the sum over all processes, in kB
+
+The processes and commands using the most memory are added to the perfdata, so alerts show what owns it.
+RSS is read from /proc/PID/stat alone. PSS and swap need /proc/PID/smaps_rollup, which is slower for the
+kernel to produce and only readable for other users' processes by root. Where it can't be read, RSS from
+/proc/PID/statm is used for PSS and swap is counted as 0.
+
+Statistics beginning 'cgroup_' report the memory of a cgroup v2 group, which inside a container is the
+container's memory rather than the host's. By default the group this script runs in is checked:
+
+  * cgroup_current, cgroup_max, cgroup_high, cgroup_swap_current - from memory.current, memory.max,
+    memory.high and memory.swap.current, in bytes. Limits of 'max' are reported as 0.
+  * cgroup_usage_percentage - memory.current as a percentage of memory.max, or 0 without a limit
+  * cgroup_stat_NAME - any value in memory.stat, e.g. cgroup_stat_anon or cgroup_stat_file
+  * cgroup_events_NAME - the event counters in memory.events, e.g. cgroup_events_oom_kill. Use with
+    --delta-time for rates.
+  * cgroup_pressure_some_avg10, cgroup_pressure_full_avg60, etc. - pressure stall information from
+    memory.pressure. cgroup_pressure_some_total and cgroup_pressure_full_total are microseconds stalled.
+
+With --cgroup-walk every group below the one given is checked in one invocation, and the group whose value
+is worst compared to the thresholds is reported.
+
+Statistics beginning 'numa_' are measured for each NUMA node, and the node whose value is worst compared to
+the thresholds is reported, so exhaustion of a single node isn't hidden by free memory on the others:
+
+  * numa_total, numa_free, numa_used - from the node's meminfo, in kB
+  * numa_free_percentage, numa_used_percentage - free and used memory as a percentage of the node's total
+  * numa_hit, numa_miss, numa_foreign, numa_interleave_hit, numa_local_node, numa_other_node - the
+    allocation counters in the node's numastat. Use with --delta-time for rates.
+
+Memory that is free but fragmented can't satisfy allocations of large contiguous blocks, such as
+transparent huge pages, and makes the kernel stall allocations while it compacts memory. Statistics
+beginning 'fragmentation_' are read from /proc/buddyinfo for blocks of at least --order:
+
+  * fragmentation_free_kb - all free memory, in kB
+  * fragmentation_free_kb_at_order - free memory in blocks of at least --order, in kB
+  * fragmentation_unusable_index - the percentage of free memory in blocks too small for --order.
+    Each zone's index is added to the perfdata.
+  * fragmentation_free_kb_at_order_TYPE - free memory in blocks of at least --order for one migrate type,
+    e.g. fragmentation_free_kb_at_order_movable. Read from /proc/pagetypeinfo, which only root can read.
+
+Huge pages and the kernel's counters are available as:
+
+  * hugepages_total, hugepages_free, hugepages_reserved, hugepages_surplus - HugePages_ values from
+    /proc/meminfo, in pages
+  * hugepages_available - free huge pages not reserved for mappings
+  * hugepages_size_kb, hugepages_anon_kb, hugepages_shmem_kb - Hugepagesize, AnonHugePages and
+    ShmemHugePages from /proc/meminfo
+  * vmstat_NAME - any counter in /proc/vmstat, e.g. vmstat_compact_stall, vmstat_thp_fault_fallback.
+    Use with --delta-time for rates.
+
+Expressions of the statistics read from meminfo and the vmstat_ statistics can be checked instead of a
+single statistic, e.g. 'used_less_buffers * 100 / total', or
+'rate(vmstat_thp_fault_fallback) * 100 / rate(vmstat_thp_fault_alloc)'. Functions rate() and delta() give
+a statistic's change per second and change since the previous invocation.
 
 Requirements
 =============
@@ -25,6 +88,8 @@ class RAM(NagiosPlugin):
     VERSION = '0.1'
     SERVICE = 'RAM'
     AUTHOR = 'Ally B'
+    ## Statistics of several instances whose smallest value is the worst
+    LOWER_IS_WORSE = ('numa_free', 'numa_free_percentage')
 
     class Defaults(object):
         timeout = 3
@@ -32,17 +97,21 @@ class RAM(NagiosPlugin):
         tail_path = 'tail'
         head_path = 'head'
         awk_path = 'awk'
-
-    def __init__(self, opts):
-        self.status = self.STATUS_UNKNOWN
-        self.args = self.parse_args(opts)
-        self.set_thresholds(self.args.warning, self.args.critical, self.args.time_periods)
+        meminfo_path = '/proc/meminfo'
+        proc_path = '/proc'
+        top = 5
+        cgroup_root = '/sys/fs/cgroup'
+        numa_path = '/sys/devices/system/node'
+        order = 9
+        delta_file_path = '/var/nagios/check_ram_plugin_delta'
+        delta_precision = 2
 
     def parse_args(self, opts):
         """
         Parse given options and arguments
         """
-        parser = self._default_parser(description=self.__doc__, version=self.VERSION, author=self.AUTHOR)
+        parser = self._default_parser(description=self.__doc__, version=self.VERSION, author=self.AUTHOR,
+            delta_file_path=self.Defaults.delta_file_path, delta_precision=self.Defaults.delta_precision)
 
         parser.epilog="""Data is gathered by parsing the output of `free`. For more information on what the figures
             actually represent, read the `man` page for `free`."""
@@ -55,6 +124,27 @@ class RAM(NagiosPlugin):
             the path.""", default=self.Defaults.head_path)
         parser.add_argument('--awk-path', nargs='?', help="""Path to `awk` binary. Default is to search
             the path.""", default=self.Defaults.awk_path)
+        parser.add_argument('--meminfo', nargs='?', const=self.Defaults.meminfo_path, default=argparse.SUPPRESS,
+            help="""Read statistics from /proc/meminfo, or the given file in the same format, instead of running
+            `free`. Values are the same as those `free` reports.""")
+        parser.add_argument('--proc-path', nargs='?', default=self.Defaults.proc_path,
+            help="Path to the proc filesystem scanned for process_ statistics. Default is %s" % self.Defaults.proc_path)
+        parser.add_argument('--top', nargs='?', type=int, default=self.Defaults.top,
+            help="""Number of processes and commands to add to the perfdata for process_ statistics.
+            Default is %d.""" % self.Defaults.top)
+        parser.add_argument('--cgroup', nargs='?', default=argparse.SUPPRESS,
+            help="""The cgroup v2 group to check for cgroup_ statistics, relative to the cgroup root. Default is
+            the group this script runs in.""")
+        parser.add_argument('--cgroup-root', nargs='?', default=self.Defaults.cgroup_root,
+            help="Path the cgroup v2 hierarchy is mounted at. Default is %s" % self.Defaults.cgroup_root)
+        parser.add_argument('--cgroup-walk', nargs='?', default=argparse.SUPPRESS,
+            help="""Check every group below the cgroup and report the worst. The --top groups with the largest
+            values are added to the perfdata.""")
+        parser.add_argument('--numa-path', nargs='?', default=self.Defaults.numa_path,
+            help="Path to the NUMA node directories for numa_ statistics. Default is %s" % self.Defaults.numa_path)
+        parser.add_argument('--order', nargs='?', type=int, default=self.Defaults.order,
+            help="""Smallest order of free blocks, i.e. blocks of 2^order pages, that fragmentation_ statistics
+            treat as usable. Default is %d, the size of a transparent huge page with 4kB pages.""" % self.Defaults.order)
         parser.add_argument('-s', '--statistic', help=textwrap.dedent("""
         The statistic to check. Possible values are:
 
@@ -68,7 +158,15 @@ class RAM(NagiosPlugin):
             free_plus_cache,
             swap_total,
             swap_used,
-            swap_free
+            swap_free,
+            process_max_rss,
+            process_max_pss,
+            process_max_swap,
+            process_total_rss,
+            process_total_pss,
+            process_total_swap,
+            or one of the cgroup_, numa_, fragmentation_, hugepages_ or vmstat_ statistics listed in the notes at the top of this script,
+            or an expression of the meminfo and vmstat_ statistics, e.g. 'used_less_buffers * 100 / total'
             """), nargs='?', required=True)
 
         args = parser.parse_args(opts)
@@ -81,6 +179,28 @@ class RAM(NagiosPlugin):
 
     def _get_statistic(self, statistic):
         "Returns a tuple containing the name of the specified statistic and its value."
+        if statistic.startswith(ProcessMemoryStatistic.PREFIX):
+            return self._get_process_statistic(statistic)
+
+        if statistic.startswith(CgroupMemoryStatistic.PREFIX):
+            return self._get_cgroup_statistic(statistic)
+
+        if statistic.startswith(NumaMemoryStatistic.PREFIX):
+            return self._get_numa_statistic(statistic)
+
+        if statistic.startswith(KernelMemoryStatistic.PREFIXES):
+            retriever = KernelMemoryStatistic(self.args.proc_path, self.args.order)
+            value = retriever.get_statistic(statistic, self.args.verbose)
+
+            if statistic == KernelMemoryStatistic.UNUSABLE_INDEX:
+                self.additional_perfdata = [('%s_%s_unusable_index' % zone, index)
+                    for (zone, index) in sorted(retriever.get_zone_unusable_indexes().items())]
+
+            return value
+
+        if not hasattr(self, 'statistic_retriever') and hasattr(self.args, 'meminfo'):
+            self.statistic_retriever = MemInfoStatistic(self.args.meminfo)
+
         if not hasattr(self, 'statistic_retriever'):
             try:
                 self.statistic_retriever = RAMStatistic(free_path = self.args.free_path,
@@ -91,10 +211,115 @@ class RAM(NagiosPlugin):
 
         return self.statistic_retriever.get_statistic(statistic, self.args.verbose)
 
+    def _get_snapshot(self):
+        """
+        Returns the statistics read from meminfo and vmstat, for evaluating expressions. Expressions always read
+        meminfo directly rather than running `free`.
+        """
+        meminfo_path = getattr(self.args, 'meminfo', os.path.join(self.args.proc_path, 'meminfo'))
+        stats = MemInfoStatistic(meminfo_path).get_stats(self.args.verbose)
+        stats.update(KernelMemoryStatistic(self.args.proc_path, self.args.order).get_stats('vmstat_'))
+
+        return stats
+
+    def _get_process_statistic(self, statistic):
+        "Returns a process_ statistic, adding the processes and commands using the most memory to the perfdata"
+        (kind, separator, metric) = statistic[len(ProcessMemoryStatistic.PREFIX):].partition('_')
+
+        if kind not in ('max', 'total') or metric not in ProcessMemoryStatistic.METRICS:
+            raise InvalidStatisticError("%s is not a valid statistic name." % statistic)
+
+        retriever = ProcessMemoryStatistic(self.args.proc_path)
+        # the scan reads files of every process, so only its result is recorded
+        (top, commands, total) = recorder.fetch('processes %s %s' % (self.args.proc_path, metric),
+            lambda: retriever.scan(metric, self.args.top, self.args.verbose))
+
+        self.additional_perfdata = [('%s_%d_%s' % (retriever.label(command), pid, metric), value)
+            for (value, pid, command) in top]
+        self.additional_perfdata += [('command_%s_%s' % (retriever.label(command), metric), value)
+            for (command, value) in heapq.nlargest(self.args.top, commands.iteritems(), key=lambda item: item[1])]
+
+        if kind == 'total':
+            return total
+
+        if top:
+            return top[0][0]
+
+        return 0
+
+    def _get_cgroup_statistic(self, statistic):
+        """
+        Returns a cgroup_ statistic for the group given by --cgroup, or the worst value of any group below it
+        when --cgroup-walk is given. Deltas are stored for each group separately.
+        """
+        if hasattr(self.args, 'cgroup'):
+            group = self.args.cgroup
+        else:
+            group = CgroupMemoryStatistic.get_own_group()
+
+        retriever = CgroupMemoryStatistic(self.args.cgroup_root, group)
+
+        if hasattr(self.args, 'cgroup_walk'):
+            cgroups = retriever.walk()
+        else:
+            cgroups = [retriever]
+
+        values = dict((cgroup.group, cgroup.get_statistic(statistic, self.args.verbose)) for cgroup in cgroups)
+
+        return self._get_worst_instance(statistic, values, hasattr(self.args, 'cgroup_walk'))
+
+    def _get_numa_statistic(self, statistic):
+        "Returns the worst value of a numa_ statistic over all NUMA nodes"
+        retriever = NumaMemoryStatistic(self.args.numa_path)
+        values = dict(('node%d' % node, value) for (node, value) in
+            retriever.get_statistic(statistic, self.args.verbose).items())
+
+        return self._get_worst_instance(statistic, values, True)
+
+    def _get_worst_instance(self, statistic, values, add_perfdata):
+        """
+        Returns the worst value of a statistic measured for several instances, such as cgroups or NUMA nodes.
+        Deltas are stored for each instance separately.
+
+        @param statistic The name of the statistic
+        @param values A dictionary of the statistic's value for each instance
+        @param add_perfdata Whether to add the --top instances with the largest values to the perfdata
+        """
+        if hasattr(self.args, 'delta_time'):
+            for (instance, value) in values.items():
+                values[instance] = self._get_delta('%s:%s' % (instance, statistic), value, persist=False)
+            self._forget_missing_instances(statistic, values)
+            self._persist_statistics()
+
+        (worst_instance, value) = self._get_worst_value(values,
+            statistic in self.LOWER_IS_WORSE and not hasattr(self.args, 'delta_time'))
+
+        if self.args.verbose:
+            print "Worst value was %s for %s" % (value, worst_instance)
+
+        if add_perfdata:
+            largest = heapq.nlargest(self.args.top, values.iteritems(), key=lambda item: item[1])
+            self.additional_perfdata = [('%s:%s' % (name, self.statistic), largest_value)
+                for (name, largest_value) in largest]
+
+        return value
+
     def check(self):
         "Retrieves the required statistic value from the server, and finds out which status it corresponds to."
         self.statistic = self.args.statistic
-        self.statistic_value = self._get_statistic(self.statistic)
+
+        if hasattr(self.args, 'delta_time'):
+            self.statistic += '_per_second'
+
+        if StatisticExpression.is_expression(self.args.statistic):
+            self.statistic_value = self._get_expression_value(self.args.statistic)
+        else:
+            self.statistic_value = self._get_statistic(self.args.statistic)
+
+        # cgroup and NUMA statistics are delta'd per group or node as they're read, and expressions can't be
+        if hasattr(self.args, 'delta_time') and StatisticExpression.NAME.match(self.args.statistic) and \
+                not self.args.statistic.startswith((CgroupMemoryStatistic.PREFIX, NumaMemoryStatistic.PREFIX)):
+            self.statistic_value = self._get_delta(self.args.statistic, self.statistic_value)
 
         if self.args.verbose:
             print self.thresholds
@@ -152,7 +377,8 @@ class RAMStatistic(object):
         if verbose:
             print "Executing command: %s" % command
 
-        stats = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True).stdout.read().strip()
+        stats = recorder.fetch('command %s' % command,
+            lambda: subprocess.Popen(command, stdout=subprocess.PIPE, shell=True).stdout.read()).strip()
 
         if verbose:
             print "Stats command returned '%s'" % stats
@@ -160,17 +386,551 @@ class RAMStatistic(object):
         return stats
 
 
+class MemInfoStatistic(object):
+    "Returns RAM usage by reading /proc/meminfo. Statistics match those derived from the output of `free`."
+
+    def __init__(self, path):
+        """
+        @param path Path to the meminfo file
+        """
+        self.path = path
+
+    def get_meminfo(self):
+        "Returns a dictionary of the values in the meminfo file, in kB"
+        meminfo = {}
+
+        for line in read_file(self.path).splitlines():
+            (name, separator, value) = line.partition(':')
+            fields = value.split()
+            if fields:
+                meminfo[name] = int(fields[0])
+
+        return meminfo
+
+    def get_statistic(self, statistic, verbose=False):
+        """
+        Returns a statistic value.
+
+        @param statistic The name of the statistic to retrieve
+        @param vebose Whether to display verbose output
+        """
+        if not statistic in RAMStatistic.valid_stats:
+            raise InvalidStatisticError("%s is not a valid statistic name." % statistic)
+
+        stats = self.get_stats(verbose)
+
+        return str(stats[statistic])
+
+    def get_stats(self, verbose=False):
+        """
+        Returns a dictionary of all statistics
+
+        @param vebose Whether to display verbose output
+        """
+        meminfo = self.get_meminfo()
+
+        if verbose:
+            print "Read from %s: %s" % (self.path, meminfo)
+
+        try:
+            used = meminfo['MemTotal'] - meminfo['MemFree']
+            buffers_and_cache = meminfo['Buffers'] + meminfo['Cached']
+
+            stats = {
+                'total': meminfo['MemTotal'],
+                'used': used,
+                'free': meminfo['MemFree'],
+                'shared': meminfo.get('Shmem', 0),
+                'buffers': meminfo['Buffers'],
+                'cached': meminfo['Cached'],
+                'used_less_buffers': used - buffers_and_cache,
+                'free_plus_cache': meminfo['MemFree'] + buffers_and_cache,
+                'swap_total': meminfo['SwapTotal'],
+                'swap_used': meminfo['SwapTotal'] - meminfo['SwapFree'],
+                'swap_free': meminfo['SwapFree'],
+            }
+        except KeyError, error:
+            raise UnexpectedResponseError("%s is missing the value %s" % (self.path, error))
+
+        return stats
+
+
+class ProcessMemoryStatistic(object):
+    "Returns the memory used by each process, read from the proc filesystem"
+
+    PREFIX = 'process_'
+    METRICS = ('rss', 'pss', 'swap')
+    ## Lines in smaps_rollup holding each metric
+    SMAPS_FIELDS = {'Rss:': 'rss', 'Pss:': 'pss', 'Swap:': 'swap'}
+    ## Index of the RSS field in /proc/PID/stat, counting from the field after the command name
+    STAT_RSS_FIELD = 21
+
+    def __init__(self, path):
+        """
+        @param path Path to the proc filesystem
+        """
+        self.path = path
+        self.page_size_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+
+    def scan(self, metric, top, verbose=False):
+        """
+        Scans every process. Returns a tuple of a list of (value, pid, command) tuples for the top processes,
+        largest first, a dictionary of the value summed for each command, and the value summed over all
+        processes. Values are in kB. Processes using none of the metric are left out.
+
+        Only the top processes are kept rather than sorting them all, and processes that exit during the
+        scan are skipped.
+
+        @param metric One of rss, pss or swap
+        @param top The number of processes to return
+        @param vebose Whether to display verbose output
+        """
+        if metric == 'rss':
+            read = self._read_stat
+        else:
+            read = self._read_smaps_rollup
+
+        try:
+            # python 2 has no os.scandir, but listing the directory alone doesn't stat each entry either
+            pids = [int(name) for name in os.listdir(self.path) if name.isdigit()]
+        except OSError, error:
+            raise NagiosPluginError("Unable to list processes in %s: %s" % (self.path, error))
+
+        heap = []
+        commands = {}
+        total = 0
+
+        for pid in pids:
+            try:
+                (command, value) = read(pid, metric)
+            except (IOError, OSError):
+                continue
+
+            if not value:
+                continue
+
+            commands[command] = commands.get(command, 0) + value
+            total += value
+
+            if len(heap) < top:
+                heapq.heappush(heap, (value, pid, command))
+            elif value > heap[0][0]:
+                heapq.heapreplace(heap, (value, pid, command))
+
+        if verbose:
+            print "Scanned %d processes in %s for %s" % (len(pids), self.path, metric)
+
+        return (sorted(heap, reverse=True), commands, total)
+
+    def label(self, command):
+        "Returns a command name made safe for use in a perfdata label"
+        return re.sub(r'\W', '_', command)
+
+    def _read_stat(self, pid, metric):
+        "Returns a tuple of the command name and RSS in kB of a process, from /proc/PID/stat"
+        file = open('%s/%d/stat' % (self.path, pid), 'r')
+        try:
+            stat = file.read()
+        finally:
+            file.close()
+
+        # the command name is in brackets and may itself contain spaces and brackets
+        end = stat.rfind(')')
+        command = stat[stat.find('(') + 1:end]
+        rss = int(stat[end + 2:].split()[self.STAT_RSS_FIELD])
+
+        return (command, rss * self.page_size_kb)
+
+    def _read_smaps_rollup(self, pid, metric):
+        """
+        Returns a tuple of the command name of a process and its PSS or swap in kB, from
+        /proc/PID/smaps_rollup. Falls back to RSS from /proc/PID/statm for PSS when smaps_rollup can't be
+        read.
+        """
+        file = open('%s/%d/comm' % (self.path, pid), 'r')
+        try:
+            command = file.read().rstrip('\n')
+        finally:
+            file.close()
+
+        try:
+            file = open('%s/%d/smaps_rollup' % (self.path, pid), 'r')
+        except IOError:
+            return (command, self._read_statm(pid, metric))
+
+        values = {}
+        try:
+            for line in file:
+                fields = line.split()
+                if fields[0] in self.SMAPS_FIELDS:
+                    values[self.SMAPS_FIELDS[fields[0]]] = int(fields[1])
+        finally:
+            file.close()
+
+        if metric not in values:
+            # kernel threads have an empty smaps_rollup
+            return (command, 0)
+
+        return (command, values[metric])
+
+    def _read_statm(self, pid, metric):
+        "Returns RSS in kB from /proc/PID/statm as an approximation of PSS. Swap isn't available."
+        if metric == 'swap':
+            return 0
+
+        file = open('%s/%d/statm' % (self.path, pid), 'r')
+        try:
+            resident = int(file.read().split()[1])
+        finally:
+            file.close()
+
+        return resident * self.page_size_kb
+
+
+class CgroupMemoryStatistic(object):
+    "Returns the memory usage of a cgroup v2 group, read from its memory.* interface files"
+
+    PREFIX = 'cgroup_'
+    ## Files holding a single value, and the statistics they're reported as
+    VALUE_FILES = {'memory.current': 'current', 'memory.max': 'max', 'memory.high': 'high',
+        'memory.swap.current': 'swap_current'}
+    ## Files holding one 'name value' pair per line, and the prefix of the statistics they're reported as
+    KEYED_FILES = {'memory.stat': 'stat_', 'memory.events': 'events_'}
+    ## Value of limits that aren't set
+    UNLIMITED = 'max'
+
+    def __init__(self, root, group):
+        """
+        @param root Path the cgroup v2 hierarchy is mounted at
+        @param group The group, relative to the root
+        """
+        self.root = root
+        self.group = '/' + group.strip('/')
+        self.path = os.path.join(root, group.strip('/'))
+
+    @staticmethod
+    def get_own_group(path='/proc/self/cgroup'):
+        "Returns the cgroup v2 group of this process"
+        for line in read_file(path).splitlines():
+            (hierarchy, controllers, group) = line.split(':', 2)
+            if hierarchy == '0':
+                return group
+
+        raise NagiosPluginError("This process isn't in a cgroup v2 group. Is the unified hierarchy mounted?")
+
+    def walk(self):
+        "Returns a list of this group and every group below it with memory accounting"
+        self._check_hierarchy()
+
+        def walk():
+            return [os.path.relpath(directory, self.root) for (directory, subdirectories, files) in os.walk(self.path)
+                if 'memory.current' in files]
+
+        return [CgroupMemoryStatistic(self.root, group) for group in recorder.fetch('walk %s' % self.path, walk)]
+
+    def get_stats(self):
+        "Returns a dictionary of every statistic for the group"
+        self._check_hierarchy()
+        stats = {}
+
+        for (filename, name) in self.VALUE_FILES.items():
+            value = self._read(filename, required=(filename == 'memory.current'))
+            if value == None:
+                continue
+
+            value = value.strip()
+            if value == self.UNLIMITED:
+                value = 0
+            stats[self.PREFIX + name] = int(value)
+
+        stats[self.PREFIX + 'usage_percentage'] = 0
+        if stats.get(self.PREFIX + 'max'):
+            stats[self.PREFIX + 'usage_percentage'] = round(stats[self.PREFIX + 'current'] * 100.0 /
+                stats[self.PREFIX + 'max'], 2)
+
+        for (filename, prefix) in self.KEYED_FILES.items():
+            for line in (self._read(filename) or '').splitlines():
+                (name, value) = line.split()
+                stats[self.PREFIX + prefix + name] = int(value)
+
+        # lines look like: some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+        for line in (self._read('memory.pressure') or '').splitlines():
+            fields = line.split()
+            for field in fields[1:]:
+                (name, value) = field.split('=')
+                stats['%spressure_%s_%s' % (self.PREFIX, fields[0], name)] = NumberUtils.string_to_number(value)
+
+        return stats
+
+    def get_statistic(self, statistic, verbose=False):
+        """
+        Returns a statistic value.
+
+        @param statistic The name of the statistic to retrieve
+        @param vebose Whether to display verbose output
+        """
+        stats = self.get_stats()
+
+        if verbose:
+            print "Read from %s: %s" % (self.path, stats)
+
+        if statistic not in stats:
+            raise InvalidStatisticError("%s is not a valid statistic name for cgroup %s." % (statistic, self.group))
+
+        return stats[statistic]
+
+    def _check_hierarchy(self):
+        "Raises an error unless the root is a cgroup v2 hierarchy"
+        path = os.path.join(self.root, 'cgroup.controllers')
+        if not recorder.fetch('exists %s' % path, lambda: os.path.exists(path)):
+            raise NagiosPluginError("%s isn't a cgroup v2 hierarchy." % self.root)
+
+    def _read(self, filename, required=False):
+        """
+        Returns the contents of one of the group's files, or None if it doesn't exist. The root group and
+        kernels without pressure stall information lack some of them.
+
+        @param required Whether to raise an error if the file doesn't exist
+        """
+        path = os.path.join(self.path, filename)
+
+        def read():
+            try:
+                file = open(path, 'r')
+            except IOError, error:
+                if required or error.errno != errno.ENOENT:
+                    raise NagiosPluginError("Unable to read %s: %s" % (path, error))
+                return None
+
+            try:
+                return file.read()
+            finally:
+                file.close()
+
+        return recorder.fetch('file %s' % path, read)
+
+
+class NumaMemoryStatistic(object):
+    "Returns memory usage and allocation counters for each NUMA node, read from sysfs"
+
+    PREFIX = 'numa_'
+
+    def __init__(self, path):
+        """
+        @param path Path to the directory containing a nodeN directory for each node
+        """
+        self.path = path
+
+    def get_nodes(self):
+        "Returns a sorted list of the numbers of the nodes"
+        def list_nodes():
+            try:
+                return os.listdir(self.path)
+            except OSError, error:
+                raise NagiosPluginError("Unable to list NUMA nodes in %s: %s" % (self.path, error))
+
+        names = recorder.fetch('listdir %s' % self.path, list_nodes)
+
+        nodes = sorted(int(name[4:]) for name in names if name.startswith('node') and name[4:].isdigit())
+
+        if not nodes:
+            raise NagiosPluginError("No NUMA nodes were found in %s." % self.path)
+
+        return nodes
+
+    def get_stats(self, node):
+        "Returns a dictionary of every statistic for a node"
+        stats = {}
+
+        # lines look like: Node 0 MemFree:         3262600 kB
+        meminfo = {}
+        for line in self._read(node, 'meminfo').splitlines():
+            fields = line.split()
+            if len(fields) >= 4:
+                meminfo[fields[2].rstrip(':')] = int(fields[3])
+
+        try:
+            stats['total'] = meminfo['MemTotal']
+            stats['free'] = meminfo['MemFree']
+            stats['used'] = meminfo['MemTotal'] - meminfo['MemFree']
+        except KeyError, error:
+            raise UnexpectedResponseError("The meminfo for node %d is missing the value %s" % (node, error))
+
+        stats['free_percentage'] = stats['used_percentage'] = 0
+        if stats['total']:
+            stats['free_percentage'] = round(stats['free'] * 100.0 / stats['total'], 2)
+            stats['used_percentage'] = round(stats['used'] * 100.0 / stats['total'], 2)
+
+        for line in self._read(node, 'numastat').splitlines():
+            (name, value) = line.split()
+            if name.startswith(self.PREFIX):
+                name = name[len(self.PREFIX):]
+            stats[name] = int(value)
+
+        return dict((self.PREFIX + name, value) for (name, value) in stats.items())
+
+    def get_statistic(self, statistic, verbose=False):
+        """
+        Returns a dictionary of a statistic's value for each node, keyed by node number.
+
+        @param statistic The name of the statistic to retrieve
+        @param vebose Whether to display verbose output
+        """
+        values = {}
+
+        for node in self.get_nodes():
+            stats = self.get_stats(node)
+
+            if verbose:
+                print "Read for node %d: %s" % (node, stats)
+
+            if statistic not in stats:
+                raise InvalidStatisticError("%s is not a valid statistic name." % statistic)
+
+            values[node] = stats[statistic]
+
+        return values
+
+    def _read(self, node, filename):
+        "Returns the contents of one of a node's files"
+        return read_file(os.path.join(self.path, 'node%d' % node, filename))
+
+
+class KernelMemoryStatistic(object):
+    "Returns memory fragmentation, huge page and virtual memory statistics from the proc filesystem"
+
+    PREFIXES = ('fragmentation_', 'hugepages_', 'vmstat_')
+    UNUSABLE_INDEX = 'fragmentation_unusable_index'
+    ## Values in /proc/meminfo reported as hugepages_ statistics
+    MEMINFO_HUGEPAGES = {'HugePages_Total': 'total', 'HugePages_Free': 'free', 'HugePages_Rsvd': 'reserved',
+        'HugePages_Surp': 'surplus', 'Hugepagesize': 'size_kb', 'AnonHugePages': 'anon_kb',
+        'ShmemHugePages': 'shmem_kb'}
+
+    def __init__(self, path, order):
+        """
+        @param path Path to the proc filesystem
+        @param order Smallest order of free blocks treated as usable
+        """
+        self.path = path
+        self.order = order
+        self.page_size_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+
+    def get_free_blocks(self, filename='buddyinfo'):
+        """
+        Returns a dictionary of lists of the number of free blocks of each order, keyed by a tuple of node and
+        zone, or by node, zone and migrate type when reading pagetypeinfo.
+        """
+        blocks = {}
+        # pagetypeinfo lines have the migrate type as a third part, and its other lines count pageblocks
+        parts_expected = 2
+        if filename == 'pagetypeinfo':
+            parts_expected = 3
+
+        # lines look like: Node 0, zone   Normal     41      2    559 ...
+        # or in pagetypeinfo: Node    0, zone   Normal, type    Movable     41      2 ...
+        for line in self._read(filename).splitlines():
+            parts = line.split(',')
+            if not line.startswith('Node') or len(parts) != parts_expected:
+                continue
+
+            key = ['node' + parts[0].split()[1]]
+            for part in parts[1:-1]:
+                key.append(part.split()[1])
+            fields = parts[-1].split()
+            key.append(fields[1])
+
+            blocks[tuple(key)] = [int(count) for count in fields[2:]]
+
+        return blocks
+
+    def get_zone_unusable_indexes(self):
+        "Returns a dictionary of the unusable free space index of each zone, keyed by a tuple of node and zone"
+        indexes = {}
+
+        for (zone, counts) in self.get_free_blocks().items():
+            (free, usable) = self._sum_free_pages(counts)
+            indexes[zone] = self._unusable_index(free, usable)
+
+        return indexes
+
+    def get_stats(self, statistic):
+        "Returns a dictionary of the statistics in the file the given statistic is read from"
+        stats = {}
+
+        if statistic.startswith('fragmentation_free_kb_at_order_'):
+            for ((node, zone, migrate_type), counts) in self.get_free_blocks('pagetypeinfo').items():
+                name = 'fragmentation_free_kb_at_order_' + migrate_type.lower()
+                stats[name] = stats.get(name, 0) + self._sum_free_pages(counts)[1] * self.page_size_kb
+
+        elif statistic.startswith('fragmentation_'):
+            (free, usable) = (0, 0)
+            for counts in self.get_free_blocks().values():
+                (zone_free, zone_usable) = self._sum_free_pages(counts)
+                free += zone_free
+                usable += zone_usable
+
+            stats['fragmentation_free_kb'] = free * self.page_size_kb
+            stats['fragmentation_free_kb_at_order'] = usable * self.page_size_kb
+            stats[self.UNUSABLE_INDEX] = self._unusable_index(free, usable)
+
+        elif statistic.startswith('hugepages_'):
+            for line in self._read('meminfo').splitlines():
+                (name, separator, value) = line.partition(':')
+                if name in self.MEMINFO_HUGEPAGES:
+                    stats['hugepages_' + self.MEMINFO_HUGEPAGES[name]] = int(value.split()[0])
+
+            if 'hugepages_free' in stats and 'hugepages_reserved' in stats:
+                stats['hugepages_available'] = stats['hugepages_free'] - stats['hugepages_reserved']
+
+        else:
+            for line in self._read('vmstat').splitlines():
+                (name, value) = line.split()
+                stats['vmstat_' + name] = int(value)
+
+        return stats
+
+    def get_statistic(self, statistic, verbose=False):
+        """
+        Returns a statistic value.
+
+        @param statistic The name of the statistic to retrieve
+        @param vebose Whether to display verbose output
+        """
+        stats = self.get_stats(statistic)
+
+        if verbose:
+            print "Read from %s: %s" % (self.path, stats)
+
+        if statistic not in stats:
+            raise InvalidStatisticError("%s is not a valid statistic name." % statistic)
+
+        return stats[statistic]
+
+    def _sum_free_pages(self, counts):
+        "Returns a tuple of the number of free pages, and the number of those in blocks of at least the order"
+        free = usable = 0
+
+        for (order, count) in enumerate(counts):
+            pages = count << order
+            free += pages
+            if order >= self.order:
+                usable += pages
+
+        return (free, usable)
+
+    def _unusable_index(self, free, usable):
+        "Returns the percentage of free pages in blocks smaller than the order"
+        if not free:
+            return 0
+
+        return round((free - usable) * 100.0 / free, 2)
+
+    def _read(self, filename):
+        "Returns the contents of a file in the proc filesystem"
+        return read_file(os.path.join(self.path, filename))
+
+
 if __name__ == '__main__':
-    try:
-        checker = RAM(sys.argv[1:])
-        checker.check()
-        status = checker.get_status()
-        print checker.get_output()
-        sys.exit(status)
-    except (ThresholdValidatorError, InvalidStatisticError), e:
-        print textwrap.fill(str(e), 80)
-        sys.exit(NagiosPlugin.STATUS_UNKNOWN)
-    except NagiosPluginError, e:
-        print textwrap.fill("%s failed unexpectedly. Error was:" % (os.path.basename(__file__,)), 80)
-        print textwrap.fill(str(e), 80)
-        sys.exit(NagiosPlugin.STATUS_UNKNOWN)
\ No newline at end of file
+    (status, output) = RAM.run(sys.argv[1:])
+    print output
+    sys.exit(status)
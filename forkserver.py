@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import errno
+import signal
+import socket
+import argparse
+from StringIO import StringIO
+from nagiosplugin import *
+from forkserver_client import send_message, receive_message, DEFAULT_SOCKET
+
+"""
+A preforking server that runs plugin checks for forkserver_client.py.
+
+Starting a python interpreter and importing the plugin modules costs far more than most checks do. This
+server imports nagiosplugin and every plugin module once, then forks workers that answer check requests
+over a Unix socket. Nagios command definitions call forkserver_client.py with the usual plugin script and
+arguments, and get the same output and exit code as running the script directly:
+
+  define command {
+      command_name check_memcached_gets
+      command_line /usr/lib/nagios/plugins/forkserver_client.py check_memcached.py -s cmd_get -d
+  }
+
+Workers are replaced after running a number of checks so any state a plugin leaves behind doesn't
+accumulate.
+
+Requirements
+=============
+
+This script requires the following python modules:
+
+  * argparse (included with python 2.7, otherwise install with 'easy_install argparse')
+  * the modules required by the plugins being served. Plugins whose modules can't be imported are
+    skipped.
+"""
+
+
+class DeadlineExceededError(Exception):
+    """
+    Thrown in a worker when a check runs past the deadline given by the client. It isn't a NagiosPluginError
+    so that NagiosPlugin.run doesn't report it as the check failing.
+    """
+    pass
+
+
+class ForkServer(object):
+    "Preforks workers that run checks requested over a Unix socket"
+
+    def __init__(self, path, workers, max_requests):
+        """
+        @param path Path to create the Unix socket at
+        @param workers The number of worker processes to keep running
+        @param max_requests The number of checks a worker runs before being replaced
+        """
+        self.path = path
+        self.workers = workers
+        self.max_requests = max_requests
+        self.children = set()
+        self.running = True
+
+    def preload(self):
+        "Imports every plugin module so workers start with them loaded. Returns a list of plugins loaded."
+        loaded = []
+
+        for script in sorted(PLUGINS):
+            try:
+                load_plugin_class(script)
+                loaded.append(script)
+            except ImportError, error:
+                print >> sys.stderr, "Not serving %s: %s" % (script, error)
+
+        return loaded
+
+    def listen(self):
+        "Creates the Unix socket, replacing any left behind by a previous server"
+        try:
+            os.unlink(self.path)
+        except OSError, error:
+            if error.errno != errno.ENOENT:
+                raise
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        self.socket.listen(128)
+
+    def serve_forever(self):
+        "Keeps the pool of workers running until the server receives SIGTERM or SIGINT"
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        while self.running:
+            while len(self.children) < self.workers:
+                self._spawn()
+
+            try:
+                (pid, status) = os.wait()
+                self.children.discard(pid)
+            except OSError, error:
+                if error.errno != errno.EINTR:
+                    raise
+
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        self.socket.close()
+        os.unlink(self.path)
+
+    def _stop(self, signum, frame):
+        self.running = False
+
+    def _spawn(self):
+        "Forks a new worker"
+        pid = os.fork()
+
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                Worker(self.socket).run(self.max_requests)
+            finally:
+                os._exit(0)
+
+        self.children.add(pid)
+
+
+class Worker(object):
+    "Runs checks for requests accepted from the forkserver's socket"
+
+    def __init__(self, listening_socket):
+        self.socket = listening_socket
+
+    def run(self, max_requests):
+        "Handles max_requests requests"
+        for i in range(max_requests):
+            (connection, address) = self.socket.accept()
+            try:
+                request = receive_message(connection)
+                if request != None:
+                    send_message(connection, self.handle(request))
+            except socket.error, error:
+                print >> sys.stderr, "Error handling forkserver request: %s" % error
+            finally:
+                connection.close()
+
+    def handle(self, request):
+        "Runs the check described by a request and returns the response"
+        argv = [arg.encode('utf-8') for arg in request['argv']]
+        script = os.path.basename(argv[0])
+        (stdout, stderr) = (StringIO(), StringIO())
+        saved = (sys.stdout, sys.stderr, sys.argv, dict(os.environ))
+
+        # make the check see the same streams, arguments and environment as if it were run directly
+        (sys.stdout, sys.stderr, sys.argv) = (stdout, stderr, argv)
+        os.environ.clear()
+        os.environ.update((name.encode('utf-8'), value.encode('utf-8'))
+            for (name, value) in request['env'].items())
+
+        signal.signal(signal.SIGALRM, self._deadline_exceeded)
+        try:
+            try:
+                remaining = request['deadline'] - time.time()
+                if remaining <= 0:
+                    raise DeadlineExceededError("The deadline passed before the check started.")
+
+                signal.setitimer(signal.ITIMER_REAL, remaining)
+                (status, output) = load_plugin_class(script).run(argv[1:], script)
+                print output
+            except SystemExit, exit:
+                # argparse exits for --help, --version and invalid arguments
+                status = exit.code
+                if not isinstance(status, int):
+                    status = NagiosPlugin.STATUS_UNKNOWN
+            except DeadlineExceededError, error:
+                status = NagiosPlugin.STATUS_UNKNOWN
+                print "%s timed out: %s" % (script, error)
+            except Exception, error:
+                status = NagiosPlugin.STATUS_UNKNOWN
+                print "%s failed unexpectedly. Error was: %s" % (script, error)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            (sys.stdout, sys.stderr, sys.argv) = saved[:3]
+            os.environ.clear()
+            os.environ.update(saved[3])
+
+        return {'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+    def _deadline_exceeded(self, signum, frame):
+        raise DeadlineExceededError("The check didn't finish within the time allowed.")
+
+
+def parse_args(opts):
+    "Parse given options and arguments"
+    parser = argparse.ArgumentParser(description="""Preforked server that runs plugin checks for
+        forkserver_client.py.""")
+    parser.add_argument('--socket', nargs='?', default=DEFAULT_SOCKET,
+        help="Path to create the Unix socket at. Default is %s" % DEFAULT_SOCKET)
+    parser.add_argument('--workers', nargs='?', type=int, default=4,
+        help="Number of worker processes. Default is 4.")
+    parser.add_argument('--max-requests', nargs='?', type=int, default=1000,
+        help="Number of checks each worker runs before it's replaced. Default is 1000.")
+
+    return parser.parse_args(opts)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    server = ForkServer(args.socket, args.workers, args.max_requests)
+
+    if not server.preload():
+        print "No plugins could be loaded."
+        sys.exit(1)
+
+    try:
+        server.listen()
+    except socket.error, error:
+        print "Unable to listen on %s: %s" % (args.socket, error)
+        sys.exit(1)
+
+    server.serve_forever()
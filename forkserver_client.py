@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import json
+import socket
+import struct
+
+"""
+Client for forkserver.py. Runs a plugin in a pre-warmed forkserver worker and exits with its status, so
+it can be used in nagios command definitions in place of the plugin script itself:
+
+  forkserver_client.py check_memcached.py -s cmd_get -d -w 1000
+
+Options for the client come before the plugin script:
+
+  --socket PATH    Path to the forkserver socket. Default is /var/run/nagiosplugin/forkserver.sock
+  --timeout SECS   Seconds the check may take. Default is 60.
+
+If the forkserver isn't running, the plugin script is run directly instead.
+
+This script deliberately imports as little as possible so that it starts quickly.
+"""
+
+DEFAULT_SOCKET = '/var/run/nagiosplugin/forkserver.sock'
+DEFAULT_TIMEOUT = 60
+
+STATUS_UNKNOWN = 3
+
+## Messages are JSON preceded by their length as a 4 byte unsigned integer
+LENGTH = struct.Struct('!I')
+
+
+def send_message(connection, message):
+    "Sends a message over a socket"
+    data = json.dumps(message)
+    connection.sendall(LENGTH.pack(len(data)) + data)
+
+
+def receive_message(connection):
+    "Receives a message from a socket, returning None if the connection is closed first"
+    header = _receive_exactly(connection, LENGTH.size)
+    if header == None:
+        return None
+
+    data = _receive_exactly(connection, LENGTH.unpack(header)[0])
+    if data == None:
+        return None
+
+    return json.loads(data)
+
+
+def _receive_exactly(connection, length):
+    "Reads length bytes from a socket, or returns None if the connection is closed first"
+    chunks = []
+    remaining = length
+
+    while remaining > 0:
+        chunk = connection.recv(min(remaining, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        remaining -= len(chunk)
+
+    return ''.join(chunks)
+
+
+def run_directly(argv):
+    "Replaces this process with the plugin script"
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.basename(argv[0]))
+    os.execv(sys.executable, [sys.executable, script] + argv[1:])
+
+
+def main(argv):
+    path = DEFAULT_SOCKET
+    timeout = DEFAULT_TIMEOUT
+
+    while argv and argv[0] in ('--socket', '--timeout'):
+        if len(argv) < 2:
+            print "%s requires a value" % argv[0]
+            return STATUS_UNKNOWN
+        if argv[0] == '--socket':
+            path = argv[1]
+        else:
+            timeout = float(argv[1])
+        argv = argv[2:]
+
+    if not argv:
+        print "Usage: %s [--socket PATH] [--timeout SECS] PLUGIN_SCRIPT [ARGS...]" % os.path.basename(sys.argv[0])
+        return STATUS_UNKNOWN
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except socket.error:
+        run_directly(argv)
+
+    # leave a little time after the deadline for the worker to report that it was missed
+    connection.settimeout(timeout + 5)
+
+    try:
+        send_message(connection, {'argv': argv, 'env': dict(os.environ), 'deadline': time.time() + timeout})
+        response = receive_message(connection)
+    except socket.error, error:
+        print "Error communicating with the forkserver: %s" % error
+        return STATUS_UNKNOWN
+    finally:
+        connection.close()
+
+    if response == None:
+        print "The forkserver closed the connection without returning a result."
+        return STATUS_UNKNOWN
+
+    sys.stdout.write(response['stdout'].encode('utf-8'))
+    sys.stderr.write(response['stderr'].encode('utf-8'))
+    return response['status']
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import random
+import argparse
+import resource
+import tempfile
+import shutil
+import threading
+import subprocess
+import SocketServer
+from multiprocessing.pool import ThreadPool
+from nagiosplugin import *
+
+"""
+Load-test harness for the memcached and MySQL plugins. Starts local stand-ins for the servers, runs
+checks against them at a fixed rate and reports throughput, latency percentiles, CPU and memory use.
+
+The stand-ins can inject latency, errors and counter resets to see how checks behave when the
+servers misbehave.
+
+Examples
+========
+
+Run 10,000 memcached checks a minute for 30 seconds by invoking check_memcached.py:
+
+  ./loadtest.py --plugin memcached --mode cli --rate 10000 --duration 30 -- -s cmd_get -d
+
+Run MySQL checks in-process against a stand-in that answers slowly 1% of the time:
+
+  ./loadtest.py --plugin mysql --rate 6000 --latency 0.5 --latency-rate 0.01 -- -s Questions -d
+
+Checks can be run in-process through the plugin classes ('library' mode) or by running the scripts
+('cli' mode). The MySQL stand-in lives inside the harness so it can only be used in library mode.
+
+Requirements
+=============
+
+This script requires the same python modules as the plugins being tested.
+"""
+
+
+class FaultInjector(object):
+    "Decides when stand-in servers should misbehave"
+
+    def __init__(self, latency=0, latency_rate=1, error_rate=0, reset_rate=0):
+        """
+        @param latency Seconds to delay a response by
+        @param latency_rate Fraction of responses to delay
+        @param error_rate Fraction of responses that should fail
+        @param reset_rate Fraction of responses for which counters should be reset, as after a restart
+        """
+        self.latency = latency
+        self.latency_rate = latency_rate
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+
+    def delay(self):
+        "Sleeps if this response should be delayed"
+        if self.latency and random.random() < self.latency_rate:
+            time.sleep(self.latency)
+
+    def should_fail(self):
+        "Returns whether this response should fail"
+        return random.random() < self.error_rate
+
+    def should_reset(self):
+        "Returns whether counters should be reset before this response"
+        return random.random() < self.reset_rate
+
+
+class FakeCounters(object):
+    "A set of counters that grow every time they're read, like those of a busy server"
+
+    def __init__(self, rates, gauges):
+        """
+        @param rates Dictionary of counter names to the average amount they grow by per read
+        @param gauges Dictionary of names to fixed values
+        """
+        self.rates = rates
+        self.gauges = gauges
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        "Resets all counters to zero"
+        self.started = time.time()
+        self.values = dict((name, 0) for name in self.rates)
+
+    def read(self, faults):
+        "Returns a dictionary of all counter and gauge values as strings"
+        self.lock.acquire()
+        try:
+            if faults.should_reset():
+                self.reset()
+
+            for (name, rate) in self.rates.items():
+                self.values[name] += random.randint(0, rate * 2)
+
+            stats = dict((name, str(value)) for (name, value) in self.values.items())
+        finally:
+            self.lock.release()
+
+        stats['uptime'] = str(int(time.time() - self.started))
+        stats.update(self.gauges)
+        return stats
+
+
+class FakeMemcachedHandler(SocketServer.StreamRequestHandler):
+    "Answers the memcached text protocol 'stats' command"
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line.strip()
+            if command == 'quit':
+                return
+
+            self.server.faults.delay()
+
+            if self.server.faults.should_fail():
+                self.wfile.write("SERVER_ERROR injected failure\r\n")
+            elif command == 'stats':
+                for (name, value) in sorted(self.server.counters.read(self.server.faults).items()):
+                    self.wfile.write("STAT %s %s\r\n" % (name, value))
+                self.wfile.write("END\r\n")
+            else:
+                self.wfile.write("ERROR\r\n")
+
+
+class FakeMemcached(SocketServer.ThreadingTCPServer):
+    "A stand-in memcached server listening on a local port"
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, faults):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeMemcachedHandler)
+        self.faults = faults
+        self.counters = FakeCounters(
+            rates={'cmd_get': 100, 'get_hits': 90, 'get_misses': 10, 'cmd_set': 20, 'evictions': 1,
+                'total_connections': 2, 'total_items': 20, 'bytes_read': 5000, 'bytes_written': 20000},
+            gauges={'pid': str(os.getpid()), 'curr_items': '1000', 'bytes': '1048576',
+                'limit_maxbytes': '67108864', 'curr_connections': '10', 'threads': '4',
+                'version': '1.4.5'})
+
+    def start(self):
+        "Serves requests in a background thread"
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class FakeMySQLConnection(object):
+    "Stands in for a MySQLdb connection, answering SHOW GLOBAL STATUS queries"
+
+    def __init__(self, faults):
+        self.faults = faults
+        self.counters = FakeCounters(
+            rates={'Questions': 500, 'Com_select': 300, 'Com_insert': 50, 'Com_update': 50, 'Com_delete': 10,
+                'Connections': 5, 'Slow_queries': 1, 'Threads_created': 1, 'Table_locks_waited': 1},
+            gauges={'Threads_connected': '20', 'Threads_running': '3', 'Threads_cached': '8',
+                'Max_used_connections': '60'})
+
+    def cursor(self, *args):
+        return FakeMySQLCursor(self)
+
+
+class FakeMySQLCursor(object):
+    "Stands in for a MySQLdb cursor"
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, sql, parameters=None):
+        self.connection.faults.delay()
+
+        if self.connection.faults.should_fail():
+            raise UnexpectedResponseError("Injected failure executing: %s" % sql)
+
+        status = self.connection.counters.read(self.connection.faults)
+        status['Uptime'] = status.pop('uptime')
+
+        if sql.startswith("SHOW GLOBAL STATUS LIKE '"):
+            name = sql[len("SHOW GLOBAL STATUS LIKE '"):-1]
+            self.rows = [(name, status[name])] if name in status else []
+        elif sql == "SHOW GLOBAL STATUS":
+            self.rows = sorted(status.items())
+        else:
+            raise UnexpectedResponseError("The stand-in MySQL server can't execute: %s" % sql)
+
+    def fetchone(self):
+        if self.rows:
+            return self.rows.pop(0)
+        return None
+
+    def fetchall(self):
+        (rows, self.rows) = (self.rows, [])
+        return rows
+
+    def close(self):
+        pass
+
+
+def percentile(sorted_values, fraction):
+    "Returns the value at the given fraction (0-1) of a sorted list"
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LoadTest(object):
+    "Runs checks against a stand-in server at a fixed rate and collects measurements"
+
+    ## Plugin scripts and classes for each plugin that can be tested
+    PLUGINS = {
+        'memcached': ('check_memcached.py', 'check_memcached', 'MemcachedStats'),
+        'mysql': ('check_mysql_stats.py', 'check_mysql_stats', 'MySQLStats'),
+    }
+
+    def __init__(self, args):
+        self.args = args
+        self.faults = FaultInjector(args.latency, args.latency_rate, args.error_rate, args.reset_rate)
+        self.directory = tempfile.mkdtemp(prefix='nagiosplugin_loadtest')
+        self.latencies = []
+        self.statuses = [0, 0, 0, 0]
+        ## Number of checks that raised each kind of exception instead of returning a status
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.slots = threading.local()
+        self.slot_count = 0
+
+        (self.script, module_name, class_name) = self.PLUGINS[args.plugin]
+
+        if args.plugin == 'memcached':
+            self.server = FakeMemcached(self.faults)
+            self.server.start()
+            self.check_args = ['-H', '127.0.0.1', '-p', str(self.server.port)]
+        else:
+            if args.mode == 'cli':
+                raise InvalidParameterError("The stand-in MySQL server can only be used in library mode.")
+            self.mysql_connection = FakeMySQLConnection(self.faults)
+            self.check_args = ['-u', 'loadtest', '--password', 'loadtest']
+
+        self.check_args += args.check_args
+
+        if args.mode == 'library':
+            self.plugin_class = getattr(__import__(module_name), class_name)
+
+    def _get_delta_file(self):
+        "Returns a delta file for the current worker thread so concurrent checks don't overwrite each other"
+        if not hasattr(self.slots, 'delta_file'):
+            self.lock.acquire()
+            try:
+                self.slot_count += 1
+                self.slots.delta_file = os.path.join(self.directory, 'delta%d' % self.slot_count)
+            finally:
+                self.lock.release()
+
+        return self.slots.delta_file
+
+    def run_library_check(self, opts):
+        "Runs a check in-process, returning its status"
+        checker = self.plugin_class(opts)
+
+        if self.args.plugin == 'mysql':
+            # route MySQLStatistic's queries to the stand-in server
+            import check_mysql_stats
+            checker.statistic_retriever = check_mysql_stats.MySQLStatistic('127.0.0.1', 3306, 'loadtest',
+                'loadtest', 3, checker._get_snapshot_cache('127.0.0.1', 3306, 'loadtest'))
+            checker.statistic_retriever.mysql = self.mysql_connection
+
+        checker.check()
+        checker.get_output()
+        return checker.get_status()
+
+    def run_cli_check(self, opts):
+        "Runs a check by invoking the plugin script, returning its exit code"
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.script)
+        process = subprocess.Popen([sys.executable, script] + opts, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        process.communicate()
+        return process.returncode
+
+    def run_check(self):
+        "Runs a single check and records how long it took"
+        opts = self.check_args + ['--delta-file', self._get_delta_file()]
+        started = time.time()
+
+        try:
+            if self.args.mode == 'library':
+                status = self.run_library_check(opts)
+            else:
+                status = self.run_cli_check(opts)
+        except (Exception, SystemExit), error:
+            # the thread pool would drop the exception, and the check with it, if it got that far
+            status = NagiosPlugin.STATUS_UNKNOWN
+            failure = error.__class__.__name__
+        else:
+            failure = None
+
+        finished = time.time()
+
+        self.lock.acquire()
+        try:
+            self.latencies.append(finished - started)
+            if 0 <= status < len(self.statuses):
+                self.statuses[status] += 1
+            if failure != None:
+                self.failures[failure] = self.failures.get(failure, 0) + 1
+        finally:
+            self.lock.release()
+
+    def run(self):
+        "Runs checks at the configured rate for the configured duration and returns a report"
+        interval = 60.0 / self.args.rate
+        pool = ThreadPool(self.args.concurrency)
+        usage_before = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+
+        started = time.time()
+        scheduled = started
+        while scheduled < started + self.args.duration:
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            pool.apply_async(self.run_check)
+            scheduled += interval
+
+        pool.close()
+        pool.join()
+        elapsed = time.time() - started
+
+        usage_after = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+        return self.report(elapsed, usage_before, usage_after)
+
+    def report(self, elapsed, usage_before, usage_after):
+        "Returns a report of the measurements as a string"
+        checks = len(self.latencies)
+        latencies = sorted(self.latencies)
+        cpu = 0
+        for (before, after) in zip(usage_before, usage_after):
+            cpu += (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+        errors = str(sum(self.failures.values()))
+        if self.failures:
+            errors += " (%s)" % ', '.join('%s=%d' % (name, count) for (name, count) in sorted(self.failures.items()))
+
+        if self.args.mode == 'library':
+            rss = "%d kB peak for the whole harness" % usage_after[0].ru_maxrss
+        else:
+            rss = "%d kB peak per check" % usage_after[1].ru_maxrss
+
+        lines = [
+            "Plugin:       %s (%s mode)" % (self.args.plugin, self.args.mode),
+            "Checks:       %d in %.1fs (target %d/min, achieved %.0f/min)" % (checks, elapsed, self.args.rate,
+                checks * 60 / elapsed),
+            "Statuses:     %s" % ', '.join('%s=%d' % (name, count) for (name, count) in
+                zip(NagiosPlugin.STATUS_CODE_STRINGS, self.statuses)),
+            "Errors:       %s" % errors,
+            "Latency (ms): p50=%.2f p90=%.2f p99=%.2f max=%.2f" % tuple(value * 1000 for value in (
+                percentile(latencies, 0.5), percentile(latencies, 0.9), percentile(latencies, 0.99),
+                percentile(latencies, 1))),
+            "CPU:          %.3fs total, %.3fms per check" % (cpu, cpu * 1000 / max(checks, 1)),
+            "RSS:          %s" % rss,
+        ]
+
+        return '\n'.join(lines)
+
+
+def parse_args(opts):
+    "Parse given options and arguments"
+    parser = argparse.ArgumentParser(description="""Load-tests the memcached and MySQL plugins against local
+        stand-in servers.""")
+
+    parser.add_argument('--plugin', choices=sorted(LoadTest.PLUGINS), default='memcached',
+        help="The plugin to test. Default is memcached.")
+    parser.add_argument('--mode', choices=['library', 'cli'], default='library',
+        help="""Whether to run checks in-process through the plugin classes, or by invoking the plugin scripts.
+        Default is library.""")
+    parser.add_argument('--rate', type=float, default=600, help="Checks to run per minute. Default is 600.")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to run checks for. Default is 10.")
+    parser.add_argument('--concurrency', type=int, default=8,
+        help="Maximum number of checks to run at once. Default is 8.")
+    parser.add_argument('--latency', type=float, default=0,
+        help="Seconds the stand-in server should delay responses by. Default is 0.")
+    parser.add_argument('--latency-rate', type=float, default=1,
+        help="Fraction of responses to delay. Default is 1.")
+    parser.add_argument('--error-rate', type=float, default=0,
+        help="Fraction of responses that should fail. Default is 0.")
+    parser.add_argument('--reset-rate', type=float, default=0,
+        help="Fraction of responses after which the server's counters are reset. Default is 0.")
+    parser.add_argument('check_args', nargs=argparse.REMAINDER,
+        help="Arguments to pass to each check, after '--', e.g. -- -s cmd_get -d")
+
+    args = parser.parse_args(opts)
+
+    if args.check_args and args.check_args[0] == '--':
+        args.check_args = args.check_args[1:]
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        print LoadTest(parse_args(sys.argv[1:])).run()
+    except NagiosPluginError, e:
+        print str(e)
+        sys.exit(1)
@@ -1,9 +1,52 @@
+import os
 import re
+import ast
+import sys
+import stat
+import errno
+import fcntl
+import heapq
+import bisect
+import select
+import shutil
 import argparse
+import textwrap
+import tempfile
+import threading
 import cPickle as pickle
 import time
 from UserDict import IterableUserDict
 
+## Plugins that can be run in-process, by script name. Values are 'module.Class'.
+PLUGINS = {
+    'check_disk.py': 'check_disk.Disk',
+    'check_logfile.py': 'check_logfile.LogFile',
+    'check_memcached.py': 'check_memcached.MemcachedStats',
+    'check_net.py': 'check_net.Net',
+    'check_procs.py': 'check_procs.Procs',
+    'check_mysql_stats.py': 'check_mysql_stats.MySQLStats',
+    'check_nagios_aggregate.py': 'check_nagios_aggregate.NagiosAggregate',
+    'check_ram.py': 'check_ram.RAM',
+}
+
+
+def load_plugin_class(script):
+    """
+    Returns the plugin class for a script, importing its module if necessary.
+
+    @param script The name of or path to a plugin script, e.g. check_ram.py
+    @throws InvalidParameterError if the script isn't a known plugin
+    """
+    name = os.path.basename(script)
+
+    if name not in PLUGINS:
+        raise InvalidParameterError("%s is not a known plugin. Known plugins are: %s" % (name,
+            ', '.join(sorted(PLUGINS))))
+
+    (module_name, class_name) = PLUGINS[name].rsplit('.', 1)
+    return getattr(__import__(module_name), class_name)
+
+
 class NagiosPluginError(Exception):
     "Base class for plugin errors"
     pass
@@ -32,6 +75,26 @@ class InvalidParameterError(NagiosPluginError):
     pass
 
 
+class StaleStatisticError(NagiosPluginError):
+    "Thrown when a statistic couldn't be fetched within the latency budget and no recent enough value is known"
+    pass
+
+
+class IncompleteStatisticError(NagiosPluginError):
+    "Thrown when a statistic gathered over several invocations doesn't cover everything it should yet"
+    pass
+
+
+class SpoolFullError(NagiosPluginError):
+    "Thrown when the check result spool directory stays too full to accept more results"
+    pass
+
+
+class ReplayError(NagiosPluginError):
+    "Thrown when a recording being replayed has no response for a request the check makes"
+    pass
+
+
 class Maths(object):
     "Constants for infinity and negative infinity"
     INFINITY = 'infinity'
@@ -342,11 +405,21 @@ class Thresholds(object):
 
 
 class TimestampedStatisticCollection(IterableUserDict):
-    "Persistable store for a collection of time-stamped statistics"
+    """
+    Persistable store for a collection of time-stamped statistics.
+
+    Several processes may share a store, e.g. checks of different statistics of the same server, or a fetch
+    detached from the check that started it. Only the statistics set through each collection are written
+    back, over whatever is in the store at the time, so one process doesn't undo the others' updates.
+    """
     def __init__(self, path):
         "Path is the path to persist data to"
         IterableUserDict.__init__(self)
         self.path = path
+        ## Keys set since the collection was loaded
+        self.modified = set()
+        ## Keys deleted since the collection was loaded
+        self.removed = set()
         self.__load()
 
     def __load(self):
@@ -360,19 +433,787 @@ class TimestampedStatisticCollection(IterableUserDict):
 
     def persist(self):
         """
-        Persists the collection.
+        Persists the statistics set since the collection was loaded, merging them into the store under a
+        lock file.
 
-        @throws IOError if it can't write to the file
+        @throws IOError if it can't write to the file or its lock file
         """
-        file = open(self.path, 'w+')
-        pickle.dump(self.data, file)
-        file.close()
+        lock = open(self.path + '.lock', 'a')
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # another process may have persisted statistics since we loaded ours
+            stored = TimestampedStatisticCollection(self.path)
+            for key in self.modified:
+                stored.data[key] = self.data[key]
+            for key in self.removed:
+                stored.data.pop(key, None)
+
+            file = open(self.path, 'w+')
+            pickle.dump(stored.data, file)
+            file.close()
+        finally:
+            # closing the file releases the lock
+            lock.close()
 
     def __setitem__(self, key, value):
         "Creates a tuple consisting of the current time stamp and the value and stores that tuple under the key."
-        data = {"time": time.time(), "value": value}
+        data = {"time": clock.time(), "value": value}
+        self.modified.add(key)
+        self.removed.discard(key)
         return IterableUserDict.__setitem__(self, key, data)
 
+    def __delitem__(self, key):
+        "Deletes a statistic, and removes it from the store when the collection is persisted."
+        self.modified.discard(key)
+        self.removed.add(key)
+        return IterableUserDict.__delitem__(self, key)
+
+
+class SnapshotCache(object):
+    """
+    A short-lived cache of a complete statistics snapshot that can be shared between processes.
+
+    Nagios frequently runs several checks against the same server within the same second, each for a
+    different statistic. Rather than each of them fetching every statistic from the server, the first
+    one to run stores the whole snapshot and the others read it until it is older than the TTL. A lock
+    file makes sure that only one process fetches a new snapshot while the rest wait for it.
+
+    Snapshots are pickled, so they're kept in a directory only the current user can write to. Otherwise
+    anyone able to write to the cache directory could plant a snapshot that runs code when it's read.
+    """
+    def __init__(self, path, ttl):
+        """
+        @param path Path to store the snapshot at. A lock file is created alongside it.
+        @param ttl Number of seconds a snapshot may be served for
+        """
+        self.path = path
+        self.ttl = ttl
+
+    @staticmethod
+    def for_server(directory, plugin, host, port, ttl, user=None):
+        """
+        Returns a cache whose snapshot is stored in a private subdirectory of directory and keyed by plugin,
+        host, port and the user connecting, since different users may see different statistics.
+
+        @throws NagiosPluginError if the private subdirectory can't be created or isn't private
+        """
+        name = re.sub(r'[^\w.-]', '_', "%s_%s_%s_%s" % (plugin, host, port, user or ''))
+        return SnapshotCache(os.path.join(SnapshotCache.get_private_directory(directory),
+            'nagiosplugin_snapshot_%s' % name), ttl)
+
+    @staticmethod
+    def get_private_directory(directory):
+        """
+        Returns the path of a subdirectory of directory for the current user, creating it with mode 0700 if
+        it doesn't exist.
+
+        @throws NagiosPluginError if it can't be created, or isn't a directory only the current user can use
+        """
+        path = os.path.join(directory, 'nagiosplugin-%d' % os.getuid())
+
+        try:
+            os.mkdir(path, 0700)
+        except OSError, error:
+            if error.errno != errno.EEXIST:
+                raise NagiosPluginError("Unable to create the snapshot directory %s: %s" % (path, error))
+
+        # lstat so a symlink planted in its place isn't followed
+        details = os.lstat(path)
+        if not stat.S_ISDIR(details.st_mode) or details.st_uid != os.getuid() or details.st_mode & 0077:
+            raise NagiosPluginError("The snapshot directory %s must be a directory owned by uid %d with mode 0700." %
+                (path, os.getuid()))
+
+        return path
+
+    def get(self, fetch):
+        """
+        Returns the cached snapshot if it is younger than the TTL. Otherwise fetch is called to retrieve a
+        new snapshot which is stored for other processes and then returned.
+
+        @param fetch A callable taking no arguments that returns a new snapshot
+        @throws IOError if the lock file or snapshot can't be written
+        """
+        snapshot = self._read()
+        if snapshot is not None:
+            return snapshot
+
+        lock = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # another process may have stored a snapshot while we were waiting for the lock
+            snapshot = self._read()
+            if snapshot is None:
+                snapshot = fetch()
+                self._write(snapshot)
+        finally:
+            # closing the file releases the lock
+            lock.close()
+
+        return snapshot
+
+    def _read(self):
+        "Returns the stored snapshot, or None if there isn't one or it has expired"
+        try:
+            file = open(self.path, 'rb')
+        except IOError:
+            return None
+
+        try:
+            try:
+                (timestamp, snapshot) = pickle.load(file)
+            except (EOFError, ValueError, TypeError, pickle.UnpicklingError):
+                return None
+        finally:
+            file.close()
+
+        if 0 <= time.time() - timestamp <= self.ttl:
+            return snapshot
+
+        return None
+
+    def _write(self, snapshot):
+        "Stores the snapshot. It's written to a temporary file first so readers never see a partial snapshot."
+        (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.nagiosplugin_snapshot')
+        file = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump((time.time(), snapshot), file, pickle.HIGHEST_PROTOCOL)
+        finally:
+            file.close()
+
+        os.rename(temp_path, self.path)
+
+
+class Clock(threading.local):
+    """
+    The time used for deltas and thresholds. It's the system time unless a replay has fixed it at the time
+    a recording was made, so replayed checks compute the same deltas as the checks that were recorded.
+
+    Each thread has its own time, so checks run in-process by nrpe_server.py don't change each other's.
+    """
+    def __init__(self):
+        self.now = None
+
+    def time(self):
+        "Returns the current time in seconds since the epoch"
+        if self.now != None:
+            return self.now
+
+        return time.time()
+
+    def set(self, timestamp):
+        "Fixes the time at timestamp, or goes back to the system time if timestamp is None"
+        self.now = timestamp
+
+
+class Recorder(threading.local):
+    """
+    The seam between statistic retrievers and their backends. Retrievers make each raw request through
+    fetch, e.g. memcached's stats, the rows returned by a MySQL query or the contents of a file in /proc.
+
+    Normally requests are simply made. While recording, each response, or the error raised instead, is kept
+    and saved to a directory as one file per check. While replaying, the responses in a saved recording are
+    returned in the order they were recorded and no requests are made, so checks can be run again offline
+    and get the same results.
+
+    Each thread records and replays separately, so checks running alongside one being recorded or replayed
+    in-process make their requests as usual.
+
+    Where the raw responses would be too large, such as a scan of every process or of a whole log file, the
+    result of the scan is fetched through the recorder instead. Statistics that can't be replayed, such as
+    latencies measured by probes, call NagiosPlugin._check_not_recording so they fail rather than making
+    requests during a replay.
+    """
+    RECORDING = 'recording'
+    REPLAYING = 'replaying'
+    ## Extension of the files recordings are saved in
+    EXTENSION = '.recording'
+
+    def __init__(self):
+        self.mode = None
+        self.responses = {}
+
+    def is_active(self):
+        "Returns whether requests are being recorded or replayed"
+        return self.mode != None
+
+    def record(self):
+        "Starts recording responses"
+        self.mode = self.RECORDING
+        self.responses = {}
+
+    def replay(self, responses):
+        """
+        Starts returning recorded responses in place of making requests
+
+        @param responses The responses of a recording returned by load
+        """
+        self.mode = self.REPLAYING
+        self.responses = dict((source, list(source_responses)) for (source, source_responses) in responses.items())
+
+    def stop(self):
+        "Goes back to making requests without recording them"
+        self.mode = None
+        self.responses = {}
+
+    def fetch(self, source, fetch):
+        """
+        Returns the response to a request.
+
+        @param source A string identifying the request, e.g. the SQL statement or path of the file read
+        @param fetch A callable taking no arguments that makes the request and returns the raw response
+        @throws ReplayError if replaying and the recording has no more responses for the source
+        """
+        if self.mode == self.REPLAYING:
+            try:
+                (kind, response) = self.responses[source].pop(0)
+            except (KeyError, IndexError):
+                raise ReplayError("The recording has no response for %s" % source)
+
+            if kind == 'error':
+                raise response
+            return response
+
+        if self.mode != self.RECORDING:
+            return fetch()
+
+        try:
+            response = fetch()
+        except Exception, error:
+            try:
+                pickle.dumps(error)
+            except Exception:
+                error = NagiosPluginError(str(error))
+            self.responses.setdefault(source, []).append(('error', error))
+            raise
+
+        self.responses.setdefault(source, []).append(('response', response))
+        return response
+
+    def save(self, directory, timestamp):
+        """
+        Saves the responses recorded so far as a new recording in directory
+
+        @param timestamp The time the check being recorded started
+        @throws NagiosPluginError if the recording can't be written
+        """
+        name = '%017.6f-%d%s' % (timestamp, os.getpid(), self.EXTENSION)
+
+        try:
+            # written to a temporary file first so a replay never reads a partial recording
+            (fd, temp_path) = tempfile.mkstemp(dir=directory, prefix='.nagiosplugin_recording')
+            file = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump((timestamp, self.responses), file, pickle.HIGHEST_PROTOCOL)
+            finally:
+                file.close()
+
+            os.rename(temp_path, os.path.join(directory, name))
+        except (IOError, OSError), error:
+            raise NagiosPluginError("Unable to save the recording to %s: %s" % (directory, error))
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Returns a list of the (timestamp, responses) tuples of the recordings in directory, oldest first
+
+        @throws NagiosPluginError if the recordings can't be read
+        """
+        recordings = []
+
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith(cls.EXTENSION))
+
+            for name in names:
+                file = open(os.path.join(directory, name), 'rb')
+                try:
+                    recordings.append(pickle.load(file))
+                finally:
+                    file.close()
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError), error:
+            raise NagiosPluginError("Unable to read recordings from %s: %s" % (directory, error))
+
+        return recordings
+
+
+## The clock and recorder used by checks. Replays change them, so everything uses these rather than its own.
+# Both are thread-local.
+clock = Clock()
+recorder = Recorder()
+
+
+def read_file(path):
+    """
+    Returns the contents of a file, such as one in /proc. Files are read through the recorder, so their
+    contents are recorded with --record and replayed with --replay.
+
+    @throws NagiosPluginError if the file can't be read
+    """
+    def read():
+        try:
+            file = open(path, 'r')
+        except IOError, error:
+            raise NagiosPluginError("Unable to read %s: %s" % (path, error))
+
+        try:
+            return file.read()
+        finally:
+            file.close()
+
+    return recorder.fetch('file %s' % path, read)
+
+
+class CheckResultSpool(object):
+    """
+    Submits passive check results by writing them as files into the nagios check result spool directory
+    (check_result_path in nagios.cfg), the way nagios itself queues results from its own checks.
+
+    Results are buffered and written several to a file. Each file is only picked up by nagios once a
+    matching .ok file exists, which is created after the results have been completely written. If nagios
+    falls behind and the spool holds too many files, flushing waits for it to catch up.
+    """
+
+    ## Nagios only reads files whose names are a 'c' followed by six characters
+    FILE_PREFIX = 'c'
+
+    def __init__(self, path, batch_size=100, max_files=1000, full_timeout=10):
+        """
+        @param path The check result spool directory
+        @param batch_size The number of results to buffer before writing them to a file
+        @param max_files Wait before writing when the spool already holds this many result files
+        @param full_timeout Seconds to wait for the spool to have space before raising a SpoolFullError
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.max_files = max_files
+        self.full_timeout = full_timeout
+        self.results = []
+
+    def add(self, host, service, plugin, start_time=None, finish_time=None):
+        """
+        Adds the result of a plugin whose check method has been called.
+
+        @param host The name of the host in nagios
+        @param service The service description in nagios, or None for a host check result
+        @param plugin A NagiosPlugin instance
+        """
+        self.add_result(host, service, plugin.get_status(), plugin.get_output(), start_time, finish_time)
+
+    def add_result(self, host, service, status, output, start_time=None, finish_time=None):
+        """
+        Adds a check result, writing the buffered results to the spool if there are batch_size of them.
+
+        @param status The nagios status code
+        @param output The plugin output
+        @param start_time When the check started, in seconds since the epoch. Defaults to now.
+        @param finish_time When the check finished, in seconds since the epoch. Defaults to start_time.
+        @throws SpoolFullError if the spool doesn't have space in time
+        """
+        if start_time == None:
+            start_time = time.time()
+        if finish_time == None:
+            finish_time = start_time
+
+        self.results.append((host, service, status, output, start_time, finish_time))
+
+        if len(self.results) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered results to a single file in the spool.
+
+        @throws SpoolFullError if the spool doesn't have space in time. Results stay buffered.
+        @throws IOError, OSError if the file can't be written
+        """
+        if not self.results:
+            return
+
+        self._wait_for_space()
+
+        (fd, path) = tempfile.mkstemp(dir=self.path, prefix=self.FILE_PREFIX, suffix='')
+        file = os.fdopen(fd, 'w')
+        try:
+            file.write(self._format_results(self.results))
+            file.flush()
+            os.fsync(file.fileno())
+        finally:
+            file.close()
+
+        # nagios ignores the results file until the .ok file exists, so it never sees a partial file
+        open(path + '.ok', 'w').close()
+
+        self.results = []
+
+    def _count_files(self):
+        "Returns the number of result files in the spool waiting for nagios to process them"
+        return len([name for name in os.listdir(self.path)
+            if name.startswith(self.FILE_PREFIX) and not name.endswith('.ok')])
+
+    def _wait_for_space(self):
+        "Waits until the spool holds fewer than max_files result files"
+        deadline = time.time() + self.full_timeout
+        delay = 0.01
+
+        while self._count_files() >= self.max_files:
+            if time.time() >= deadline:
+                raise SpoolFullError("The check result spool %s holds %d or more files." % (self.path,
+                    self.max_files))
+
+            time.sleep(min(delay, max(deadline - time.time(), 0)))
+            delay = min(delay * 2, 1)
+
+    def _format_results(self, results):
+        "Returns the contents of a check result file for the given results"
+        now = time.time()
+        lines = ["### Nagios Check Result File ###", "file_time=%d" % now, ""]
+
+        for (host, service, status, output, start_time, finish_time) in results:
+            if service == None:
+                lines.append("### Nagios Host Check Result ###")
+            else:
+                lines.append("### Nagios Service Check Result ###")
+
+            lines.append("# Time: %s" % time.ctime(finish_time))
+            lines.append("host_name=%s" % host)
+
+            if service != None:
+                lines.append("service_description=%s" % service)
+
+            lines.extend([
+                "check_type=1",
+                "check_options=0",
+                "scheduled_check=0",
+                "reschedule_check=0",
+                "latency=0.0",
+                "start_time=%s" % self._format_time(start_time),
+                "finish_time=%s" % self._format_time(finish_time),
+                "early_timeout=0",
+                "exited_ok=1",
+                "return_code=%d" % status,
+                "output=%s" % output.replace('\\', '\\\\').replace('\n', '\\n'),
+                "",
+            ])
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _format_time(timestamp):
+        "Formats a timestamp as seconds.microseconds the way nagios expects"
+        seconds = int(timestamp)
+        return "%d.%06d" % (seconds, int(round((timestamp - seconds) * 1000000)) % 1000000)
+
+
+class Histogram(object):
+    """
+    Counts values into fixed buckets so that percentiles of a stream of values can be estimated in
+    constant memory.
+
+    Buckets are defined by their upper bounds. Values above the last bound are counted in an overflow
+    bucket. Percentiles are interpolated linearly within the bucket they fall in.
+    """
+    def __init__(self, bounds, counts=None):
+        """
+        @param bounds Sorted list of bucket upper bounds
+        @param counts Optional list of initial counts, one per bound plus one for the overflow bucket
+        """
+        self.bounds = list(bounds)
+
+        if counts == None:
+            counts = [0] * (len(self.bounds) + 1)
+        elif len(counts) != len(self.bounds) + 1:
+            raise InvalidParameterError("A histogram with %d bounds needs %d counts, %d given" % (len(self.bounds),
+                len(self.bounds) + 1, len(counts)))
+
+        self.counts = list(counts)
+        self.count = sum(self.counts)
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+
+    @staticmethod
+    def exponential(start, factor, buckets):
+        "Returns a histogram whose bucket bounds start at start and grow by factor, e.g. 1, 2, 4, 8..."
+        return Histogram([start * factor ** i for i in range(buckets)])
+
+    def add(self, value):
+        "Counts a value"
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+        if self.minimum == None or value < self.minimum:
+            self.minimum = value
+        if self.maximum == None or value > self.maximum:
+            self.maximum = value
+
+    def mean(self):
+        "Returns the mean of the values added, or 0 if there are none"
+        if not self.count:
+            return 0
+        return float(self.total) / self.count
+
+    def percentile(self, percentile):
+        """
+        Returns an estimate of the given percentile (0-100) of the values counted, or 0 if there are none.
+        """
+        if not self.count:
+            return 0
+
+        rank = self.count * percentile / 100.0
+        cumulative = 0
+
+        for (index, count) in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                (lower, upper) = self._get_bucket_range(index)
+                value = lower + (upper - lower) * max(rank - cumulative, 0) / count
+
+                # the exact extremes are better than the bucket bounds if we know them
+                if self.minimum != None:
+                    value = min(max(value, self.minimum), self.maximum)
+
+                return value
+
+            cumulative += count
+
+        return self._get_bucket_range(len(self.counts) - 1)[1]
+
+    def _get_bucket_range(self, index):
+        "Returns a tuple (lower, upper) of the range of values counted in a bucket"
+        if index == 0:
+            lower = min(0, self.bounds[0])
+        else:
+            lower = self.bounds[index - 1]
+
+        if index < len(self.bounds):
+            upper = self.bounds[index]
+        elif self.maximum != None:
+            upper = self.maximum
+        else:
+            upper = self.bounds[-1]
+
+        return (lower, upper)
+
+
+class TopCounter(object):
+    """
+    Approximately counts the most frequent (or heaviest) keys of a stream in constant memory, using the
+    space-saving algorithm.
+
+    At most size keys are tracked. When a new key arrives and there's no room, the key with the lowest
+    count is replaced and the new key inherits its count. Counts may therefore be overestimated by at
+    most the count they inherited, but any key whose true count is larger than total / size is
+    guaranteed to be tracked.
+    """
+    def __init__(self, size):
+        """
+        @param size The maximum number of keys to track
+        """
+        self.size = size
+        self.counts = {}
+        self.errors = {}
+        ## min-heap of (count, key). Counts only grow, so an entry may be lower than the key's count.
+        self.heap = []
+
+    def add(self, key, amount=1):
+        "Adds amount to the count for key"
+        if key in self.counts:
+            self.counts[key] += amount
+            return
+
+        if len(self.counts) < self.size:
+            self.counts[key] = amount
+            self.errors[key] = 0
+            heapq.heappush(self.heap, (amount, key))
+            return
+
+        # find the key with the lowest count, correcting entries that are out of date on the way
+        while True:
+            (count, smallest) = heapq.heappop(self.heap)
+            if self.counts[smallest] == count:
+                break
+            heapq.heappush(self.heap, (self.counts[smallest], smallest))
+
+        del self.counts[smallest]
+        del self.errors[smallest]
+
+        self.counts[key] = count + amount
+        self.errors[key] = count
+        heapq.heappush(self.heap, (count + amount, key))
+
+    def top(self, n):
+        "Returns a list of up to n (key, count) tuples for the keys with the highest counts"
+        return heapq.nlargest(n, self.counts.items(), key=lambda item: item[1])
+
+
+class StatisticExpression(object):
+    """
+    An arithmetic expression over the statistics in a snapshot, e.g.:
+
+      rate(get_hits) * 100 / rate(cmd_get)
+      Threads_created / Connections
+
+    Expressions may contain statistic names, numbers, brackets, +, -, *, / and %, and these functions of a
+    statistic's change since the expression was last evaluated:
+
+      rate(name)   change per second
+      delta(name)  change
+
+    Expressions are parsed with the ast module and anything else, including attribute access and calls
+    to any other function, is rejected, so they are safe to take from the command line. Parsed
+    expressions are cached so long-lived processes only parse each one once. The cache is emptied when it's
+    full, so a server checking ever-changing expressions doesn't grow without limit.
+
+    Values are converted to floats, and division by zero gives 0.
+    """
+
+    FUNCTIONS = ('rate', 'delta')
+    OPERATORS = {
+        ast.Add: lambda left, right: left + right,
+        ast.Sub: lambda left, right: left - right,
+        ast.Mult: lambda left, right: left * right,
+        ast.Div: lambda left, right: left / right,
+        ast.Mod: lambda left, right: left % right,
+    }
+    UNARY_OPERATORS = {
+        ast.USub: lambda operand: -operand,
+        ast.UAdd: lambda operand: operand,
+    }
+    ## Names of statistics, which are also the only values of -s that aren't expressions
+    NAME = re.compile(r'^\w+$')
+
+    ## Parsed expressions by text
+    _parsed = {}
+    ## Most parsed expressions to cache
+    MAX_PARSED = 100
+
+    @staticmethod
+    def is_expression(text):
+        "Returns whether text is an expression rather than the name of a single statistic"
+        return not StatisticExpression.NAME.match(text)
+
+    @staticmethod
+    def parse(text):
+        """
+        Returns the expression for text, parsing it if it hasn't been parsed already.
+
+        @throws InvalidStatisticError if the text isn't a valid expression
+        """
+        expression = StatisticExpression._parsed.get(text)
+
+        if expression == None:
+            expression = StatisticExpression(text)
+            if len(StatisticExpression._parsed) >= StatisticExpression.MAX_PARSED:
+                StatisticExpression._parsed.clear()
+            StatisticExpression._parsed[text] = expression
+
+        return expression
+
+    def __init__(self, text):
+        """
+        @param text The expression
+        @throws InvalidStatisticError if the text isn't a valid expression
+        """
+        self.text = text
+        ## Names of the statistics the expression uses
+        self.names = set()
+        ## Names of the statistics whose values must be kept for rate() and delta()
+        self.counters = set()
+
+        try:
+            tree = ast.parse(text.strip(), mode='eval')
+        except SyntaxError, error:
+            raise InvalidStatisticError("'%s' isn't a valid expression: %s" % (text, error.msg))
+
+        self.evaluator = self._compile(tree.body)
+
+    def evaluate(self, stats, previous=None, elapsed=None):
+        """
+        Returns the value of the expression.
+
+        rate() and delta() are 0 when there are no previous values.
+
+        @param stats A dictionary of statistics
+        @param previous A dictionary of the values of the counters when the expression was last evaluated
+        @param elapsed Seconds since the expression was last evaluated
+        """
+        return self.evaluator(stats, previous or {}, elapsed)
+
+    def _compile(self, node):
+        "Returns a function of (stats, previous, elapsed) that evaluates an expression node"
+        if isinstance(node, ast.Num):
+            value = float(node.n)
+            return lambda stats, previous, elapsed: value
+
+        if isinstance(node, ast.Name):
+            self.names.add(node.id)
+            return lambda stats, previous, elapsed: self._lookup(stats, node.id)
+
+        if isinstance(node, ast.BinOp) and type(node.op) in self.OPERATORS:
+            (left, right, operator) = (self._compile(node.left), self._compile(node.right),
+                self.OPERATORS[type(node.op)])
+
+            def evaluate(stats, previous, elapsed):
+                try:
+                    return operator(left(stats, previous, elapsed), right(stats, previous, elapsed))
+                except ZeroDivisionError:
+                    return 0.0
+            return evaluate
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in self.UNARY_OPERATORS:
+            (operand, operator) = (self._compile(node.operand), self.UNARY_OPERATORS[type(node.op)])
+            return lambda stats, previous, elapsed: operator(operand(stats, previous, elapsed))
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in self.FUNCTIONS:
+            if len(node.args) != 1 or not isinstance(node.args[0], ast.Name) or node.keywords or \
+                    node.starargs or node.kwargs:
+                raise InvalidStatisticError("%s() in '%s' takes the name of a single statistic." %
+                    (node.func.id, self.text))
+
+            name = node.args[0].id
+            self.names.add(name)
+            self.counters.add(name)
+
+            if node.func.id == 'rate':
+                return lambda stats, previous, elapsed: self._rate(stats, previous, elapsed, name)
+            return lambda stats, previous, elapsed: self._delta(stats, previous, name)
+
+        raise InvalidStatisticError("%s isn't allowed in the expression '%s'." % (self._describe(node), self.text))
+
+    def _describe(self, node):
+        "Returns a description of an expression node for error messages"
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            return "The function %s()" % node.func.id
+
+        if isinstance(node, (ast.BinOp, ast.UnaryOp)):
+            return "The operator %s" % type(node.op).__name__
+
+        return "%s" % type(node).__name__
+
+    def _lookup(self, stats, name):
+        "Returns the value of a statistic as a float"
+        if name not in stats:
+            raise InvalidStatisticError("No statistic called '%s' is available for the expression '%s'." %
+                (name, self.text))
+
+        return float(NumberUtils.string_to_number(stats[name]))
+
+    def _delta(self, stats, previous, name):
+        "Returns the change in a statistic since the previous values"
+        if name not in previous:
+            return 0.0
+
+        return self._lookup(stats, name) - float(NumberUtils.string_to_number(previous[name]))
+
+    def _rate(self, stats, previous, elapsed, name):
+        "Returns the change per second in a statistic since the previous values"
+        if not elapsed:
+            return 0.0
+
+        return self._delta(stats, previous, name) / elapsed
+
 
 class NumberUtils(object):
     "Utility methods for working with numbers"
@@ -401,6 +1242,16 @@ class NagiosPlugin(object):
 
     ## Strings that correspond to the above status codes 
     STATUS_CODE_STRINGS = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+    ## Status codes from the least to the most severe, for reporting the worst of several checks
+    STATUS_SEVERITY = [STATUS_OK, STATUS_WARNING, STATUS_UNKNOWN, STATUS_CRITICAL]
+
+    ## Prefix of keys in the statistic collection that hold the last value reported for a statistic
+    LAST_KNOWN_PREFIX = 'last_known:'
+    ## Prefix of keys in the statistic collection that hold the counters used by an expression
+    EXPRESSION_PREFIX = 'expression:'
+    ## Seconds after which the values stored for instances that have disappeared, such as cgroups or mounts,
+    ## are forgotten
+    FORGET_INSTANCES_AFTER = 86400
 
     def __init__(self, opts):
         self.status = self.STATUS_UNKNOWN
@@ -408,8 +1259,94 @@ class NagiosPlugin(object):
         self.set_thresholds(self.args.warning, self.args.critical, self.args.time_periods)
         self.statistic_collection = TimestampedStatisticCollection(self.args.delta_file)
 
+    @classmethod
+    def run(cls, opts, script_name=None):
+        """
+        Runs a check and returns a tuple (status, output) of the exit code and text nagios expects.
+
+        Errors raised by the plugin are turned into UNKNOWN results with an explanation as output, so checks
+        can be run in-process by long-lived servers as well as from the command line.
+
+        @param opts List of command line arguments
+        @param script_name Name of the script to mention in error messages. Defaults to the plugin's module.
+        """
+        if script_name == None:
+            script_name = os.path.splitext(os.path.basename(sys.modules[cls.__module__].__file__))[0] + '.py'
+
+        try:
+            checker = cls(opts)
+
+            if hasattr(checker.args, 'replay') and hasattr(checker.args, 'record'):
+                raise InvalidParameterError("--record and --replay can't be used together.")
+
+            # checks run for each recording being replayed see the recorder replaying, not --replay
+            if hasattr(checker.args, 'replay') and recorder.mode != Recorder.REPLAYING:
+                return cls._replay(opts, checker.args, script_name)
+
+            if hasattr(checker.args, 'record'):
+                timestamp = clock.time()
+                recorder.record()
+                try:
+                    checker.check()
+                finally:
+                    recorder.save(checker.args.record, timestamp)
+                    recorder.stop()
+            else:
+                checker.check()
+
+            return (checker.get_status(), checker.get_output())
+        except (ThresholdValidatorError, InvalidStatisticError, StaleStatisticError, IncompleteStatisticError), e:
+            return (cls.STATUS_UNKNOWN, textwrap.fill(str(e), 80))
+        except NagiosPluginError, e:
+            return (cls.STATUS_UNKNOWN, "%s\n%s" % (
+                textwrap.fill("%s failed unexpectedly. Error was:" % (script_name,), 80),
+                textwrap.fill(str(e), 80)))
+
+    @classmethod
+    def _replay(cls, opts, args, script_name):
+        """
+        Runs the check once for each recording in a directory, returning the recorded responses in place of
+        making requests and with the clock set to the time each recording was made. Returns a tuple of the
+        most severe status and the output of every check, one per line and prefixed with its time.
+
+        Deltas are computed in a delta file that only lasts for the replay, so replays are repeatable and
+        never disturb the delta file of live checks.
+
+        @param opts List of command line arguments
+        @param args The parsed arguments, giving the directory to replay and the speed to replay it at
+        """
+        recordings = Recorder.load(args.replay)
+        if not recordings:
+            raise NagiosPluginError("There are no recordings in %s" % args.replay)
+
+        delta_directory = tempfile.mkdtemp(prefix='nagiosplugin_replay')
+        if hasattr(args, 'delta_file'):
+            opts = list(opts) + ['--delta-file', os.path.join(delta_directory, 'delta')]
+        statuses = []
+        outputs = []
+
+        try:
+            for (index, (timestamp, responses)) in enumerate(recordings):
+                if index and args.replay_speed:
+                    time.sleep(max(0, timestamp - recordings[index - 1][0]) / args.replay_speed)
+
+                clock.set(timestamp)
+                recorder.replay(responses)
+                try:
+                    (status, output) = cls.run(opts, script_name)
+                finally:
+                    recorder.stop()
+                    clock.set(None)
+
+                statuses.append(status)
+                outputs.append("[%s] %s" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)), output))
+        finally:
+            shutil.rmtree(delta_directory, ignore_errors=True)
+
+        return (max(statuses, key=cls.STATUS_SEVERITY.index), '\n'.join(outputs))
+
     def _default_parser(self, description, version, author, timeout=None, hostname=None,
-            port=None, delta_file_path=None, delta_precision=None):
+            port=None, delta_file_path=None, delta_precision=None, snapshot_cache_dir=None, max_staleness=None):
         """
         Returns a default parser with common options that will be needed by most plugins.
         
@@ -438,6 +1375,17 @@ class NagiosPlugin(object):
             comma-separated warning and critical thresholds. Values must take the same form as in Nagios, e.g.
             08:00-14:00,14:00-24:00,00:00-08:00. Note 00:00 and 24:00 can be used interchangeably.""")
 
+        parser.add_argument('--record', default=argparse.SUPPRESS, metavar='DIR',
+            help="""Save the raw responses the check receives, and when it received them, to a new file in DIR
+            for replaying later.""")
+        parser.add_argument('--replay', default=argparse.SUPPRESS, metavar='DIR',
+            help="""Run the check once for each recording saved in DIR by --record, using the recorded
+            responses instead of making any requests and with the clock set to the time of the recording.
+            Exits with the most severe status of all of the checks.""")
+        parser.add_argument('--replay-speed', type=float, default=0,
+            help="""How many times faster than they were recorded to replay recordings, e.g. 1 to wait as long
+            between them as there was when recording. Default is 0, which replays them as fast as possible.""")
+
         if hostname != None:
             parser.add_argument('-H', '--hostname', nargs='?', default=hostname,
                 help="""Hostname of the machine to connect to.
@@ -463,6 +1411,24 @@ class NagiosPlugin(object):
                 raise NagiosPluginError("Delta file path given, but no delta precision. Please set the delta_precision\n"
                     + "parameter.")
 
+        if snapshot_cache_dir != None:
+            parser.add_argument('--cache-ttl', type=float, default=argparse.SUPPRESS,
+                help="""Share a snapshot of all of the server's statistics between checks for this many seconds.
+                Checks against the same server within the TTL read the snapshot instead of querying the server.
+                Disabled by default.""")
+            parser.add_argument('--cache-dir', nargs='?', default=snapshot_cache_dir,
+                help="""Directory to store shared snapshots in. They're kept in a subdirectory of it that only
+                the user running the check can access. Default is %s""" % snapshot_cache_dir)
+
+        if max_staleness != None:
+            parser.add_argument('--latency-budget', type=float, default=argparse.SUPPRESS,
+                help="""Seconds to wait for a fresh value. If the server takes longer the last known value is
+                returned and marked as stale, while the fetch carries on in the background to update it.
+                Disabled by default.""")
+            parser.add_argument('--max-staleness', type=float, nargs='?', default=max_staleness,
+                help="""Maximum age in seconds of a stale value before the check returns UNKNOWN instead.
+                Default is %d.""" % max_staleness)
+
         return parser
         
 
@@ -477,10 +1443,188 @@ class NagiosPlugin(object):
         @see ThresholdParser.get_thresholds_for_time for more details on rules for parameter values.
         """
         if warning or critical:
-            (warning, critical) = ThresholdParser.get_thresholds_for_time(warning, critical, time_periods, time.time())
+            (warning, critical) = ThresholdParser.get_thresholds_for_time(warning, critical, time_periods, clock.time())
 
             self.thresholds = Thresholds(warning, critical)
 
+    def _get_snapshot_cache(self, host, port, user=None):
+        """
+        Returns a SnapshotCache for the given server if the --cache-ttl option was given, otherwise None
+
+        @param user The user connecting to the server, if the statistics it can see depend on the user
+        """
+        # recorded checks must make their own requests for them to be recorded, and replayed checks none
+        if not hasattr(self.args, 'cache_ttl') or recorder.is_active():
+            return None
+
+        return SnapshotCache.for_server(self.args.cache_dir, self.SERVICE.lower(), host, port, self.args.cache_ttl,
+            user)
+
+    def _evaluate_within_latency_budget(self, statistic, evaluate):
+        """
+        Calls evaluate to get the value to report for a statistic, waiting at most --latency-budget seconds.
+
+        evaluate is run in a detached process so a slow server can't hold up the check. If it returns in time
+        its value is used, otherwise the last value known for the statistic is returned and the detached
+        process carries on in the background, recording its value for later checks when it finishes. While
+        it's running, later checks of the statistic return the last known value without starting another.
+
+        @param statistic The name of the statistic being reported, used to store its last known value
+        @param evaluate A callable taking no arguments that returns the value to report
+        @return tuple (value, age) where age is None if the value is fresh, otherwise the number of seconds
+            since the stale value was recorded.
+        @throws StaleStatisticError if evaluate took too long and there is no value younger than
+            --max-staleness
+        """
+        # responses made in the detached process couldn't be recorded, and replayed responses are never slow
+        if not hasattr(self.args, 'latency_budget') or recorder.is_active():
+            return (evaluate(), None)
+
+        lock = self._lock_refresh(statistic)
+        if lock == None:
+            # a detached process is still fetching the statistic, so don't pile another one up behind it
+            return self._get_last_known_value(statistic)
+
+        try:
+            (read_fd, write_fd) = os.pipe()
+            pid = os.fork()
+
+            if pid == 0:
+                # fork again so the process doing the work is never left as a zombie of ours. It inherits the
+                # lock, which is held until it exits.
+                os.close(read_fd)
+                os.setsid()
+                if os.fork() == 0:
+                    self._run_detached(statistic, evaluate, write_fd, lock)
+                os._exit(0)
+
+            os.close(write_fd)
+            os.waitpid(pid, 0)
+        finally:
+            lock.close()
+
+        try:
+            result = self._read_result(read_fd, time.time() + self.args.latency_budget)
+        finally:
+            os.close(read_fd)
+
+        if result == None:
+            return self._get_last_known_value(statistic)
+
+        (kind, value, additional_perfdata) = result
+        if kind == 'error':
+            raise value
+
+        # perfdata added while evaluating the statistic was added in the other process
+        if additional_perfdata != None:
+            self.additional_perfdata = additional_perfdata
+
+        return (value, None)
+
+    def _lock_refresh(self, statistic):
+        """
+        Returns a lock file for fetching the statistic in a detached process, or None if another process holds
+        it. The lock is released once every process the file is open in has closed it.
+
+        @throws NagiosPluginError if the lock file can't be opened
+        """
+        path = '%s.refresh_%s' % (self.args.delta_file, re.sub(r'[^\w.-]', '_', statistic))
+
+        try:
+            lock = open(path, 'a')
+        except IOError, error:
+            raise NagiosPluginError("Unable to open the lock file %s: %s" % (path, error))
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, error:
+            lock.close()
+            if error.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise NagiosPluginError("Unable to lock %s: %s" % (path, error))
+
+        return lock
+
+    def _run_detached(self, statistic, evaluate, write_fd, lock):
+        """
+        Runs in the detached process to evaluate the statistic, record it and pass it back. Never returns.
+
+        @param lock The lock file from _lock_refresh, released once the statistic is recorded
+        """
+        try:
+            # detach from the standard streams, otherwise nagios would wait for us to finish
+            null = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(null, fd)
+
+            try:
+                value = evaluate()
+                self.statistic_collection[self.LAST_KNOWN_PREFIX + statistic] = value
+                self.statistic_collection.persist()
+                result = pickle.dumps(('value', value, getattr(self, 'additional_perfdata', None)))
+            except Exception, error:
+                try:
+                    result = pickle.dumps(('error', error, None))
+                except pickle.PicklingError:
+                    result = pickle.dumps(('error', NagiosPluginError(str(error)), None))
+
+            # release the lock before passing the value back, so the next check can start a fetch
+            lock.close()
+
+            # the check may already have given up on us, in which case there's nobody to tell
+            try:
+                file = os.fdopen(write_fd, 'wb')
+                file.write(result)
+                file.close()
+            except (IOError, OSError):
+                pass
+        finally:
+            os._exit(0)
+
+    def _read_result(self, fd, deadline):
+        "Returns the unpickled result written to fd, or None if it isn't completely written by the deadline"
+        chunks = []
+
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+
+            (readable, writable, errored) = select.select([fd], [], [], remaining)
+            if not readable:
+                return None
+
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+
+        try:
+            return pickle.loads(''.join(chunks))
+        except (EOFError, ValueError, pickle.UnpicklingError):
+            raise NagiosPluginError("The process fetching the statistic exited without returning a value.")
+
+    def _get_last_known_value(self, statistic):
+        """
+        Returns a tuple (value, age) of the last value recorded for the statistic and its age in seconds.
+
+        @throws StaleStatisticError if no value is known or it's older than --max-staleness
+        """
+        last_known = self._get_value_from_last_invocation(self.LAST_KNOWN_PREFIX + statistic)
+
+        if not last_known:
+            raise StaleStatisticError("No value for %s was returned within %s seconds and no previous value is "
+                "known." % (statistic, self.args.latency_budget))
+
+        age = clock.time() - last_known['time']
+
+        if age > self.args.max_staleness:
+            raise StaleStatisticError("No value for %s was returned within %s seconds and the last known value is "
+                "%d seconds old." % (statistic, self.args.latency_budget, age))
+
+        return (last_known['value'], age)
+
     def get_status(self):
         "Returns the nagios status code for the latest check."
         return self.status
@@ -514,12 +1658,172 @@ class NagiosPlugin(object):
 
         return value
 
+    def _get_delta(self, statistic, current_value, persist=True):
+        """
+        Returns the change per second in a statistic since the previous invocation, and stores its current
+        value for the next one.
+
+        @param statistic The key to store the statistic under
+        @param current_value The statistic's current value
+        @param persist Whether to write the statistic collection to disk. Callers computing many deltas at
+            once can persist it themselves afterwards.
+        """
+        previous_value = self._get_value_from_last_invocation(statistic)
+        delta_value = 0
+
+        # calculate delta, catching division by zero errors
+        try:
+            delta = NumberUtils.string_to_number(current_value) - NumberUtils.string_to_number(previous_value['value'])
+            delta_time = round(clock.time() - previous_value['time'])
+            delta_value = round(delta / delta_time, self.args.delta_precision)
+        except (KeyError, ZeroDivisionError):
+            pass
+
+        self.statistic_collection[statistic] = current_value
+
+        if persist:
+            self._persist_statistics()
+
+        return delta_value
+
+    def _check_not_recording(self, statistics):
+        """
+        Raises an error while recording or replaying, for statistics whose requests aren't made through the
+        recorder. They would be made live during a replay, and nothing would be saved while recording.
+
+        @param statistics A description of the statistics, for the error message
+        @throws InvalidParameterError if the recorder is recording or replaying
+        """
+        if recorder.is_active():
+            raise InvalidParameterError("%s can't be recorded or replayed." % statistics)
+
+    def _forget_missing_instances(self, statistic, instances):
+        """
+        Deletes the values stored under INSTANCE:STATISTIC keys for instances of a statistic, such as cgroups
+        or mounts, that are missing from the current scan, so the delta file doesn't grow as instances come
+        and go. Other checks sharing the delta file may scan different instances, so values are only deleted
+        once they haven't been stored for FORGET_INSTANCES_AFTER seconds.
+
+        @param statistic The name of the statistic
+        @param instances The instances found by the current scan
+        """
+        suffix = ':' + statistic
+
+        for (key, stored) in self.statistic_collection.items():
+            if isinstance(key, basestring) and key.endswith(suffix) and key[:-len(suffix)] not in instances and \
+                    clock.time() - stored['time'] > self.FORGET_INSTANCES_AFTER:
+                del self.statistic_collection[key]
+
+    def _persist_statistics(self):
+        "Writes the statistic collection to the delta file"
+        try:
+            self.statistic_collection.persist()
+        except IOError, error:
+            raise NagiosPluginError("%s.\nProbably means we were unable to write to file %s" % (str(error), self.args.delta_file))
+
+    def _get_snapshot(self):
+        """
+        Returns a dictionary of every statistic the plugin can read in one go, for evaluating expressions.
+        Plugins that support expressions override this.
+        """
+        raise InvalidStatisticError("%s doesn't support expressions." % self.__class__.__name__)
+
+    def _get_expression_value(self, text):
+        """
+        Returns the value of an expression given instead of a statistic name, evaluated against a single
+        snapshot of statistics.
+
+        @param text The expression
+        """
+        if hasattr(self.args, 'delta_time'):
+            raise InvalidParameterError("--delta-time can't be used with expressions. Use rate() instead.")
+
+        return self._evaluate_expression(StatisticExpression.parse(text), self._get_snapshot())
+
+    def _evaluate_expression(self, expression, stats):
+        """
+        Returns the value of a StatisticExpression for a snapshot of statistics.
+
+        The values of statistics used by rate() and delta() are stored in the delta file under a key for the
+        expression, and the file is written once.
+
+        @param expression The StatisticExpression
+        @param stats A dictionary of statistics
+        """
+        key = self.EXPRESSION_PREFIX + expression.text
+        previous = self._get_value_from_last_invocation(key)
+        elapsed = None
+        if 'time' in previous:
+            elapsed = round(clock.time() - previous['time'])
+
+        value = round(expression.evaluate(stats, previous.get('value'), elapsed), self.args.delta_precision)
+
+        if self.args.verbose:
+            print "%s = %s" % (expression.text, value)
+
+        if expression.counters:
+            self.statistic_collection[key] = dict((name, stats[name]) for name in expression.counters)
+            self._persist_statistics()
+
+        return value
+
+    def _get_worst_value(self, values, lower_is_worse=False):
+        """
+        Returns a tuple of the key and value from a dictionary of values whose status is the worst when
+        compared to the thresholds, so one check can cover many instances of a statistic. Ties are broken by
+        how far past the critical threshold, or the warning threshold without one, each value is, so among
+        values that are OK the one closest to alerting is worst. Without thresholds the largest value is
+        worst.
+
+        @param values A dictionary of values keyed by what they were measured for
+        @param lower_is_worse Whether the smallest value is worst when there are no thresholds, e.g. for free
+            space
+        """
+        if not values:
+            raise InvalidStatisticError("There are no values to check.")
+
+        return max(values.iteritems(), key=lambda item: (self._calculate_status(item[1]),
+            self._get_distance_past_threshold(NumberUtils.string_to_number(item[1]), lower_is_worse)))
+
+    def _get_distance_past_threshold(self, value, lower_is_worse=False):
+        """
+        Returns how far a value is inside the range the critical threshold, or the warning threshold without
+        one, alerts for. It's negative when the value doesn't alert, and closer to 0 the closer it is.
+        Without thresholds it's the value, or the negated value if lower_is_worse.
+        """
+        for name in ('critical_values', 'warning_values'):
+            if hasattr(self, 'thresholds') and hasattr(self.thresholds, name):
+                (start, end, alert_inside_range) = getattr(self.thresholds, name)
+                if start == Maths.NEGATIVE_INFINITY:
+                    start = float('-inf')
+                if end == Maths.INFINITY:
+                    end = float('inf')
+
+                if alert_inside_range:
+                    return min(value - start, end - value)
+                return max(start - value, value - end)
+
+        if lower_is_worse:
+            return -value
+        return value
+
     def get_output(self):
         """
         Returns an output string for nagios. Prior to calling this method, self.statistic and
         self.statistic_value should have been set (probably in the 'check' method).
+
+        If self.additional_perfdata has been set to a list of (label, value) tuples, they're appended to the
+        perfdata after the checked statistic.
         """
         statistic = self._format_perfdata(self.statistic, self.statistic_value)
         output_statistic = statistic.replace("'", '')
-            
-        return "%s %s - %s | %s" % (self.SERVICE, self.STATUS_CODE_STRINGS[self.status], output_statistic, statistic)
\ No newline at end of file
+
+        if hasattr(self, 'stale_age') and self.stale_age != None:
+            output_statistic += " (stale, %ds old)" % self.stale_age
+
+        perfdata = statistic
+        if hasattr(self, 'additional_perfdata'):
+            for (label, value) in self.additional_perfdata:
+                perfdata += ' ' + self._format_perfdata(label, value)
+
+        return "%s %s - %s | %s" % (self.SERVICE, self.STATUS_CODE_STRINGS[self.status], output_statistic, perfdata)
\ No newline at end of file
@@ -1,9 +1,31 @@
 #!/bin/env python
 "Unit tests for nagiosplugin"
 
+import os
+import sys
+import re
 import time
+import errno
+import shutil
+import socket
+import threading
+import tempfile
 import unittest
+from StringIO import StringIO
 from nagiosplugin import *
+from check_logfile import LogFile, LogScanner
+from check_ram import RAM
+from check_disk import Disk, MountInfo, FilesystemStatistic
+from check_procs import Procs, ProcessScanner
+from check_nagios_aggregate import NagiosAggregate, StatusFile
+from nrpe_server import NRPEPacket, NRPEProtocolError, CommandTable, NRPEServer
+import forkserver
+
+try:
+    import check_mysql_stats
+except ImportError:
+    # MySQLdb isn't installed
+    check_mysql_stats = None
 
 class ThresholdParserTests(unittest.TestCase):
     "Tests for the ThresholdParser class"
@@ -257,5 +279,1321 @@ class ThresholdParserTests(unittest.TestCase):
             except AssertionError, error:
                 raise AssertionError(str(error) + ' for values: ' + str(values))
 
+class SnapshotCacheTests(unittest.TestCase):
+    "Tests for the SnapshotCache class"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fetches = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self):
+        self.fetches += 1
+        return {'cmd_get': self.fetches}
+
+    def testSnapshotIsSharedWithinTtl(self):
+        "get only calls fetch once while the stored snapshot is younger than the TTL"
+        cache = SnapshotCache.for_server(self.directory, 'memcached', 'localhost', 11211, 60)
+        self.assertEquals(cache.get(self.fetch), {'cmd_get': 1})
+
+        other_cache = SnapshotCache.for_server(self.directory, 'memcached', 'localhost', 11211, 60)
+        self.assertEquals(other_cache.get(self.fetch), {'cmd_get': 1})
+        self.assertEquals(self.fetches, 1)
+
+    def testExpiredSnapshotIsFetchedAgain(self):
+        "get calls fetch again once the stored snapshot is older than the TTL"
+        cache = SnapshotCache.for_server(self.directory, 'memcached', 'localhost', 11211, 0)
+        cache.get(self.fetch)
+        time.sleep(0.01)
+        self.assertEquals(cache.get(self.fetch), {'cmd_get': 2})
+
+    def testSnapshotsAreKeyedByServer(self):
+        "Snapshots for different servers are stored separately"
+        SnapshotCache.for_server(self.directory, 'memcached', 'localhost', 11211, 60).get(self.fetch)
+        SnapshotCache.for_server(self.directory, 'memcached', 'localhost', 11212, 60).get(self.fetch)
+        SnapshotCache.for_server(self.directory, 'mysql', 'localhost', 3306, 60, 'monitor').get(self.fetch)
+        SnapshotCache.for_server(self.directory, 'mysql', 'localhost', 3306, 60, 'admin').get(self.fetch)
+        self.assertEquals(self.fetches, 4)
+
+    def testSnapshotsAreKeptInAPrivateDirectory(self):
+        "Snapshots are stored in a directory only the current user can access"
+        cache = SnapshotCache.for_server(self.directory, 'memcached', 'localhost', 11211, 60)
+        cache.get(self.fetch)
+
+        private_directory = os.path.dirname(cache.path)
+        self.assertEquals(os.path.dirname(private_directory), self.directory)
+        self.assertEquals(os.stat(private_directory).st_mode & 0777, 0700)
+
+    def testSharedDirectoryIsRejected(self):
+        "A private directory that others can write to isn't used"
+        os.chmod(SnapshotCache.get_private_directory(self.directory), 0777)
+        self.assertRaises(NagiosPluginError, SnapshotCache.for_server, self.directory, 'memcached', 'localhost',
+            11211, 60)
+
+class LatencyBudgetTests(unittest.TestCase):
+    "Tests for NagiosPlugin._evaluate_within_latency_budget"
+
+    class Plugin(NagiosPlugin):
+        SERVICE = 'Test'
+
+        def parse_args(self, opts):
+            parser = self._default_parser(description='Test', version='0.1', author='Test',
+                delta_file_path='unused', delta_precision=2, max_staleness=60)
+            return parser.parse_args(opts)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.delta_file = os.path.join(self.directory, 'delta')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def getPlugin(self, *opts):
+        return self.Plugin(['--delta-file', self.delta_file] + list(opts))
+
+    def testWithoutBudgetValueIsFresh(self):
+        "Without a latency budget the value is evaluated directly"
+        self.assertEquals(self.getPlugin()._evaluate_within_latency_budget('stat', lambda: 5), (5, None))
+
+    def testFastValueIsFreshAndRecorded(self):
+        "A value returned within the budget is fresh and recorded as the last known value"
+        plugin = self.getPlugin('--latency-budget', '5')
+        self.assertEquals(plugin._evaluate_within_latency_budget('stat', lambda: 5), (5, None))
+        last_known = self.getPlugin()._get_value_from_last_invocation(NagiosPlugin.LAST_KNOWN_PREFIX + 'stat')
+        self.assertEquals(last_known['value'], 5)
+
+    def testSlowValueReturnsLastKnownValue(self):
+        "A value not returned within the budget is replaced by the last known value"
+        self.getPlugin('--latency-budget', '5')._evaluate_within_latency_budget('stat', lambda: 5)
+
+        def slow():
+            time.sleep(0.5)
+            return 6
+
+        (value, age) = self.getPlugin('--latency-budget', '0.05')._evaluate_within_latency_budget('stat', slow)
+        self.assertEquals(value, 5)
+        self.assertTrue(age >= 0)
+
+        # the detached fetch records its value once it finishes
+        time.sleep(1)
+        last_known = self.getPlugin()._get_value_from_last_invocation(NagiosPlugin.LAST_KNOWN_PREFIX + 'stat')
+        self.assertEquals(last_known['value'], 6)
+
+    def testRefreshIsSkippedWhileOneIsRunning(self):
+        "No detached fetch is started while one for the same statistic is still running"
+        self.getPlugin('--latency-budget', '5')._evaluate_within_latency_budget('stat', lambda: 5)
+
+        def slow():
+            time.sleep(0.5)
+            return 6
+
+        self.getPlugin('--latency-budget', '0.05')._evaluate_within_latency_budget('stat', slow)
+        (value, age) = self.getPlugin('--latency-budget', '5')._evaluate_within_latency_budget('stat', lambda: 7)
+        self.assertEquals(value, 5)
+        self.assertTrue(age >= 0)
+
+        time.sleep(1)
+        last_known = self.getPlugin()._get_value_from_last_invocation(NagiosPlugin.LAST_KNOWN_PREFIX + 'stat')
+        self.assertEquals(last_known['value'], 6)
+
+    def testDetachedFetchKeepsOtherStatistics(self):
+        "A detached fetch only writes back its own statistic, not the rest of the collection it started with"
+        def slow():
+            time.sleep(0.5)
+            return 6
+
+        plugin = self.getPlugin('--latency-budget', '0.05')
+        self.assertRaises(StaleStatisticError, lambda: plugin._evaluate_within_latency_budget('slow', slow))
+
+        plugin = self.getPlugin()
+        plugin.statistic_collection['other'] = 1
+        plugin.statistic_collection.persist()
+
+        time.sleep(1)
+        collection = TimestampedStatisticCollection(self.delta_file)
+        self.assertEquals(collection['other']['value'], 1)
+        self.assertEquals(collection[NagiosPlugin.LAST_KNOWN_PREFIX + 'slow']['value'], 6)
+
+    def testSlowValueWithoutLastKnownValue(self):
+        "A StaleStatisticError is raised if a value isn't returned in time and none is known"
+        plugin = self.getPlugin('--latency-budget', '0.05')
+        self.assertRaises(StaleStatisticError, lambda: plugin._evaluate_within_latency_budget('stat',
+            lambda: time.sleep(0.5)))
+
+    def testErrorsAreRaised(self):
+        "Errors raised while evaluating the value are raised by the check"
+        def fail():
+            raise UnexpectedResponseError('broken')
+
+        plugin = self.getPlugin('--latency-budget', '5')
+        self.assertRaises(UnexpectedResponseError, lambda: plugin._evaluate_within_latency_budget('stat', fail))
+
+class WorstValueTests(unittest.TestCase):
+    "Tests for NagiosPlugin._get_worst_value"
+
+    class Plugin(NagiosPlugin):
+        SERVICE = 'Test'
+
+        def parse_args(self, opts):
+            parser = self._default_parser(description='Test', version='0.1', author='Test',
+                delta_file_path='unused', delta_precision=2)
+            return parser.parse_args(opts)
+
+    def testWorstStatusWins(self):
+        "The value with the worst status is returned even if it isn't the largest"
+        plugin = self.Plugin(['-w', '10:20', '-c', '5:'])
+        self.assertEquals(plugin._get_worst_value({'a': 15, 'b': 30, 'c': 2}), ('c', 2))
+
+    def testTiesAreBrokenByLargestValue(self):
+        "Values with the same status are compared by size"
+        plugin = self.Plugin([])
+        self.assertEquals(plugin._get_worst_value({'a': 1, 'b': '3', 'c': 2}), ('b', '3'))
+
+    def testLowerIsWorseWithoutThresholds(self):
+        "Without thresholds the smallest value is worst for statistics where lower is worse"
+        plugin = self.Plugin([])
+        self.assertEquals(plugin._get_worst_value({'a': 1, 'b': '3', 'c': 2}, lower_is_worse=True), ('a', 1))
+
+    def testTiesAreBrokenByDistanceToThreshold(self):
+        "Values with the same status are compared by how close they are to alerting"
+        self.assertEquals(self.Plugin(['-c', '10:'])._get_worst_value({'a': 50, 'b': 12, 'c': 30}), ('b', 12))
+        self.assertEquals(self.Plugin(['-w', '10:', '-c', '5:'])._get_worst_value({'a': 8, 'b': 6, 'c': 30}),
+            ('b', 6))
+        self.assertEquals(self.Plugin(['-w', '80'])._get_worst_value({'a': 50, 'b': 12, 'c': 70}), ('c', 70))
+        self.assertEquals(self.Plugin(['-c', '10:20'])._get_worst_value({'a': 15, 'b': 19, 'c': 12}), ('b', 19))
+        self.assertEquals(self.Plugin(['-c', '@10:20'])._get_worst_value({'a': 15, 'b': 19, 'c': 25}), ('a', 15))
+
+    def testNoValues(self):
+        "An empty dictionary has no worst value"
+        self.assertRaises(InvalidStatisticError, self.Plugin([])._get_worst_value, {})
+
+
+class ForgetMissingInstancesTests(unittest.TestCase):
+    "Tests for NagiosPlugin._forget_missing_instances"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.delta_file = os.path.join(self.directory, 'delta')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        clock.set(None)
+
+    def getPlugin(self):
+        return WorstValueTests.Plugin(['--delta-file', self.delta_file])
+
+    def testMissingInstancesAreForgotten(self):
+        "Values of instances missing for longer than FORGET_INSTANCES_AFTER are removed from the delta file"
+        clock.set(1000)
+        plugin = self.getPlugin()
+        for key in ('/gone:cgroup_memory_current', '/kept:cgroup_memory_current', '/gone:cgroup_memory_max',
+                'cgroup_memory_current'):
+            plugin.statistic_collection[key] = 1
+        plugin._persist_statistics()
+
+        clock.set(1000 + NagiosPlugin.FORGET_INSTANCES_AFTER + 1)
+        plugin = self.getPlugin()
+        plugin._get_delta('/kept:cgroup_memory_current', 2, persist=False)
+        plugin._forget_missing_instances('cgroup_memory_current', {'/kept': 1})
+        plugin._persist_statistics()
+
+        self.assertEquals(sorted(TimestampedStatisticCollection(self.delta_file).keys()),
+            ['/gone:cgroup_memory_max', '/kept:cgroup_memory_current', 'cgroup_memory_current'])
+
+    def testRecentlyStoredInstancesAreKept(self):
+        "Values stored recently may belong to another check scanning different instances, so are kept"
+        clock.set(1000)
+        plugin = self.getPlugin()
+        plugin.statistic_collection['/other:cgroup_memory_current'] = 1
+        plugin._persist_statistics()
+
+        clock.set(2000)
+        plugin = self.getPlugin()
+        plugin._forget_missing_instances('cgroup_memory_current', {'/kept': 1})
+        plugin._persist_statistics()
+
+        self.assertEquals(TimestampedStatisticCollection(self.delta_file).keys(), ['/other:cgroup_memory_current'])
+
+class RunTests(unittest.TestCase):
+    "Tests for NagiosPlugin.run and load_plugin_class"
+
+    class Plugin(NagiosPlugin):
+        SERVICE = 'Test'
+
+        def __init__(self, opts):
+            self.status = self.STATUS_UNKNOWN
+            self.args = self.parse_args(opts)
+            self.set_thresholds(self.args.warning, self.args.critical, self.args.time_periods)
+
+        def parse_args(self, opts):
+            parser = self._default_parser(description='Test', version='0.1', author='Test')
+            parser.add_argument('-s', '--statistic', nargs='?', required=True)
+            return parser.parse_args(opts)
+
+        def check(self):
+            if self.args.statistic == 'broken':
+                raise UnexpectedResponseError('The server sent nonsense')
+            if self.args.statistic == 'missing':
+                raise InvalidStatisticError('No statistic called missing')
+
+            self.statistic = self.args.statistic
+            self.statistic_value = 15
+            self.status = self._calculate_status(self.statistic_value)
+
+    def testRunReturnsStatusAndOutput(self):
+        "run returns the status and output of the check"
+        self.assertEquals(self.Plugin.run(['-s', 'stat', '-w', '10']),
+            (NagiosPlugin.STATUS_WARNING, "Test WARNING - stat=15 | 'stat'=15"))
+
+    def testRunReturnsUnknownForInvalidStatistics(self):
+        "run returns UNKNOWN with the error message for invalid statistics"
+        self.assertEquals(self.Plugin.run(['-s', 'missing']),
+            (NagiosPlugin.STATUS_UNKNOWN, 'No statistic called missing'))
+
+    def testRunReturnsUnknownForErrors(self):
+        "run returns UNKNOWN with an explanation when the plugin fails"
+        (status, output) = self.Plugin.run(['-s', 'broken'], 'check_test.py')
+        self.assertEquals(status, NagiosPlugin.STATUS_UNKNOWN)
+        self.assertEquals(output, "check_test.py failed unexpectedly. Error was:\nThe server sent nonsense")
+
+    def testLoadUnknownPluginClass(self):
+        "load_plugin_class raises an InvalidParameterError for unknown plugins"
+        self.assertRaises(InvalidParameterError, lambda: load_plugin_class('check_nothing.py'))
+
+class NRPEPacketTests(unittest.TestCase):
+    "Tests for the NRPEPacket class in nrpe_server.py"
+
+    def setUp(self):
+        (self.client, self.server) = socket.socketpair()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def assertRoundTrip(self, version):
+        "A packet read from a socket is the packet encoded, and nothing is left unread"
+        self.client.sendall(NRPEPacket(version, NRPEPacket.TYPE_RESPONSE, 1, 'RAM WARNING - free=10').encode())
+        self.client.shutdown(socket.SHUT_WR)
+
+        packet = NRPEPacket.read(self.server)
+        self.assertEquals((packet.version, packet.type, packet.result_code, packet.buffer),
+            (version, NRPEPacket.TYPE_RESPONSE, 1, 'RAM WARNING - free=10'))
+        self.assertEquals(self.server.recv(1), '')
+
+    def testVersion2RoundTrip(self):
+        "Version 2 packets are read back as they were encoded"
+        self.assertRoundTrip(NRPEPacket.VERSION_2)
+
+    def testVersion3RoundTrip(self):
+        "Version 3 packets are read back as they were encoded, including their trailing padding"
+        self.assertRoundTrip(NRPEPacket.VERSION_3)
+
+    def testInvalidChecksum(self):
+        "Packets whose checksum doesn't match are rejected"
+        data = NRPEPacket(NRPEPacket.VERSION_3, NRPEPacket.TYPE_QUERY, 0, 'check_ram').encode()
+        self.client.sendall(data[:-5] + 'x' + data[-4:])
+        self.assertRaises(NRPEProtocolError, lambda: NRPEPacket.read(self.server))
+
+    def testTruncatedPacket(self):
+        "Packets cut short by the connection closing are rejected"
+        self.client.sendall(NRPEPacket(NRPEPacket.VERSION_2, NRPEPacket.TYPE_QUERY, 0, 'check_ram').encode()[:100])
+        self.client.shutdown(socket.SHUT_WR)
+        self.assertRaises(NRPEProtocolError, lambda: NRPEPacket.read(self.server))
+
+class CommandTableTests(unittest.TestCase):
+    "Tests for the CommandTable class in nrpe_server.py"
+
+    def testOnlyKnownPluginsCanBeDefined(self):
+        "Commands must run one of the plugins in PLUGINS"
+        self.assertRaises(InvalidParameterError, lambda: CommandTable().add('check_shell', '/bin/sh -c id'))
+
+    def testOnlyDefinedCommandsCanBeRun(self):
+        "Queries for commands that aren't defined are rejected"
+        commands = CommandTable()
+        commands.add('check_net', 'check_net.py -s Tcp_RetransSegs')
+        self.assertRaises(InvalidParameterError, lambda: commands.resolve('check_ram'))
+
+    def testCommandsAreResolved(self):
+        "Defined commands resolve to their plugin class, script name and options"
+        commands = CommandTable()
+        commands.add('check_net', '/usr/lib/nagios/plugins/check_net.py -s Tcp_RetransSegs -w 10')
+        (plugin_class, script_name, opts) = commands.resolve('check_net')
+
+        self.assertEquals(plugin_class.__name__, 'Net')
+        self.assertEquals(script_name, 'check_net.py')
+        self.assertEquals(opts, ['-s', 'Tcp_RetransSegs', '-w', '10'])
+
+    def testArgumentsAreRejectedByDefault(self):
+        "Arguments sent by clients are rejected unless allowed"
+        commands = CommandTable()
+        commands.add('check_net', 'check_net.py -s $ARG1$')
+        self.assertRaises(InvalidParameterError, lambda: commands.resolve('check_net!Tcp_RetransSegs'))
+
+    def testArgumentsAreSubstituted(self):
+        "Allowed arguments replace their macros, and macros without an argument are removed"
+        commands = CommandTable(allow_arguments=True)
+        commands.add('check_net', "check_net.py -s $ARG1$ -w '$ARG2$' -c $ARG3$")
+        self.assertEquals(commands.resolve('check_net!Tcp_RetransSegs!10:')[2],
+            ['-s', 'Tcp_RetransSegs', '-w', '10:', '-c', ''])
+
+class NRPEServerTests(unittest.TestCase):
+    "Tests for the NRPEServer class in nrpe_server.py"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'net'))
+        file = open(os.path.join(self.directory, 'net', 'snmp'), 'w')
+        file.write("Tcp: ActiveOpens RetransSegs\nTcp: 10 25\n")
+        file.close()
+
+        commands = CommandTable(allow_arguments=True)
+        commands.add('check_net', 'check_net.py --proc-path %s -s $ARG1$ -w 20' % self.directory)
+        commands.add('check_net_invalid', 'check_net.py --no-such-option')
+        self.nrpe_server = NRPEServer(commands, '127.0.0.1', 0, 1, 5)
+
+    def tearDown(self):
+        self.nrpe_server.stop()
+        shutil.rmtree(self.directory)
+
+    def query(self, buffer, version):
+        "Sends a query to the server and returns the response packet"
+        (client, server) = socket.socketpair()
+        try:
+            client.sendall(NRPEPacket(version, NRPEPacket.TYPE_QUERY, 0, buffer).encode())
+            self.nrpe_server.handle(server)
+            return NRPEPacket.read(client)
+        finally:
+            client.close()
+
+    def testChecksAreRun(self):
+        "Queries run the check and return its status and output in a packet of the same version"
+        for version in (NRPEPacket.VERSION_2, NRPEPacket.VERSION_3):
+            response = self.query('check_net!Tcp_RetransSegs', version)
+            self.assertEquals((response.version, response.type), (version, NRPEPacket.TYPE_RESPONSE))
+            self.assertEquals(response.result_code, NagiosPlugin.STATUS_WARNING)
+            self.assertTrue(response.buffer.startswith('Net WARNING - Tcp_RetransSegs=25'), response.buffer)
+
+    def testVersionQuery(self):
+        "The version query is answered without running a check"
+        response = self.query(NRPEServer.VERSION_QUERY, NRPEPacket.VERSION_2)
+        self.assertEquals((response.result_code, response.buffer), (NagiosPlugin.STATUS_OK, NRPEServer.VERSION))
+
+    def testUndefinedCommands(self):
+        "Queries for undefined commands return UNKNOWN"
+        self.assertEquals(self.nrpe_server.run('check_ram'),
+            (NagiosPlugin.STATUS_UNKNOWN, "Command 'check_ram' is not defined."))
+
+    def testInvalidArguments(self):
+        "Plugins exiting because of invalid arguments return UNKNOWN instead of stopping the server"
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            (status, output) = self.nrpe_server.run('check_net_invalid')
+        finally:
+            sys.stderr = stderr
+
+        self.assertEquals(status, NagiosPlugin.STATUS_UNKNOWN)
+        self.assertTrue(output.startswith('Invalid arguments for check_net.py'), output)
+
+class WorkerTests(unittest.TestCase):
+    "Tests for the Worker class in forkserver.py"
+
+    class Plugin(RunTests.Plugin):
+        "Records the arguments and environment it sees"
+        seen = None
+
+        def check(self):
+            WorkerTests.Plugin.seen = (list(sys.argv), os.environ.get('CHECK_VARIABLE'))
+            print >> sys.stderr, "checking %s" % self.args.statistic
+
+            if self.args.statistic == 'slow':
+                time.sleep(2)
+            if self.args.statistic == 'exit':
+                sys.exit('exiting')
+
+            RunTests.Plugin.check(self)
+
+    def setUp(self):
+        self.load_plugin_class = forkserver.load_plugin_class
+        forkserver.load_plugin_class = lambda script: self.Plugin
+        self.worker = forkserver.Worker(None)
+        os.environ['WORKER_VARIABLE'] = 'worker'
+
+    def tearDown(self):
+        forkserver.load_plugin_class = self.load_plugin_class
+        del os.environ['WORKER_VARIABLE']
+
+    def handle(self, args, timeout=10):
+        "Runs a check in the worker as if requested with the given arguments"
+        return self.worker.handle({'argv': [u'/usr/lib/nagios/plugins/check_test.py'] + args,
+            'env': {u'CHECK_VARIABLE': u'check'}, 'deadline': time.time() + timeout})
+
+    def testOutputIsCaptured(self):
+        "The check's status, stdout and stderr are returned"
+        self.assertEquals(self.handle([u'-s', u'stat', u'-w', u'10']), {'status': NagiosPlugin.STATUS_WARNING,
+            'stdout': "Test WARNING - stat=15 | 'stat'=15\n", 'stderr': "checking stat\n"})
+
+    def testArgvAndEnvironment(self):
+        "The check sees the request's argv and environment, and the worker's are restored afterwards"
+        (argv, stdout, environ) = (list(sys.argv), sys.stdout, dict(os.environ))
+        self.handle([u'-s', u'stat'])
+
+        self.assertEquals(self.Plugin.seen, (['/usr/lib/nagios/plugins/check_test.py', '-s', 'stat'], 'check'))
+        self.assertEquals((sys.argv, sys.stdout, dict(os.environ)), (argv, stdout, environ))
+        self.assertEquals(os.environ['WORKER_VARIABLE'], 'worker')
+
+    def testSystemExit(self):
+        "Exit codes are passed on, and exits without an integer code are UNKNOWN"
+        self.assertEquals(self.handle([u'--no-such-option'])['status'], 2)
+        self.assertEquals(self.handle([u'-s', u'exit'])['status'], NagiosPlugin.STATUS_UNKNOWN)
+
+    def testPassedDeadline(self):
+        "Checks whose deadline has already passed aren't run"
+        self.Plugin.seen = None
+        response = self.handle([u'-s', u'stat'], timeout=-1)
+
+        self.assertEquals(response['status'], NagiosPlugin.STATUS_UNKNOWN)
+        self.assertTrue('timed out' in response['stdout'], response['stdout'])
+        self.assertEquals(self.Plugin.seen, None)
+
+    def testDeadlineInterruptsChecks(self):
+        "Checks still running at the deadline are interrupted and return UNKNOWN"
+        start = time.time()
+        response = self.handle([u'-s', u'slow'], timeout=0.2)
+
+        self.assertTrue(time.time() - start < 1)
+        self.assertEquals(response['status'], NagiosPlugin.STATUS_UNKNOWN)
+        self.assertTrue('timed out' in response['stdout'], response['stdout'])
+
+class CheckResultSpoolTests(unittest.TestCase):
+    "Tests for the CheckResultSpool class"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testResultsAreBatched(self):
+        "Results are only written once batch_size of them have been added, all to one file"
+        spool = CheckResultSpool(self.directory, batch_size=2)
+        spool.add_result('web1', 'RAM', NagiosPlugin.STATUS_OK, "RAM OK - free=10 | 'free'=10", 1300000000.5)
+        self.assertEquals(os.listdir(self.directory), [])
+
+        spool.add_result('web2', None, NagiosPlugin.STATUS_CRITICAL, "Down\nreally", 1300000001)
+        names = sorted(os.listdir(self.directory))
+        self.assertEquals(len(names), 2)
+        self.assertEquals(names[0] + '.ok', names[1])
+        self.assertEquals(len(names[0]), 7)
+
+        contents = open(os.path.join(self.directory, names[0])).read()
+        self.assertTrue("host_name=web1\nservice_description=RAM\n" in contents)
+        self.assertTrue("start_time=1300000000.500000\n" in contents)
+        self.assertTrue("host_name=web2\ncheck_type=1\n" in contents)
+        self.assertTrue("return_code=2\noutput=Down\\nreally\n" in contents)
+
+    def testFlushWritesRemainingResults(self):
+        "flush writes buffered results even if there are fewer than batch_size"
+        spool = CheckResultSpool(self.directory, batch_size=10)
+        spool.add_result('web1', 'RAM', NagiosPlugin.STATUS_OK, "RAM OK")
+        spool.flush()
+        self.assertEquals(len(os.listdir(self.directory)), 2)
+
+    def testFullSpoolRaisesError(self):
+        "flush raises a SpoolFullError if the spool stays full, keeping the results buffered"
+        spool = CheckResultSpool(self.directory, batch_size=10, max_files=1, full_timeout=0.05)
+        spool.add_result('web1', 'RAM', NagiosPlugin.STATUS_OK, "RAM OK")
+        spool.flush()
+        spool.add_result('web1', 'RAM', NagiosPlugin.STATUS_OK, "RAM OK")
+        self.assertRaises(SpoolFullError, spool.flush)
+        self.assertEquals(len(spool.results), 1)
+
+class HistogramTests(unittest.TestCase):
+    "Tests for the Histogram class"
+
+    def testPercentiles(self):
+        "percentile returns values within the bucket the percentile falls in"
+        histogram = Histogram([10, 20, 30, 40])
+        for value in range(1, 41):
+            histogram.add(value)
+
+        self.assertEquals(histogram.count, 40)
+        self.assertEquals(histogram.percentile(50), 20)
+        self.assertEquals(histogram.percentile(100), 40)
+        self.assertTrue(30 < histogram.percentile(90) <= 40)
+        self.assertEquals(histogram.mean(), 20.5)
+
+    def testOverflowBucketUsesMaximum(self):
+        "Values above the last bound are reported up to the largest value seen"
+        histogram = Histogram.exponential(1, 2, 4)
+        histogram.add(1)
+        histogram.add(100)
+        self.assertEquals(histogram.percentile(100), 100)
+
+    def testEmptyHistogram(self):
+        "percentile returns 0 when no values have been added"
+        self.assertEquals(Histogram([1, 2]).percentile(99), 0)
+
+    def testInitialCounts(self):
+        "Histograms can be created from existing bucket counts"
+        histogram = Histogram([10, 20], [0, 10, 0])
+        self.assertEquals(histogram.percentile(50), 15)
+        self.assertRaises(InvalidParameterError, lambda: Histogram([10, 20], [1, 2]))
+
+
+class TopCounterTests(unittest.TestCase):
+    "Tests for the TopCounter class"
+
+    def testCountsExactlyWithinSize(self):
+        "Counts are exact while there are no more keys than the counter's size"
+        counter = TopCounter(3)
+        for key in ['a', 'b', 'a', 'c', 'a', 'b']:
+            counter.add(key)
+
+        self.assertEquals(counter.top(2), [('a', 3), ('b', 2)])
+
+    def testKeepsHeavyKeys(self):
+        "Keys that make up a large share of the stream are kept when there are more keys than the size"
+        counter = TopCounter(5)
+        for i in range(1000):
+            counter.add('heavy', 10)
+            counter.add('light%d' % i)
+
+        self.assertEquals(counter.top(1)[0][0], 'heavy')
+        self.assertTrue(counter.top(1)[0][1] >= 10000)
+        self.assertEquals(len(counter.counts), 5)
+
+
+class StatisticExpressionTests(unittest.TestCase):
+    "Tests for the StatisticExpression class"
+
+    def testArithmetic(self):
+        "Statistics are converted to floats so division isn't truncated"
+        expression = StatisticExpression('(Threads_created + 1) * 100 / Connections')
+        self.assertEquals(expression.evaluate({'Threads_created': '4', 'Connections': '20'}), 25.0)
+        self.assertEquals(expression.names, set(['Threads_created', 'Connections']))
+        self.assertEquals(expression.counters, set())
+
+    def testRateAndDelta(self):
+        "rate() and delta() compare statistics with their previous values"
+        expression = StatisticExpression('rate(get_hits) * 100 / rate(cmd_get) + delta(get_hits)')
+        stats = {'get_hits': '90', 'cmd_get': '200'}
+        self.assertEquals(expression.counters, set(['get_hits', 'cmd_get']))
+        self.assertEquals(expression.evaluate(stats, {'get_hits': '50', 'cmd_get': '100'}, 10), 80.0)
+
+    def testRateWithoutPreviousValues(self):
+        "rate() is 0 without previous values, and division by zero gives 0"
+        expression = StatisticExpression('get_hits / rate(cmd_get)')
+        self.assertEquals(expression.evaluate({'get_hits': '5', 'cmd_get': '10'}), 0)
+
+    def testUnsafeExpressions(self):
+        "Anything other than arithmetic on statistics is rejected"
+        for text in ['__import__("os")', 'a.b', 'a ** 9', 'rate(a, b)', 'rate(1)', 'a[0]', 'a +', 'lambda: 1']:
+            self.assertRaises(InvalidStatisticError, StatisticExpression, text)
+
+    def testUnknownStatistic(self):
+        "Statistics missing from the snapshot are an error"
+        self.assertRaises(InvalidStatisticError, StatisticExpression('a / b').evaluate, {'a': 1})
+
+    def testIsExpression(self):
+        "Names of single statistics aren't expressions"
+        self.assertFalse(StatisticExpression.is_expression('Threads_created'))
+        self.assertTrue(StatisticExpression.is_expression('rate(cmd_get)'))
+
+    def testParsedExpressionsAreCachedWithinALimit(self):
+        "Parsed expressions are reused, and the cache never holds more than MAX_PARSED of them"
+        expression = StatisticExpression.parse('a + 1')
+        self.assertTrue(StatisticExpression.parse('a + 1') is expression)
+
+        for i in range(StatisticExpression.MAX_PARSED * 2):
+            StatisticExpression.parse('a + %d' % i)
+            self.assertTrue(len(StatisticExpression._parsed) <= StatisticExpression.MAX_PARSED)
+
+class RecorderTests(unittest.TestCase):
+    "Tests for the Recorder class and NagiosPlugin's --record and --replay options"
+
+    class Plugin(NagiosPlugin):
+        SERVICE = 'Test'
+        counter = 0
+
+        def parse_args(self, opts):
+            parser = self._default_parser(description='Test', version='0.1', author='Test',
+                delta_file_path='/nonexistent', delta_precision=2)
+            parser.add_argument('-s', '--statistic', nargs='?', required=True)
+            return parser.parse_args(opts)
+
+        def fetch(self):
+            if self.counter < 0:
+                raise UnexpectedResponseError('The server sent nonsense')
+            return self.counter
+
+        def check(self):
+            self.statistic = self.args.statistic
+            self.statistic_value = self._get_delta(self.statistic, recorder.fetch('counter', self.fetch))
+            self.status = self._calculate_status(self.statistic_value)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.opts = ['-s', 'counter', '--delta-file', os.path.join(self.directory, 'delta')]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        recorder.stop()
+        clock.set(None)
+
+    def testReplayReturnsRecordedResponses(self):
+        "Replayed responses are returned in the order they were recorded without making requests"
+        recorder.record()
+        self.assertEquals([recorder.fetch('stats', lambda: value) for value in (1, 2)], [1, 2])
+        recorder.save(self.directory, 1000)
+        recorder.stop()
+
+        [(timestamp, responses)] = Recorder.load(self.directory)
+        self.assertEquals(timestamp, 1000)
+
+        recorder.replay(responses)
+        self.assertEquals(recorder.fetch('stats', lambda: 5), 1)
+        self.assertEquals(recorder.fetch('stats', lambda: 5), 2)
+        self.assertRaises(ReplayError, recorder.fetch, 'stats', lambda: 5)
+
+    def testReplayRaisesRecordedErrors(self):
+        "Errors raised while recording are raised again when replaying"
+        def fail():
+            raise UnexpectedResponseError('The server sent nonsense')
+
+        recorder.record()
+        self.assertRaises(UnexpectedResponseError, recorder.fetch, 'stats', fail)
+        recorder.replay(recorder.responses)
+        self.assertRaises(UnexpectedResponseError, recorder.fetch, 'stats', lambda: 1)
+
+    def testReplayedDeltasUseRecordedTimes(self):
+        "Checks are replayed with the clock at the time of each recording, in a delta file of their own"
+        for (timestamp, counter) in ((1000, 10), (1010, 60), (1020, -1)):
+            clock.set(timestamp)
+            self.Plugin.counter = counter
+            self.Plugin.run(self.opts + ['--record', self.directory])
+
+        self.Plugin.counter = 0
+        (status, output) = self.Plugin.run(self.opts + ['--replay', self.directory, '-w', '4'], 'check_test.py')
+        lines = output.splitlines()
+
+        self.assertEquals(status, NagiosPlugin.STATUS_UNKNOWN)
+        self.assertTrue(lines[0].endswith("Test OK - counter=0 | 'counter'=0"))
+        self.assertTrue(lines[1].endswith("Test WARNING - counter=5.0 | 'counter'=5.0"))
+        self.assertTrue(lines[2].endswith("check_test.py failed unexpectedly. Error was:"))
+        self.assertEquals(lines[3], "The server sent nonsense")
+
+    def testReplayReportsCriticalOverUnknown(self):
+        "The status of a replay is the most severe of its checks, and CRITICAL is worse than UNKNOWN"
+        for (timestamp, counter) in ((1000, 10), (1010, 60), (1020, -1)):
+            clock.set(timestamp)
+            self.Plugin.counter = counter
+            self.Plugin.run(self.opts + ['--record', self.directory])
+
+        (status, output) = self.Plugin.run(self.opts + ['--replay', self.directory, '-c', '4'])
+        self.assertEquals(status, NagiosPlugin.STATUS_CRITICAL)
+
+    def testRecordingIsPerThread(self):
+        "Recording in one thread doesn't record, or change the clock of, checks in other threads"
+        def record():
+            recorder.record()
+            clock.set(1000)
+            recorder.fetch('stats', lambda: 1)
+
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+
+        self.assertFalse(recorder.is_active())
+        self.assertEquals(recorder.fetch('stats', lambda: 2), 2)
+        self.assertNotEquals(clock.time(), 1000)
+
+class PluginReplayTests(unittest.TestCase):
+    "Tests that plugins replay what they recorded without reading anything live"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.live = os.path.join(self.directory, 'live')
+        self.recordings = os.path.join(self.directory, 'recordings')
+        os.mkdir(self.live)
+        os.mkdir(self.recordings)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        recorder.stop()
+        clock.set(None)
+
+    def write(self, name, text, mode='w'):
+        "Writes a file below the live directory, creating the directories it's in"
+        path = os.path.join(self.live, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        file = open(path, mode)
+        file.write(text)
+        file.close()
+        return path
+
+    def assertReplaysRecording(self, plugin_class, opts, change=None):
+        """
+        Records two checks ten seconds apart, calling change in between, then replays them with everything
+        they read deleted and asserts the replay has the same results
+        """
+        opts = list(opts) + ['--delta-file', os.path.join(self.directory, 'delta')]
+        outputs = []
+
+        for timestamp in (1000, 1010):
+            clock.set(timestamp)
+            (status, output) = plugin_class.run(opts + ['--record', self.recordings])
+            outputs.append(output)
+            if change:
+                change()
+        clock.set(None)
+
+        shutil.rmtree(self.live)
+        (status, output) = plugin_class.run(opts + ['--replay', self.recordings])
+
+        self.assertEquals([line.split('] ', 1)[1] for line in output.splitlines()], outputs)
+        return outputs
+
+    def testProcs(self):
+        "Process scans are replayed"
+        for pid in (100, 150):
+            self.write('proc/%d/stat' % pid, '%d (my app) S%s 3 0 0 0 100 0\n' % (pid, ' 0' * 16))
+        self.write('proc/sys/kernel/threads-max', '60\n')
+
+        outputs = self.assertReplaysRecording(Procs, ['--proc-path', os.path.join(self.live, 'proc'),
+            '--command', 'my app', '-s', 'threads_used_percentage'])
+        self.assertTrue(outputs[0].startswith('Procs OK - threads_used_percentage=10.0'), outputs[0])
+
+    def testProcessMemory(self):
+        "Scans of the memory used by processes are replayed"
+        self.write('proc/100/stat', '100 (my app) S%s 3 0 0 0 100 0\n' % (' 0' * 16))
+
+        outputs = self.assertReplaysRecording(RAM, ['--proc-path', os.path.join(self.live, 'proc'),
+            '-s', 'process_total_rss'])
+        rss = 100 * os.sysconf('SC_PAGE_SIZE') / 1024
+        self.assertTrue(outputs[0].startswith('RAM OK - process_total_rss=%d' % rss), outputs[0])
+
+    def testDisk(self):
+        "Mounts and their usage are replayed"
+        os.mkdir(os.path.join(self.live, 'data'))
+        mountinfo = self.write('mountinfo', '26 22 0:46 / %s rw,relatime shared:4 - ext4 /dev/sdd1 rw\n' %
+            os.path.join(self.live, 'data'))
+
+        outputs = self.assertReplaysRecording(Disk, ['--mountinfo', mountinfo, '-s', 'inodes_free'])
+        self.assertTrue(outputs[0].startswith('Disk OK - inodes_free='), outputs[0])
+
+    def testLogFile(self):
+        "What was counted in a log file is replayed"
+        logfile = self.write('app.log', 'ERROR before\n')
+
+        outputs = self.assertReplaysRecording(LogFile, ['--logfile', logfile, '--pattern', 'errors=ERROR',
+            '-s', 'errors'], lambda: self.write('app.log', 'ERROR after\n', 'a'))
+        self.assertEquals(outputs, ["Logfile OK - errors=0 | 'errors'=0", "Logfile OK - errors=1 | 'errors'=1"])
+
+    def testNagiosAggregate(self):
+        "Services read from status.dat are replayed"
+        status_file = self.write('status.dat', "programstatus {\n\tprogram_start=1000\n\t}\n\n"
+            "servicestatus {\n\thost_name=db1\n\tservice_description=MySQL\n\tcurrent_state=2\n\t}\n")
+
+        outputs = self.assertReplaysRecording(NagiosAggregate, ['--status-file', status_file,
+            '-s', 'problem_percentage'])
+        self.assertTrue(outputs[0].startswith('Aggregate OK - problem_percentage=100'), outputs[0])
+
+    def testStatisticsThatCantBeReplayed(self):
+        "Statistics that can't be recorded fail when recording or replaying, rather than making live requests"
+        class Plugin(RecorderTests.Plugin):
+            def check(self):
+                self._check_not_recording("Probe statistics")
+                RecorderTests.Plugin.check(self)
+
+        opts = ['-s', 'counter', '--delta-file', os.path.join(self.directory, 'delta')]
+        self.assertEquals(Plugin.run(opts)[0], NagiosPlugin.STATUS_OK)
+
+        (status, output) = Plugin.run(opts + ['--record', self.recordings])
+        self.assertEquals(status, NagiosPlugin.STATUS_UNKNOWN)
+        self.assertTrue(output.endswith("Probe statistics can't be recorded or replayed."), output)
+
+class LogScannerTests(unittest.TestCase):
+    "Tests for the LogScanner class in check_logfile.py"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'app.log')
+        self.scanner = LogScanner(self.path, [('errors', 'ERROR'), ('oom', 'Out of memory')])
+        self.write('w', 'ERROR before the first scan\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, mode, text, path=None):
+        file = open(path or self.path, mode)
+        file.write(text)
+        file.close()
+
+    def testFirstScanStartsAtTheEnd(self):
+        "Matches already in the file when it's first scanned aren't counted"
+        (counts, position) = self.scanner.scan()
+        self.assertEquals(counts, {'errors': 0, 'oom': 0})
+        self.assertEquals(position['offset'], os.path.getsize(self.path))
+
+    def testPartialLinesWaitUntilTheyEnd(self):
+        "A line still being written is only scanned once it's complete"
+        (counts, position) = self.scanner.scan()
+        self.write('a', 'ERROR one\nOut of memory, ERROR')
+        (counts, position) = self.scanner.scan(position)
+        self.assertEquals(counts, {'errors': 1, 'oom': 0})
+
+        self.write('a', ' two\n')
+        (counts, position) = self.scanner.scan(position)
+        self.assertEquals(counts, {'errors': 1, 'oom': 1})
+        self.assertEquals(position['counters'], {'errors': 2, 'oom': 1})
+        self.assertEquals(position['offset'], os.path.getsize(self.path))
+
+    def testTruncatedFileIsScannedFromTheStart(self):
+        "A file shorter than the previous position was truncated, so all of it is new"
+        (counts, position) = self.scanner.scan()
+        self.write('w', 'ERROR\n')
+        (counts, position) = self.scanner.scan(position)
+        self.assertEquals(counts, {'errors': 1, 'oom': 0})
+
+    def testRotatedFileIsFinishedFirst(self):
+        "After rotation the rest of the old file is scanned, then the new file from the start"
+        (counts, position) = self.scanner.scan()
+        self.write('a', 'ERROR before rotation\n')
+        os.rename(self.path, self.path + '.1')
+        self.write('a', 'Out of memory without a newline', self.path + '.1')
+        self.write('w', 'ERROR after rotation\n')
+
+        (counts, position) = self.scanner.scan(position, '.1')
+        self.assertEquals(counts, {'errors': 2, 'oom': 1})
+        self.assertEquals(position['inode'], os.stat(self.path).st_ino)
+        self.assertEquals(position['offset'], os.path.getsize(self.path))
+
+    def testPatternsMatchingTheEmptyStringAreRejected(self):
+        "Patterns that can match the empty string would count a match between every character"
+        for regex in ('.*', '^$', 'x*', 'ERROR|'):
+            self.assertRaises(InvalidParameterError, LogScanner, self.path, [('errors', 'ERROR'), ('empty', regex)])
+
+    def testPatternNamesOfStatisticsAreRejected(self):
+        "Patterns can't be named after the statistics counting every pattern or each pattern's total"
+        for name in ('matches', 'matches_total', 'errors_total'):
+            self.assertRaises(InvalidParameterError, LogFile, ['--logfile', self.path, '--pattern', 'errors=ERROR',
+                '--pattern', name + '=WARNING', '-s', 'errors', '--delta-file', os.path.join(self.directory, 'delta')])
+
+class MountInfoTests(unittest.TestCase):
+    "Tests for the MountInfo class in check_disk.py"
+
+    MOUNTINFO = (
+        "22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw,errors=remount-ro\n"
+        "23 22 0:21 / /proc rw,nosuid shared:12 - proc proc rw\n"
+        "24 22 0:44 / /mnt/my\\040disk rw,relatime shared:2 - ext4 /dev/sdb1 rw\n"
+        "25 22 0:45 / /mnt/back\\134040slash rw,relatime shared:3 - xfs /dev/sdc\\0401 rw\n"
+        "26 22 0:46 / /data rw,relatime shared:4 - ext4 /dev/sdd1 rw\n"
+        "27 26 0:47 / /data rw,relatime shared:5 - nfs server:/export rw\n")
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'mountinfo')
+        file = open(self.path, 'w')
+        file.write(self.MOUNTINFO)
+        file.close()
+        self.mountinfo = MountInfo(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testMountsAreParsedAndUnescaped(self):
+        "Mount points and sources are unescaped, and a backslash is only unescaped once"
+        self.assertEquals(self.mountinfo.get_mounts(excluded_types=['proc']), [
+            ('/', 'ext4', '/dev/sda1'),
+            ('/data', 'nfs', 'server:/export'),
+            ('/mnt/back\\040slash', 'xfs', '/dev/sdc 1'),
+            ('/mnt/my disk', 'ext4', '/dev/sdb1'),
+        ])
+
+    def testLastMountHidesEarlierOnes(self):
+        "Only the last mount on a mount point is returned"
+        self.assertEquals(self.mountinfo.get_mounts(['/data']), [('/data', 'nfs', 'server:/export')])
+
+    def testMountsAreFilteredByType(self):
+        "Only mounts of the given types, and not of the excluded ones, are returned"
+        self.assertEquals([mount[0] for mount in self.mountinfo.get_mounts(types=['ext4'])], ['/', '/mnt/my disk'])
+        self.assertEquals([mount[0] for mount in self.mountinfo.get_mounts(excluded_types=['ext4', 'nfs'])],
+            ['/mnt/back\\040slash', '/proc'])
+
+    def testMalformedLines(self):
+        "Lines without the separator or with too few fields are reported rather than misread"
+        for line in ("28 22 0:48 / /broken rw,relatime shared:6 ext4 /dev/sde1 rw\n",
+                "28 22 0:48 / /broken rw - ext4\n", "28 22 0:48 /\n"):
+            file = open(self.path, 'a')
+            file.write(line)
+            file.close()
+
+            self.assertRaises(UnexpectedResponseError, self.mountinfo.get_mounts)
+
+            file = open(self.path, 'w')
+            file.write(self.MOUNTINFO)
+            file.close()
+
+class FilesystemStatisticTests(unittest.TestCase):
+    "Tests for the FilesystemStatistic class in check_disk.py"
+
+    class HungStatistic(FilesystemStatistic):
+        "Queries mounts that don't answer until released"
+        release = threading.Event()
+
+        def _statvfs(self, mount_point, results):
+            self.release.wait()
+            FilesystemStatistic._statvfs(self, mount_point, results)
+
+    def testHungMountIsNotQueriedAgain(self):
+        "A mount whose query from an earlier check hasn't returned fails without starting another"
+        statistic = self.HungStatistic(0.05)
+        (stats, failed) = statistic.get_stats(['/'])
+        self.assertEquals(failed, {'/': 'timed out after 0.05s'})
+
+        threads = threading.active_count()
+        (stats, failed) = statistic.get_stats(['/'])
+        self.assertEquals(failed, {'/': 'still not answering an earlier check'})
+        self.assertEquals(threading.active_count(), threads)
+
+        self.HungStatistic.release.set()
+        FilesystemStatistic._queries['/'].join()
+        (stats, failed) = statistic.get_stats(['/'])
+        self.assertEquals(failed, {})
+        self.assertTrue('/' in stats)
+
+class ProcessScannerTests(unittest.TestCase):
+    "Tests for the ProcessScanner class in check_procs.py"
+
+    class Scanner(ProcessScanner):
+        "Scans processes whose file descriptors can only be read for pids below 200"
+        def _count_fds(self, pid):
+            if pid >= 200:
+                raise OSError(errno.EACCES, 'Permission denied')
+            return pid
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for (pid, state) in ((100, 'S'), (150, 'R'), (200, 'S'), (250, 'Z')):
+            os.mkdir(os.path.join(self.directory, str(pid)))
+            file = open(os.path.join(self.directory, str(pid), 'stat'), 'w')
+            file.write('%d (my app) %s%s 3 0\n' % (pid, state, ' 0' * 16))
+            file.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testProcessesAreCounted(self):
+        "Matching processes, their threads and their states are counted"
+        (stats, states, worst) = self.Scanner(self.directory, ['my app']).scan()
+        self.assertEquals((stats['count'], stats['threads'], stats['threads_max']), (4, 12, 3))
+        self.assertEquals(states, {'S': 2, 'R': 1, 'Z': 1})
+
+    def testProcessesWithUnreadableFdsAreCounted(self):
+        "Processes whose file descriptors can't be read are still counted, and the number of them returned"
+        (stats, states, worst) = self.Scanner(self.directory, ['my app']).scan(read_fds=True)
+        self.assertEquals(stats['count'], 4)
+        self.assertEquals(stats['fds_unreadable'], 2)
+        self.assertEquals(states, {'S': 2, 'R': 1, 'Z': 1})
+        self.assertEquals((stats['fds_max'], worst['fds_max']), (150, (150, 'my app')))
+
+@unittest.skipIf(check_mysql_stats == None, "MySQLdb isn't installed")
+class DigestStatisticTests(unittest.TestCase):
+    "Tests for the digest_ statistics in check_mysql_stats.py"
+
+    class Retriever(object):
+        "Returns the digest counters it's given instead of reading them from a server"
+        counters = {}
+
+        def get_digest_counters(self, verbose=False):
+            return self.counters
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.delta_file = os.path.join(self.directory, 'delta')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        clock.set(None)
+
+    def getStats(self, timestamp, counters, *opts):
+        "Returns every digest_ statistic and the perfdata of a check at timestamp with the given counters"
+        clock.set(timestamp)
+        self.Retriever.counters = counters
+        stats = {}
+
+        for statistic in ('calls_per_second', 'latency_per_second', 'rows_examined_per_second',
+                'top_latency_percentage'):
+            plugin = check_mysql_stats.MySQLStats(['-s', 'digest_' + statistic, '--delta-file', self.delta_file,
+                '-u', 'nagios', '--password', 'secret'] + list(opts))
+            plugin.statistic_retriever = self.Retriever()
+
+            # each statistic is computed from the same previous counters
+            if self.previous != None:
+                plugin.statistic_collection.data[plugin.DIGEST_COUNTERS] = {'time': self.previous[0],
+                    'value': self.previous[1]}
+            stats[statistic] = plugin._get_statistic('digest_' + statistic)
+
+        self.stored = TimestampedStatisticCollection(self.delta_file)[plugin.DIGEST_COUNTERS]['value']
+        return (stats, getattr(plugin, 'additional_perfdata', []))
+
+    def testFirstInvocationReportsNothing(self):
+        "Without counters from a previous invocation every statistic is 0"
+        self.previous = None
+        (stats, perfdata) = self.getStats(1000, {('shop', '\xab\xcd'): (10, 10 ** 12, 100)})
+        self.assertEquals(stats.values(), [0, 0, 0, 0])
+
+    def testRatesOfChange(self):
+        "Statistics are the change in the counters of every digest per second, with the schema in labels"
+        self.previous = (990, {('shop', '\xab\xcd'): (10, 10 ** 12, 100), ('blog', '\xab\xcd'): (5, 10 ** 12, 50)})
+        counters = {('shop', '\xab\xcd'): (40, 7 * 10 ** 12, 400), ('blog', '\xab\xcd'): (15, 4 * 10 ** 12, 50)}
+
+        (stats, perfdata) = self.getStats(1000, counters)
+        self.assertEquals(stats, {'calls_per_second': 4.0, 'latency_per_second': 0.9,
+            'rows_examined_per_second': 30.0, 'top_latency_percentage': 66.67})
+        self.assertEquals(perfdata, [('digest_shop_abcd_latency_per_second', 0.6),
+            ('digest_blog_abcd_latency_per_second', 0.3)])
+
+    def testResetAndNewDigestsAreCountedFromZero(self):
+        "Digests that are new, or whose counters went backwards, have only been counted since the last check"
+        self.previous = (990, {('shop', '\x01'): (100, 10 ** 12, 100), ('gone', '\x02'): (5, 10 ** 12, 5)})
+        counters = {('shop', '\x01'): (10, 10 ** 12, 20), (None, ''): (10, 10 ** 12, 20)}
+
+        (stats, perfdata) = self.getStats(1000, counters)
+        self.assertEquals(stats['calls_per_second'], 2.0)
+        self.assertEquals(stats['rows_examined_per_second'], 4.0)
+        self.assertTrue(('digest_none_other_latency_per_second', 0.1) in perfdata)
+        self.assertEquals(sorted(self.stored), [(None, ''), ('shop', '\x01')])
+
+    def testDeltaTimeIsRejected(self):
+        "digest_ statistics are already rates, so can't be used with --delta-time"
+        self.previous = None
+        self.assertRaises(InvalidParameterError, self.getStats, 1000, {}, '-d', '1')
+
+    def testDigestTopMustBePositive(self):
+        "--digest-top must report at least one digest"
+        self.previous = None
+        self.assertRaises(InvalidParameterError, self.getStats, 1000, {}, '--digest-top', '0')
+
+    def testTopLatencyPercentageIgnoresDigestTop(self):
+        "The largest share of latency is found among every digest, however few are in the perfdata"
+        self.previous = (990, {('shop', '\x01'): (0, 0, 0), ('blog', '\x02'): (0, 0, 0)})
+        counters = {('shop', '\x01'): (1, 10 ** 12, 0), ('blog', '\x02'): (1, 3 * 10 ** 12, 0)}
+
+        (stats, perfdata) = self.getStats(1000, counters, '--digest-top', '1')
+        self.assertEquals(stats['top_latency_percentage'], 75.0)
+        self.assertEquals(perfdata, [('digest_blog_02_latency_per_second', 0.3)])
+
+@unittest.skipIf(check_mysql_stats == None, "MySQLdb isn't installed")
+class InnoDBStatusParserTests(unittest.TestCase):
+    "Tests for the InnoDBStatusParser class in check_mysql_stats.py"
+
+    ## Abridged output of SHOW ENGINE INNODB STATUS from MySQL 5.7
+    STATUS = """
+=====================================
+2024-03-01 12:00:00 0x7f1c2c0f9700 INNODB MONITOR OUTPUT
+=====================================
+Per second averages calculated from the last 20 seconds
+-----------------
+BACKGROUND THREAD
+-----------------
+srv_master_thread loops: 100 srv_active, 0 srv_shutdown, 2000 srv_idle
+----------
+SEMAPHORES
+----------
+OS WAIT ARRAY INFO: reservation count 1234
+--Thread 139759045310208 has waited at buf0flu.cc line 1209 for 241.00 seconds the semaphore:
+SX-lock on RW-latch at 0x7f1c3c0c8a38 created in file buf0buf.cc line 1460
+--Thread 139759045576448 has waited at trx0undo.cc line 1690 for 240.00 seconds the semaphore:
+Mutex at 0x7f1c3c0d4c28, Mutex UNDO_SPACE_RSEG created trx0rseg.cc:204, lock var 1
+OS WAIT ARRAY INFO: signal count 5678
+RW-shared spins 0, rounds 120, OS waits 60
+RW-excl spins 0, rounds 4500, OS waits 150
+RW-sx spins 30, rounds 900, OS waits 29
+Spin rounds per wait: 120.00 RW-shared, 4500.00 RW-excl, 30.00 RW-sx
+------------
+TRANSACTIONS
+------------
+Trx id counter 987654
+Purge done for trx's n:o < 987000 undo n:o < 0 state: running but idle
+History list length 4242
+LIST OF TRANSACTIONS FOR EACH SESSION:
+---TRANSACTION 421234567890, not started
+0 lock struct(s), heap size 1136, 0 row lock(s)
+--------
+FILE I/O
+--------
+I/O thread 0 state: waiting for completed aio requests (insert buffer thread)
+Pending normal aio reads: [0, 2, 0, 1] , aio writes: [3, 0, 0, 0] ,
+ ibuf aio reads:, log i/o's:, sync i/o's:
+Pending flushes (fsync) log: 1; buffer pool: 4
+-------------------------------------
+INSERT BUFFER AND ADAPTIVE HASH INDEX
+-------------------------------------
+Ibuf: size 1, free list len 0, seg size 2, 0 merges
+---
+LOG
+---
+Log sequence number 9876543210
+Log flushed up to   9876543000
+Pages flushed up to 9876000000
+Last checkpoint at  9870000000
+2 pending log flushes, 1 pending chkp writes
+----------------------
+BUFFER POOL AND MEMORY
+----------------------
+Total large memory allocated 137428992
+Buffer pool size   8191
+Free buffers       1024
+Database pages     7000
+Modified db pages  2048
+Pending reads      5
+Pending writes: LRU 1, flush list 2, single page 3
+--------------
+ROW OPERATIONS
+--------------
+7 queries inside InnoDB, 3 queries in queue
+0 read views open inside InnoDB
+----------------------------
+END OF INNODB MONITOR OUTPUT
+============================
+"""
+
+    def setUp(self):
+        self.stats = check_mysql_stats.InnoDBStatusParser().parse(self.STATUS)
+
+    def assertStats(self, expected):
+        for (name, value) in expected.items():
+            self.assertEquals(self.stats['innodb_status_' + name], value, name)
+
+    def testSemaphores(self):
+        "Semaphore counters are parsed and threads waiting on a semaphore are counted"
+        self.assertStats({'semaphore_reservation_count': 1234, 'semaphore_signal_count': 5678,
+            'rw_shared_rounds': 120, 'rw_shared_os_waits': 60, 'rw_excl_os_waits': 150, 'semaphore_waits': 2})
+
+    def testTransactionsAndRowOperations(self):
+        "The history list length and the queries inside InnoDB are parsed"
+        self.assertStats({'history_list_length': 4242, 'queries_inside': 7, 'queries_in_queue': 3})
+
+    def testPendingIOListsAreSummed(self):
+        "Lists of pending requests for each I/O thread are summed"
+        self.assertStats({'pending_aio_reads': 3, 'pending_aio_writes': 3, 'pending_log_fsyncs': 1,
+            'pending_buffer_pool_fsyncs': 4})
+
+    def testLogAndCheckpointAge(self):
+        "The checkpoint age is the log written since the last checkpoint"
+        self.assertStats({'log_sequence_number': 9876543210, 'last_checkpoint': 9870000000,
+            'checkpoint_age': 6543210, 'pending_log_writes': 2, 'pending_checkpoint_writes': 1})
+
+    def testBufferPool(self):
+        "Buffer pool pages are parsed, with modified and free pages as percentages of the pool"
+        self.assertStats({'buffer_pool_pages': 8191, 'free_pages': 1024, 'modified_pages': 2048,
+            'pending_reads': 5, 'pending_writes_flush_list': 2, 'modified_pages_percentage': 25.0,
+            'free_pages_percentage': 12.5})
+
+    def testLinesAreOnlyMatchedInTheirSection(self):
+        "A line matching a pattern for another section is ignored"
+        stats = check_mysql_stats.InnoDBStatusParser().parse("----------\nSEMAPHORES\n----------\n"
+            "Buffer pool size   10\nHistory list length 5\n")
+        self.assertFalse('innodb_status_buffer_pool_pages' in stats)
+        self.assertFalse('innodb_status_history_list_length' in stats)
+
+    def testOldLogSequenceNumbers(self):
+        "The pairs of numbers old versions print for log sequence numbers are combined"
+        stats = check_mysql_stats.InnoDBStatusParser().parse("---\nLOG\n---\nLog sequence number 1 100\n"
+            "Last checkpoint at  0 4294967200\n")
+        self.assertEquals(stats['innodb_status_log_sequence_number'], (1 << 32) + 100)
+        self.assertEquals(stats['innodb_status_checkpoint_age'], 196)
+
+class StatusFileTests(unittest.TestCase):
+    "Tests for the StatusFile class in check_nagios_aggregate.py"
+
+    INFO = "info {\n\tcreated=1700000000\n\tversion=4.4.6\n\t}\n\n"
+    PROGRAM = "programstatus {\n\tnagios_pid=1234\n\tprogram_start=%d\n\t}\n\n"
+    SERVICE = ("servicestatus {\n\thost_name=%s\n\tservice_description=%s\n\tcurrent_state=%d\n"
+        "\tplugin_output=OK\n\tperformance_data='Questions_per_second'=%s 'Threads'=4\n\t}\n\n")
+
+    class CountingStatusFile(StatusFile):
+        "Counts how often the whole file is scanned"
+        scans = 0
+
+        def _scan(self, status, host_pattern, service_pattern):
+            self.scans += 1
+            return StatusFile._scan(self, status, host_pattern, service_pattern)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'status.dat')
+        self.status_file = self.CountingStatusFile(self.path)
+        self.hosts = re.compile('^db')
+        self.services = re.compile('^MySQL')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, program_start, services, padding=''):
+        "Writes a status.dat listing (host, service, state, questions) tuples"
+        file = open(self.path, 'w')
+        file.write(self.INFO + self.PROGRAM % program_start + padding)
+        for service in services:
+            file.write(self.SERVICE % service)
+        file.close()
+
+    def getServices(self, offsets=None):
+        (services, offsets) = self.status_file.get_services(self.hosts, self.services, offsets)
+        return ([(service['host'], service['service'], service['current_state'],
+            service['perfdata'].get('Questions_per_second')) for service in services], offsets)
+
+    def testFullScan(self):
+        "Only services whose host and description match are decoded"
+        self.write(1000, [('db1', 'MySQL Questions', 0, '12.5'), ('web1', 'MySQL Questions', 0, '1'),
+            ('db2', 'Disk', 1, '2'), ('db2', 'MySQL Questions', 2, '7')])
+
+        (services, offsets) = self.getServices()
+        self.assertEquals(services, [('db1', 'MySQL Questions', 0, 12.5), ('db2', 'MySQL Questions', 2, 7)])
+        self.assertEquals(offsets['program_start'], '1000')
+        self.assertEquals(self.status_file.scans, 1)
+
+    def testKnownOffsetsAreReused(self):
+        "While nagios hasn't restarted, services are found again from their offsets without a full scan"
+        self.write(1000, [('db1', 'MySQL Questions', 0, '12.5'), ('db2', 'MySQL Questions', 0, '7')])
+        (services, offsets) = self.getServices()
+
+        # services move as the values before them change length
+        self.write(1000, [('db1', 'MySQL Questions', 1, '1234.5'), ('db2', 'MySQL Questions', 2, '8')],
+            padding='comment=' + 'x' * 100 + '\n')
+        (services, offsets) = self.getServices(offsets)
+
+        self.assertEquals(services, [('db1', 'MySQL Questions', 1, 1234.5), ('db2', 'MySQL Questions', 2, 8)])
+        self.assertEquals(self.status_file.scans, 1)
+
+    def testRestartScansTheWholeFile(self):
+        "A changed program_start means the services may have changed, so the whole file is scanned again"
+        self.write(1000, [('db1', 'MySQL Questions', 0, '12.5')])
+        (services, offsets) = self.getServices()
+
+        self.write(2000, [('db1', 'MySQL Questions', 0, '13'), ('db3', 'MySQL Questions', 0, '3')])
+        (services, offsets) = self.getServices(offsets)
+
+        self.assertEquals(services, [('db1', 'MySQL Questions', 0, 13), ('db3', 'MySQL Questions', 0, 3)])
+        self.assertEquals(offsets['program_start'], '2000')
+        self.assertEquals(self.status_file.scans, 2)
+
+    def testMissingServiceScansTheWholeFile(self):
+        "If a known service can't be found, the whole file is scanned again"
+        self.write(1000, [('db1', 'MySQL Questions', 0, '12.5'), ('db2', 'MySQL Questions', 0, '7')])
+        (services, offsets) = self.getServices()
+
+        self.write(1000, [('db2', 'MySQL Questions', 0, '8')])
+        (services, offsets) = self.getServices(offsets)
+
+        self.assertEquals(services, [('db2', 'MySQL Questions', 0, 8)])
+        self.assertEquals(self.status_file.scans, 2)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+import sys
+import os
+import re
+import ssl
+import shlex
+import socket
+import struct
+import zlib
+import argparse
+from multiprocessing.pool import ThreadPool
+from nagiosplugin import *
+
+"""
+An NRPE-compatible server that runs the plugins in this project in-process.
+
+NRPE forks a new process for every check it runs, which for these plugins means starting a python
+interpreter and importing every module each time. This server speaks the NRPE v2 and v3 protocols so
+check_nrpe can query it as normal, but runs checks in a pool of worker threads inside one long-lived
+interpreter.
+
+Commands are defined as in nrpe.cfg, and only defined commands can be run:
+
+  command[check_ram]=check_ram.py --meminfo -s free_plus_cache -w 500000: -c 200000:
+  command[check_memcached_gets]=check_memcached.py -s cmd_get -d -w $ARG1$
+
+Only the plugins listed in nagiosplugin.PLUGINS can be run. Arguments sent by check_nrpe ($ARG1$ etc.)
+are only substituted if --allow-arguments is given.
+
+Examples
+========
+
+  ./nrpe_server.py serve --config nrpe_server.cfg --port 5666
+  ./nrpe_server.py query -H localhost -c check_ram
+
+Requirements
+=============
+
+This script requires the following python modules:
+
+  * argparse (included with python 2.7, otherwise install with 'easy_install argparse')
+  * the modules required by the plugins being served
+"""
+
+
+class NRPEProtocolError(NagiosPluginError):
+    "Thrown when a packet doesn't follow the NRPE protocol"
+    pass
+
+
+class NRPEPacket(object):
+    """
+    An NRPE query or response packet.
+
+    Version 2 packets have a fixed 1024 byte buffer. Version 3 packets give the length of their buffer,
+    so can carry longer output.
+    """
+    VERSION_2 = 2
+    VERSION_3 = 3
+
+    TYPE_QUERY = 1
+    TYPE_RESPONSE = 2
+
+    ## version, type, crc32 and result code, common to all versions
+    COMMON_HEADER = struct.Struct('!hhIh')
+    V2 = struct.Struct('!hhIh1024s2x')
+    ## alignment padding and buffer length that follow the common header in version 3 packets
+    V3_HEADER = struct.Struct('!hi')
+
+    V2_BUFFER_LENGTH = 1024
+    ## NRPE computes version 3 checksums over its C struct, which includes 3 bytes of trailing padding
+    V3_PADDING = '\0' * 3
+    ## The largest version 3 buffer we'll accept
+    V3_MAX_BUFFER_LENGTH = 65536
+
+    def __init__(self, version, type, result_code, buffer):
+        self.version = version
+        self.type = type
+        self.result_code = result_code
+        self.buffer = buffer
+
+    def encode(self):
+        "Returns the packet as a string of bytes to send"
+        if self.version == self.VERSION_2:
+            buffer = self.buffer[:self.V2_BUFFER_LENGTH - 1]
+            packet = self.V2.pack(self.version, self.type, 0, self.result_code, buffer)
+            crc = zlib.crc32(packet) & 0xffffffff
+            return self.V2.pack(self.version, self.type, crc, self.result_code, buffer)
+
+        buffer = self.buffer[:self.V3_MAX_BUFFER_LENGTH - 1] + '\0'
+        body = self.V3_HEADER.pack(0, len(buffer)) + buffer + self.V3_PADDING
+        crc = zlib.crc32(self.COMMON_HEADER.pack(self.version, self.type, 0, self.result_code) + body) & 0xffffffff
+        return self.COMMON_HEADER.pack(self.version, self.type, crc, self.result_code) + body
+
+    @classmethod
+    def read(cls, connection):
+        """
+        Reads a packet from a socket, verifying its checksum.
+
+        @throws NRPEProtocolError if the packet is malformed
+        """
+        header = cls._read_exactly(connection, cls.COMMON_HEADER.size)
+        (version, type, crc, result_code) = cls.COMMON_HEADER.unpack(header)
+
+        if version == cls.VERSION_2:
+            rest = cls._read_exactly(connection, cls.V2.size - len(header))
+            packet = header + rest
+            buffer = cls.V2.unpack(packet)[4]
+            checked = header[:4] + '\0\0\0\0' + header[8:] + rest
+        elif version == cls.VERSION_3:
+            rest = cls._read_exactly(connection, cls.V3_HEADER.size)
+            (alignment, buffer_length) = cls.V3_HEADER.unpack(rest)
+
+            if not 0 < buffer_length <= cls.V3_MAX_BUFFER_LENGTH:
+                raise NRPEProtocolError("Invalid buffer length %d" % buffer_length)
+
+            buffer = cls._read_exactly(connection, buffer_length)
+            # the padding is sent too, and leaving it unread would reset the connection when it's closed
+            padding = cls._read_exactly(connection, len(cls.V3_PADDING))
+            checked = header[:4] + '\0\0\0\0' + header[8:] + rest + buffer + padding
+        else:
+            raise NRPEProtocolError("Unsupported packet version %d" % version)
+
+        if zlib.crc32(checked) & 0xffffffff != crc:
+            raise NRPEProtocolError("Packet checksum is invalid")
+
+        return cls(version, type, result_code, buffer.split('\0', 1)[0])
+
+    @staticmethod
+    def _read_exactly(connection, length):
+        "Reads length bytes from a socket"
+        chunks = []
+        remaining = length
+
+        while remaining > 0:
+            chunk = connection.recv(remaining)
+            if not chunk:
+                raise NRPEProtocolError("Connection closed after %d of %d bytes" % (length - remaining, length))
+            chunks.append(chunk)
+            remaining -= len(chunk)
+
+        return ''.join(chunks)
+
+
+class CommandTable(object):
+    "The commands the server is allowed to run, defined as in nrpe.cfg"
+
+    def __init__(self, allow_arguments=False):
+        """
+        @param allow_arguments Whether to substitute arguments sent by clients for $ARGn$ macros
+        """
+        self.commands = {}
+        self.allow_arguments = allow_arguments
+
+    def add(self, name, command_line):
+        """
+        Defines a command.
+
+        @param name The command name clients use
+        @param command_line The plugin script to run followed by its arguments
+        @throws InvalidParameterError if the command doesn't run a known plugin
+        """
+        argv = shlex.split(command_line)
+        if not argv:
+            raise InvalidParameterError("No command line given for command %s" % name)
+
+        self.commands[name] = (load_plugin_class(argv[0]), os.path.basename(argv[0]), argv[1:])
+
+    def load(self, path):
+        "Adds commands defined in an nrpe.cfg style file. Lines other than command definitions are ignored."
+        file = open(path, 'r')
+        try:
+            for line in file:
+                match = re.match(r'^\s*command\[([^\]]+)\]\s*=\s*(.+?)\s*$', line)
+                if match:
+                    self.add(match.group(1), match.group(2))
+        finally:
+            file.close()
+
+    def resolve(self, query):
+        """
+        Returns a tuple (plugin_class, script_name, opts) for a query of the form command!arg1!arg2
+
+        @throws InvalidParameterError if the command isn't defined or arguments aren't allowed
+        """
+        parts = query.split('!')
+        (name, arguments) = (parts[0], parts[1:])
+
+        if name not in self.commands:
+            raise InvalidParameterError("Command '%s' is not defined." % name)
+
+        if arguments and not self.allow_arguments:
+            raise InvalidParameterError("Command arguments are not allowed.")
+
+        (plugin_class, script_name, opts) = self.commands[name]
+
+        substituted = []
+        for opt in opts:
+            for (index, argument) in enumerate(arguments):
+                opt = opt.replace('$ARG%d$' % (index + 1), argument)
+            substituted.append(re.sub(r'\$ARG\d+\$', '', opt))
+
+        return (plugin_class, script_name, substituted)
+
+
+class NRPEServer(object):
+    "Accepts NRPE connections and runs the queried checks in a pool of worker threads"
+
+    ## Query that check_nrpe sends to find out the server version
+    VERSION_QUERY = '_NRPE_CHECK'
+    VERSION = 'NRPE v3 (nagiosplugin)'
+
+    def __init__(self, commands, address, port, workers, timeout, ssl_context=None, allowed_hosts=None):
+        """
+        @param commands The CommandTable of commands that may be run
+        @param workers The number of checks to run at once
+        @param timeout Seconds to wait for a client to send its query or receive its response
+        @param ssl_context An optional ssl.SSLContext to wrap connections with
+        @param allowed_hosts An optional list of client addresses to accept connections from
+        """
+        self.commands = commands
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.allowed_hosts = allowed_hosts
+        self.pool = ThreadPool(workers)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((address, port))
+        self.socket.listen(128)
+        self.running = True
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def serve_forever(self):
+        "Accepts connections until stop is called"
+        while self.running:
+            try:
+                (connection, address) = self.socket.accept()
+            except socket.error:
+                continue
+
+            if self.allowed_hosts and address[0] not in self.allowed_hosts:
+                connection.close()
+                continue
+
+            self.pool.apply_async(self.handle, (connection,))
+
+    def stop(self):
+        "Stops accepting connections and waits for running checks to finish"
+        self.running = False
+        self.socket.close()
+        self.pool.close()
+        self.pool.join()
+
+    def handle(self, connection):
+        "Reads a query from a connection, runs the check and sends back the result"
+        try:
+            connection.settimeout(self.timeout)
+            if self.ssl_context:
+                connection = self.ssl_context.wrap_socket(connection, server_side=True)
+
+            query = NRPEPacket.read(connection)
+            if query.type != NRPEPacket.TYPE_QUERY:
+                raise NRPEProtocolError("Expected a query packet, received type %d" % query.type)
+
+            (status, output) = self.run(query.buffer)
+            connection.sendall(NRPEPacket(query.version, NRPEPacket.TYPE_RESPONSE, status, output).encode())
+        except (NagiosPluginError, socket.error, ssl.SSLError), error:
+            print >> sys.stderr, "Error handling NRPE connection: %s" % error
+        finally:
+            connection.close()
+
+    def run(self, query):
+        "Runs the check for a query, returning a tuple (status, output)"
+        if query == self.VERSION_QUERY:
+            return (NagiosPlugin.STATUS_OK, self.VERSION)
+
+        try:
+            (plugin_class, script_name, opts) = self.commands.resolve(query)
+        except InvalidParameterError, error:
+            return (NagiosPlugin.STATUS_UNKNOWN, str(error))
+
+        try:
+            return plugin_class.run(opts, script_name)
+        except SystemExit:
+            # argparse exits when given invalid arguments
+            return (NagiosPlugin.STATUS_UNKNOWN, "Invalid arguments for %s: %s" % (script_name, ' '.join(opts)))
+        except Exception, error:
+            return (NagiosPlugin.STATUS_UNKNOWN, "%s failed unexpectedly. Error was: %s" % (script_name, error))
+
+
+def query(host, port, command, arguments=(), version=NRPEPacket.VERSION_2, timeout=10, ssl_context=None):
+    """
+    Sends a query to an NRPE server and returns a tuple (status, output). Useful for testing the server.
+
+    @param command The command to run
+    @param arguments Arguments to substitute for $ARGn$ macros in the command definition
+    """
+    connection = socket.create_connection((host, port), timeout)
+    try:
+        if ssl_context:
+            connection = ssl_context.wrap_socket(connection, server_hostname=host)
+
+        buffer = '!'.join([command] + list(arguments))
+        connection.sendall(NRPEPacket(version, NRPEPacket.TYPE_QUERY, 0, buffer).encode())
+        response = NRPEPacket.read(connection)
+    finally:
+        connection.close()
+
+    return (response.result_code, response.buffer)
+
+
+def parse_args(opts):
+    "Parse given options and arguments"
+    parser = argparse.ArgumentParser(description="""Serves the plugins in this project over the NRPE protocol,
+        running checks in-process.""")
+    subparsers = parser.add_subparsers(dest='action')
+
+    serve = subparsers.add_parser('serve', help="Run the server")
+    serve.add_argument('--config', nargs='?', help="""nrpe.cfg style file containing command[name]=... command
+        definitions.""")
+    serve.add_argument('--command', action='append', default=[], metavar='NAME=COMMAND_LINE',
+        help="A command definition. May be given several times.")
+    serve.add_argument('--address', nargs='?', default='0.0.0.0', help="Address to listen on. Default is 0.0.0.0.")
+    serve.add_argument('-p', '--port', nargs='?', type=int, default=5666, help="Port to listen on. Default is 5666.")
+    serve.add_argument('--workers', nargs='?', type=int, default=8,
+        help="Number of checks to run at once. Default is 8.")
+    serve.add_argument('-t', '--timeout', nargs='?', type=float, default=10,
+        help="Seconds to wait for clients to send queries. Default is 10.")
+    serve.add_argument('--allow-arguments', action='store_true',
+        help="Substitute arguments sent by clients for $ARGn$ macros in command definitions.")
+    serve.add_argument('--allowed-hosts', nargs='?',
+        help="Comma-separated addresses to accept connections from. Default is to accept all.")
+    serve.add_argument('--ssl-cert', nargs='?', help="Certificate file to serve TLS connections with.")
+    serve.add_argument('--ssl-key', nargs='?', help="Private key for the certificate.")
+    serve.add_argument('--ssl-ca', nargs='?', help="CA file to verify client certificates against, if required.")
+
+    client = subparsers.add_parser('query', help="Send a query to a server")
+    client.add_argument('-H', '--hostname', nargs='?', default='localhost', help="Server to query.")
+    client.add_argument('-p', '--port', nargs='?', type=int, default=5666, help="Port to connect to.")
+    client.add_argument('-c', '--command', nargs='?', default=NRPEServer.VERSION_QUERY, help="Command to run.")
+    client.add_argument('-a', '--arguments', nargs='*', default=[], help="Arguments to the command.")
+    client.add_argument('--packet-version', type=int, choices=[2, 3], default=2,
+        help="NRPE packet version to send. Default is 2.")
+    client.add_argument('--ssl', action='store_true', help="Connect with TLS.")
+    client.add_argument('-t', '--timeout', nargs='?', type=float, default=10, help="Seconds to wait for the result.")
+
+    return parser.parse_args(opts)
+
+
+def get_server_ssl_context(args):
+    "Returns an SSLContext for the server, or None if no certificate was given"
+    if not args.ssl_cert:
+        return None
+
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.load_cert_chain(args.ssl_cert, args.ssl_key)
+
+    if args.ssl_ca:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(args.ssl_ca)
+
+    return context
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+
+    if args.action == 'query':
+        context = None
+        if args.ssl:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+
+        try:
+            (status, output) = query(args.hostname, args.port, args.command, args.arguments, args.packet_version,
+                args.timeout, context)
+        except (NagiosPluginError, socket.error, ssl.SSLError), error:
+            print "Error querying %s:%d: %s" % (args.hostname, args.port, error)
+            sys.exit(NagiosPlugin.STATUS_UNKNOWN)
+
+        print output
+        sys.exit(status)
+
+    try:
+        commands = CommandTable(args.allow_arguments)
+        if args.config:
+            commands.load(args.config)
+        for definition in args.command:
+            (name, separator, command_line) = definition.partition('=')
+            commands.add(name, command_line)
+
+        allowed_hosts = None
+        if args.allowed_hosts:
+            allowed_hosts = args.allowed_hosts.split(',')
+
+        server = NRPEServer(commands, args.address, args.port, args.workers, args.timeout,
+            get_server_ssl_context(args), allowed_hosts)
+    except (NagiosPluginError, IOError, socket.error, ssl.SSLError), error:
+        print "Unable to start the server: %s" % error
+        sys.exit(1)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()